@@ -0,0 +1,4 @@
+-- AlterTable
+ALTER TABLE "bundle" ADD COLUMN     "codec" TEXT,
+ADD COLUMN     "raw_md5" TEXT,
+ADD COLUMN     "raw_size" BIGINT;
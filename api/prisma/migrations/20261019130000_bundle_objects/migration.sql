@@ -0,0 +1,2 @@
+-- AlterTable
+ALTER TABLE "bundle" ADD COLUMN     "objects" JSONB;
@@ -1,6 +1,6 @@
 const fsPromises = require('fs/promises');
 const express = require('express');
-const { PrismaClient } = require('@prisma/client');
+const { Prisma, PrismaClient } = require('@prisma/client');
 const createError = require('http-errors');
 const {
   query, param, body, checkSchema,
@@ -9,6 +9,7 @@ const multer = require('multer');
 const _ = require('lodash/fp');
 const config = require('config');
 const pm = require('picomatch');
+const { v4: uuidv4 } = require('uuid');
 
 // const logger = require('../services/logger');
 const asyncHandler = require('../middleware/asyncHandler');
@@ -345,6 +346,31 @@ const getOp = (op) => {
 }
 
 
+const DATASET_FIELDS = Object.values(Prisma.DatasetScalarFieldEnum);
+const DEFAULT_CURSOR_PAGE_SIZE = 1000;
+
+// latest download and latest STAGED state of a dataset - used by workers to
+// evict least recently used staged datasets
+const INCLUDE_LAST_ACCESS_TIMES = {
+  accesses: {
+    select: { timestamp: true },
+    orderBy: { timestamp: 'desc' },
+    take: 1,
+  },
+  states: {
+    select: { timestamp: true },
+    where: { state: 'STAGED' },
+    orderBy: { timestamp: 'desc' },
+    take: 1,
+  },
+};
+
+const flatten_access_times = ({ accesses, states, ...dataset }) => ({
+  ...dataset,
+  last_accessed_at: accesses[0]?.timestamp || null,
+  last_staged_at: states[0]?.timestamp || null,
+});
+
 // Get all datasets, and the count of datasets. Results can optionally be
 // filtered and sorted by the criteria specified. Used by workers + UI.
 router.get(
@@ -371,37 +397,79 @@ router.get(
     query('sort_order').default('desc').isIn(['asc', 'desc']),
 
     query('match_name_exact').default(false).toBoolean(),
+    query('include_access_times').default(false).toBoolean(),
+
+    // cursor pagination - workers page through all datasets in the order of
+    // their ids. cursor is the id of the last dataset of the previous page (0
+    // for the first page). The response has metadata.next_cursor (null on the
+    // last page) instead of metadata.count
+    query('cursor').isInt({ min: 0 }).toInt().optional(),
+    // comma separated dataset columns to return instead of datasets with their
+    // workflows, source and derived datasets. id is always returned.
+    query('fields').optional()
+      .customSanitizer((fields) => fields.split(','))
+      .custom((fields) => fields.every((f) => DATASET_FIELDS.includes(f))),
   ]),
   asyncHandler(async (req, res, next) => {
     // #swagger.tags = ['datasets']
     console.log('QUERY', req.query);
     const query_obj = buildQueryObject(req.query);
+    const paginate_by_cursor = !_.isNil(req.query.cursor);
 
     const filterQuery = { where: query_obj };
-    const orderBy = {
+    const orderBy = paginate_by_cursor ? { id: 'asc' } : {
       [req.query.sort_by]: req.query.sort_order,
     };
-    const datasetRetrievalQuery = {
-      skip: req.query.offset,
-      take: req.query.limit,
-      ...filterQuery,
-      orderBy,
+    const relations = {
+      bundle: req.query.bundle || false,
+      ...(req.query.include_access_times && INCLUDE_LAST_ACCESS_TIMES),
+    };
+    const projection = req.query.fields ? {
+      select: {
+        ..._.fromPairs(req.query.fields.map((f) => [f, true])),
+        id: true,
+        ...relations,
+      },
+    } : {
       include: {
         ...CONSTANTS.INCLUDE_WORKFLOWS,
         source_datasets: true,
         derived_datasets: true,
-        bundle: req.query.bundle || false,
+        ...relations,
       },
     };
 
-    const [datasets, count] = await prisma.$transaction([
-      prisma.dataset.findMany({ ...datasetRetrievalQuery }),
-      prisma.dataset.count({ ...filterQuery }),
-    ]);
+    let datasets;
+    let metadata;
+    if (paginate_by_cursor) {
+      const take = req.query.limit || DEFAULT_CURSOR_PAGE_SIZE;
+      datasets = await prisma.dataset.findMany({
+        where: { ...query_obj, id: { gt: req.query.cursor } },
+        take,
+        orderBy,
+        ...projection,
+      });
+      metadata = {
+        next_cursor: datasets.length === take ? datasets[datasets.length - 1].id : null,
+      };
+    } else {
+      const [_datasets, count] = await prisma.$transaction([
+        prisma.dataset.findMany({
+          skip: req.query.offset,
+          take: req.query.limit,
+          ...filterQuery,
+          orderBy,
+          ...projection,
+        }),
+        prisma.dataset.count({ ...filterQuery }),
+      ]);
+      datasets = _datasets;
+      metadata = { count };
+    }
 
     res.json({
-      metadata: { count },
-      datasets,
+      metadata,
+      datasets: req.query.include_access_times ? datasets.map(flatten_access_times) : datasets,
     });
   }),
 );
@@ -432,6 +500,7 @@ router.get(
   validate([
     param('id').isInt().toInt(),
     query('files').toBoolean().default(false),
+    query('files_format').default('objects').isIn(['objects', 'columnar']),
     query('workflows').toBoolean().default(false),
     query('last_task_run').toBoolean().default(false),
     query('prev_task_runs').toBoolean().default(false),
@@ -450,6 +519,7 @@ router.get(
     const dataset = await datasetService.get_dataset({
       id: req.params.id,
       files: req.query.files,
+      files_format: req.query.files_format,
       workflows: req.query.workflows,
       last_task_run: req.query.last_task_run,
       prev_task_runs: req.query.prev_task_runs,
@@ -464,6 +534,58 @@ router.get(
   }),
 );
 
+async function create_dataset({
+  workflow_id, state, ingestion_space, data,
+}, initiator_id) {
+  const { origin_path } = data;
+
+  // remove whitespaces from dataset name
+  data.name = data.name.split(' ').join('-');
+
+  if (ingestion_space) {
+    // if dataset's origin_path is a restricted for dataset creation, throw
+    // error
+    const restricted_ingestion_dirs = config.restricted_ingestion_dirs[ingestion_space].split(',');
+    const origin_path_is_restricted = restricted_ingestion_dirs.some((glob) => {
+      const isMatch = pm(glob);
+      const matches = isMatch(origin_path, glob);
+      return matches.isMatch;
+    });
+    if (origin_path_is_restricted) {
+      throw createError.Forbidden();
+    }
+  }
+
+  // create workflow association
+  if (workflow_id) {
+    data.workflows = {
+      create: [
+        {
+          id: workflow_id,
+          ...(initiator_id && { initiator_id }),
+        },
+      ],
+    };
+  }
+
+  // add a state
+  data.states = {
+    create: [
+      {
+        state: state || 'REGISTERED',
+      },
+    ],
+  };
+
+  // create dataset along with associations
+  return prisma.dataset.create({
+    data,
+    include: {
+      ...CONSTANTS.INCLUDE_WORKFLOWS,
+    },
+  });
+}
+
 // create - worker
 router.post(
   '/',
@@ -482,62 +604,65 @@ router.post(
     * workflow_id,
         a new relation is created between dataset and given workflow_id'
     */
-    const {
-      workflow_id, state, ingestion_space, data,
-    } = req.body;
-
-    const { origin_path } = data;
-
-    // remove whitespaces from dataset name
-    data.name = data.name.split(' ').join('-');
-
-    if (ingestion_space) {
-      // if dataset's origin_path is a restricted for dataset creation, throw
-      // error
-      const restricted_ingestion_dirs = config.restricted_ingestion_dirs[ingestion_space].split(',');
-      const origin_path_is_restricted = restricted_ingestion_dirs.some((glob) => {
-        const isMatch = pm(glob);
-        const matches = isMatch(origin_path, glob);
-        return matches.isMatch;
-      });
-      if (origin_path_is_restricted) {
-        return next(createError.Forbidden());
-      }
-    }
+    const dataset = await create_dataset(req.body, req.user?.id);
+    res.json(dataset);
+  }),
+);
 
-    // create workflow association
-    if (workflow_id) {
-      data.workflows = {
-        create: [
-          {
-            id: workflow_id,
-          },
-        ],
-      };
+// create many - worker
+router.post(
+  '/bulk',
+  isPermittedTo('create'),
+  validate([
+    body().isArray({ min: 1 }),
+    body('*.data.name').notEmpty(),
+  ]),
+  asyncHandler(async (req, res, next) => {
+    // #swagger.tags = ['datasets']
+    // #swagger.summary = 'Create new datasets.'
+    /*
+    * #swagger.description = 'The request body is a list of the payloads
+        accepted by POST /datasets. Each dataset is created independently,
+        a failure to create one dataset does not affect the others.'
+    */
+    const datasets = [];
+    const errors = [];
+    // eslint-disable-next-line no-restricted-syntax
+    for (const payload of req.body) {
+      const { name } = payload.data;
+      try {
+        // eslint-disable-next-line no-await-in-loop
+        datasets.push(await create_dataset(payload, req.user?.id));
+      } catch (e) {
+        errors.push({ name, error: e.message });
+      }
     }
-
-    // add a state
-    data.states = {
-      create: [
-        {
-          state: state || 'REGISTERED',
-        },
-      ],
-    };
-
-    // create dataset along with associations
-    const dataset = await prisma.dataset.create({
-      data,
-      include: {
-        ...CONSTANTS.INCLUDE_WORKFLOWS,
-      },
+    res.json({
+      datasets,
+      errors,
     });
-
-
-    res.json(dataset);
   }),
 );
 
+function dataset_update_data(datasetToUpdate, update) {
+  const { metadata, ...data } = update;
+  data.metadata = _.merge(datasetToUpdate?.metadata)(metadata); // deep merge
+
+  if (update.bundle) {
+    // a JSON column is set to NULL with Prisma.DbNull
+    const bundle = update.bundle.objects === null
+      ? { ...update.bundle, objects: Prisma.DbNull }
+      : update.bundle;
+    data.bundle = {
+      upsert: {
+        create: bundle,
+        update: bundle,
+      },
+    };
+  }
+  return data;
+}
+
 // modify - worker
 router.patch(
   '/:id',
@@ -567,23 +692,11 @@ router.patch(
     });
     if (!datasetToUpdate) { return next(createError(404)); }
 
-    const { metadata, ...data } = req.body;
-    data.metadata = _.merge(datasetToUpdate?.metadata)(metadata); // deep merge
-
-    if (req.body.bundle) {
-      data.bundle = {
-        upsert: {
-          create: req.body.bundle,
-          update: req.body.bundle,
-        },
-      };
-    }
-
     const dataset = await prisma.dataset.update({
       where: {
         id: req.params.id,
       },
-      data,
+      data: dataset_update_data(datasetToUpdate, req.body),
       include: {
         ...CONSTANTS.INCLUDE_WORKFLOWS,
         source_datasets: true,
@@ -739,6 +852,17 @@ router.post(
   }),
 );
 
+const REPORT_FILENAME = 'multiqc_report.html';
+
+// directory of the QC reports with this report_id, created if missing
+async function get_report_dir(report_id) {
+  const parent_dir = `reports/${report_id}`;
+  await fsPromises.mkdir(parent_dir, {
+    recursive: true,
+  });
+  return parent_dir;
+}
+
 const report_storage = multer.diskStorage({
   async destination(req, file, cb) {
     try {
@@ -749,12 +873,7 @@ const report_storage = multer.diskStorage({
       });
 
       if (dataset?.metadata?.report_id) {
-        const parent_dir = `reports/${dataset?.metadata?.report_id}`;
-        await fsPromises.mkdir(parent_dir, {
-          recursive: true,
-        });
-
-        cb(null, parent_dir);
+        cb(null, await get_report_dir(dataset.metadata.report_id));
       } else {
         cb('report_id is not set');
       }
@@ -764,7 +883,7 @@ const report_storage = multer.diskStorage({
   },
 
   filename(req, file, cb) {
-    cb(null, 'multiqc_report.html');
+    cb(null, REPORT_FILENAME);
   },
 });
 
@@ -785,6 +904,116 @@ router.put(
   }),
 );
 
+// apply the changes of a workflow step in one transaction - worker
+router.post(
+  '/:id/changes',
+  isPermittedTo('update'),
+  // multipart/form-data when the changes include a report: the changes are in the JSON field "changes"
+  multer({ storage: multer.memoryStorage() }).single('report'),
+  (req, res, next) => {
+    try {
+      if (typeof req.body.changes === 'string') {
+        req.body = JSON.parse(req.body.changes);
+      }
+      next();
+    } catch (e) {
+      next(createError.BadRequest('changes is not valid JSON'));
+    }
+  },
+  validate([
+    param('id').isInt().toInt(),
+    body('update').optional().isObject(),
+    body('update.du_size').optional().notEmpty().bail()
+      .customSanitizer(BigInt),
+    body('update.size').optional().notEmpty().bail()
+      .customSanitizer(BigInt),
+    body('update.bundle_size').optional().notEmpty().bail()
+      .customSanitizer(BigInt),
+    body('update.bundle').optional().isObject(),
+    body('state').optional().isString().notEmpty(),
+    body('files').optional().isArray(),
+  ]),
+  asyncHandler(async (req, res, next) => {
+    // #swagger.tags = ['datasets']
+    // #swagger.summary = Apply the changes of a workflow step to a dataset
+    /* #swagger.description =
+        Updates the dataset (as PATCH /datasets/:id), adds files (as POST
+        /datasets/:id/files), adds a state (as POST /datasets/:id/states) and
+        saves a QC report (as PUT /datasets/:id/report). The database changes
+        are applied in one transaction: either all of them or none.
+    */
+    const datasetToUpdate = await prisma.dataset.findFirst({
+      where: {
+        id: req.params.id,
+      },
+    });
+    if (!datasetToUpdate) { return next(createError(404)); }
+
+    const update = req.body.update || {};
+
+    // the report is written to a temporary file first, and replaces the current report (the report_id is
+    // reused) only once the transaction is committed
+    let report_path;
+    let tmp_report_path;
+    if (req.file) {
+      const report_id = update.metadata?.report_id || datasetToUpdate.metadata?.report_id;
+      if (!report_id) { return next(createError.BadRequest('report_id is not set')); }
+      const parent_dir = await get_report_dir(report_id);
+      report_path = `${parent_dir}/${REPORT_FILENAME}`;
+      tmp_report_path = `${report_path}.${uuidv4()}.tmp`;
+      await fsPromises.writeFile(tmp_report_path, req.file.buffer);
+    }
+
+    let dataset;
+    try {
+      dataset = await prisma.$transaction(async (tx) => {
+        if (req.body.files?.length) {
+          const data = req.body.files.map((f) => ({
+            path: f.path,
+            md5: f.md5,
+            size: BigInt(f.size),
+            filetype: f.type,
+          }));
+          await datasetService.add_files({ dataset_id: req.params.id, data, client: tx });
+        }
+
+        if (req.body.state) {
+          await tx.dataset_state.create({
+            data: {
+              state: req.body.state,
+              dataset_id: req.params.id,
+            },
+          });
+        }
+
+        return tx.dataset.update({
+          where: {
+            id: req.params.id,
+          },
+          data: dataset_update_data(datasetToUpdate, update),
+          include: {
+            ...CONSTANTS.INCLUDE_WORKFLOWS,
+            source_datasets: true,
+            derived_datasets: true,
+          },
+        });
+      }, {
+        // adding the files of large datasets takes longer than the default timeout (5s)
+        timeout: config.get('dataset_changes.transaction_timeout_ms'),
+      });
+    } catch (e) {
+      if (tmp_report_path) {
+        await fsPromises.rm(tmp_report_path, { force: true });
+      }
+      throw e;
+    }
+    if (tmp_report_path) {
+      await fsPromises.rename(tmp_report_path, report_path);
+    }
+    res.json(dataset);
+  }),
+);
+
 router.get(
   '/:id/files',
   validate([
@@ -880,6 +1109,13 @@ router.get(
       },
     });
 
+    // the bundle of a deduplicated dataset does not contain its large files (stored as objects)
+    if (!isFileDownload && dataset.bundle?.objects) {
+      return next(createError.Conflict(
+        'The archive of this dataset does not contain all of its files. Download its files individually.',
+      ));
+    }
+
     if (dataset.metadata.stage_alias) {
       const download_file_path = isFileDownload
         ? `${dataset.metadata.stage_alias}/${file.path}`
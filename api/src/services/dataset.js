@@ -15,7 +15,29 @@ const {
 
 const prisma = new PrismaClient();
 
-function get_wf_body(wf_name) {
+// Queue and priority of a task by its type and the size of the dataset it processes.
+// Same as get_route in workers/workflow_utils.py. I/O and CPU heavy tasks are
+// sent to <app_id>.<task_type>.<small|large>.q queues, and smaller datasets
+// have higher priorities. Datasets of unknown size are considered large.
+function get_route(task_name, dataset) {
+  const { routing } = config;
+  const task_type = routing.task_types[task_name];
+  if (!task_type) {
+    return { queue: `${config.app_id}.q` };
+  }
+
+  const dataset_size = dataset?.du_size || dataset?.bundle?.size;
+  const size = dataset_size ? Number(dataset_size) : null;
+  const size_class = size !== null && size <= routing.large_dataset_size ? 'small' : 'large';
+  const route = { queue: `${config.app_id}.${task_type}.${size_class}.q` };
+  if (size !== null) {
+    const bucket = routing.priorities.find(([max_size]) => size <= max_size);
+    route.priority = bucket ? bucket[1] : routing.default_priority;
+  }
+  return route;
+}
+
+function get_wf_body(wf_name, dataset) {
   assert(config.workflow_registry.has(wf_name), `${wf_name} workflow is not registered`);
 
   // create a deep copy of the config object because it is immutable
@@ -25,13 +47,13 @@ function get_wf_body(wf_name) {
   wf_body.app_id = config.app_id;
   wf_body.steps = wf_body.steps.map((step) => ({
     ...step,
-    queue: step.queue || `${config.app_id}.q`,
+    ...(!step.queue && get_route(step.task, dataset)),
   }));
   return wf_body;
 }
 
 async function create_workflow(dataset, wf_name, initiator_id) {
-  const wf_body = get_wf_body(wf_name);
+  const wf_body = get_wf_body(wf_name, dataset);
 
 
   // check if a workflow with the same name is not already running / pending on this dataset
@@ -99,6 +121,7 @@ async function soft_delete(dataset, user_id) {
 async function get_dataset({
   id = null,
   files = false,
+  files_format = 'objects',
   workflows = false,
   last_task_run = false,
   prev_task_runs = false,
@@ -112,6 +135,7 @@ async function get_dataset({
     select: {
       path: true,
       md5: true,
+      ...(files_format === 'columnar' && { size: true }),
     },
     where: {
       NOT: {
@@ -155,6 +179,16 @@ async function get_dataset({
   });
   const dataset_workflows = dataset.workflows;
 
+  if (files && files_format === 'columnar') {
+    // arrays of paths, md5s and sizes instead of a list of objects - used by
+    // workers for datasets with many files
+    dataset.files = {
+      path: dataset.files.map((f) => f.path),
+      md5: dataset.files.map((f) => f.md5),
+      size: dataset.files.map((f) => f.size),
+    };
+  }
+
   if (workflows && dataset.workflows.length > 0) {
     // include workflow objects with dataset
     try {
@@ -433,7 +467,7 @@ async function search_files({
   });
 }
 
-async function add_files({ dataset_id, data }) {
+async function add_files({ dataset_id, data, client = prisma }) {
   const files = data.map((f) => ({
     dataset_id,
     name: path.parse(f.path).base,
@@ -452,13 +486,13 @@ async function add_files({ dataset_id, data }) {
   }));
 
   // create files and directory metadata
-  await prisma.dataset_file.createMany({
+  await client.dataset_file.createMany({
     data: files.concat(directories),
     skipDuplicates: true,
   });
 
   // retrive all files and directories for this dataset to get their ids
-  const fileObjs = await prisma.dataset_file.findMany({
+  const fileObjs = await client.dataset_file.findMany({
     where: {
       dataset_id,
     },
@@ -480,7 +514,7 @@ async function add_files({ dataset_id, data }) {
     child_id: path_to_ids[dst],
   }));
 
-  await prisma.dataset_file_hierarchy.createMany({
+  await client.dataset_file_hierarchy.createMany({
     data: edges,
     skipDuplicates: true,
   });
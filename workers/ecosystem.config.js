@@ -5,7 +5,7 @@ module.exports = {
     {
       name: "celery_worker",
       script: "python",
-      args: "-m celery -A workers.celery_app worker --loglevel INFO -O fair --pidfile celery_worker.pid --hostname 'bioloop-bc2-celery-w1@%h' --autoscale=8,2 --queues 'bc2.bioloop.iu.edu.q'",
+      args: "-m celery -A workers.celery_app worker --loglevel INFO -O fair --pidfile celery_worker.pid --hostname 'bioloop-bc2-celery-w1@%h' --autoscale=8,2 --queues 'bc2.bioloop.iu.edu.q,bc2.bioloop.iu.edu.io.small.q,bc2.bioloop.iu.edu.cpu.small.q'",
       watch: false,
       interpreter: "",
       log_date_format: "YYYY-MM-DD HH:mm Z",
@@ -15,6 +15,21 @@ module.exports = {
       exp_backoff_restart_delay: 100,
       max_restarts: 3,
     },
+    {
+      // tasks of large datasets (see config['routing']) are run by a separate worker
+      // so that they do not hold up the tasks of small datasets
+      name: "celery_worker_large",
+      script: "python",
+      args: "-m celery -A workers.celery_app worker --loglevel INFO -O fair --pidfile celery_worker_large.pid --hostname 'bioloop-bc2-celery-w2@%h' --concurrency=2 --queues 'bc2.bioloop.iu.edu.io.large.q,bc2.bioloop.iu.edu.cpu.large.q'",
+      watch: false,
+      interpreter: "",
+      log_date_format: "YYYY-MM-DD HH:mm Z",
+      error_file: "../logs/workers/celery_worker_large.err",
+      out_file: "../logs/workers/celery_worker_large.log",
+      kill_timeout: "10000",
+      exp_backoff_restart_delay: 100,
+      max_restarts: 3,
+    },
     {
       name: "watch",
       script: "python",
@@ -50,7 +65,7 @@ module.exports = {
       log_date_format: "YYYY-MM-DD HH:mm Z",
       error_file: "../logs/workers/purge_staged_datasets.err",
       out_file: "../logs/workers/purge_staged_datasets.log",
-      cron_restart: "00 07 * * *",
+      cron_restart: "00 * * * *",
       autorestart: false,
       exp_backoff_restart_delay: 100,
       max_restarts: 3,
@@ -69,6 +84,20 @@ module.exports = {
       exp_backoff_restart_delay: 100,
       max_restarts: 3,
     },
+    {
+      name: "empty_trash",
+      script: "python",
+      args: "-u -m workers.scripts.empty_trash",
+      watch: false,
+      interpreter: "",
+      log_date_format: "YYYY-MM-DD HH:mm Z",
+      error_file: "../logs/workers/empty_trash.err",
+      out_file: "../logs/workers/empty_trash.log",
+      cron_restart: "00 05 * * *",
+      autorestart: false,
+      exp_backoff_restart_delay: 100,
+      max_restarts: 3,
+    },
     // {
     //   name: "populate_bundles",
     //   script: "python",
@@ -0,0 +1,222 @@
+"""
+Stub API server for the benchmarks - an in-memory store of the datasets, that serves the endpoints called by
+the workflow steps with the same payloads as the API (sizes are serialized as strings, dates as ISO strings).
+"""
+from __future__ import annotations
+
+import email
+import json
+import re
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+SIZE_KEYS = ['du_size', 'size', 'bundle_size']
+
+
+def now() -> str:
+    return datetime.utcnow().isoformat(timespec='milliseconds') + 'Z'
+
+
+def serialize_dataset(dataset: dict, files: bool, files_format: str, bundle: bool) -> dict:
+    d = {k: v for k, v in dataset.items() if k not in ('files', 'bundle')}
+    for key in SIZE_KEYS:
+        if d.get(key) is not None:
+            d[key] = str(d[key])
+    if bundle:
+        b = dataset.get('bundle')
+        d['bundle'] = {**b, **{k: str(b[k]) for k in ('size', 'raw_size') if b.get(k) is not None}} if b else None
+    if files:
+        if files_format == 'columnar':
+            d['files'] = {
+                'path': [f['path'] for f in dataset['files']],
+                'md5': [f['md5'] for f in dataset['files']],
+                'size': [str(f['size']) for f in dataset['files']],
+            }
+        else:
+            d['files'] = [{'path': f['path'], 'md5': f['md5']} for f in dataset['files']]
+    return d
+
+
+class Store:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.datasets: dict[int, dict] = {}
+        self.metrics: list = []
+        self.next_id = 1
+
+    def add_dataset(self, **fields) -> dict:
+        with self.lock:
+            dataset = {
+                'id': self.next_id,
+                'is_deleted': False,
+                'is_staged': False,
+                'metadata': {},
+                'files': [],
+                'states': [],
+                'workflows': [],
+                'bundle': None,
+                'created_at': now(),
+                'updated_at': now(),
+                **fields,
+            }
+            self.datasets[dataset['id']] = dataset
+            self.next_id += 1
+            return dataset
+
+    def update_dataset(self, dataset_id: int, data: dict) -> dict:
+        with self.lock:
+            dataset = self.datasets[dataset_id]
+            for key, value in data.items():
+                if key in SIZE_KEYS and value is not None:
+                    value = int(value)
+                if key == 'metadata':
+                    value = {**(dataset['metadata'] or {}), **(value or {})}
+                if key == 'bundle':
+                    prev = dataset['bundle'] or {'id': dataset_id}
+                    value = {**prev, **value, 'size': int(value['size'])}
+                dataset[key] = value
+            dataset['updated_at'] = now()
+            return dataset
+
+    def add_files(self, dataset_id: int, files: list[dict]) -> None:
+        with self.lock:
+            self.datasets[dataset_id]['files'].extend(
+                {**f, 'size': int(f['size']) if f.get('size') is not None else None} for f in files
+            )
+
+    def add_state(self, dataset_id: int, state: dict) -> None:
+        with self.lock:
+            self.datasets[dataset_id]['states'].append({**state, 'timestamp': now()})
+
+
+class Handler(BaseHTTPRequestHandler):
+    store: Store = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, body, status=200):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(length)
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('application/json'):
+            return json.loads(data)
+        if content_type.startswith('multipart/form-data'):
+            # {field name: content}
+            message = email.message_from_bytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + data)
+            return {part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+                    for part in message.get_payload()}
+        return data
+
+    def route(self, method: str):
+        url = urlparse(self.path)
+        path = url.path.strip('/')
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        body = self.body()
+        flag = lambda name: query.get(name) in ('True', 'true')  # noqa: E731
+
+        if m := re.fullmatch(r'datasets/(\d+)', path):
+            dataset_id = int(m.group(1))
+            if dataset_id not in self.store.datasets:
+                return self.send({'error': 'not found'}, 404)
+            if method == 'GET':
+                dataset = self.store.datasets[dataset_id]
+                d = serialize_dataset(dataset,
+                                      files=flag('files'),
+                                      files_format=query.get('files_format', 'objects'),
+                                      bundle=flag('bundle'))
+                if not flag('include_upload_log'):
+                    d.pop('dataset_upload_log', None)
+                return self.send(d)
+            if method == 'PATCH':
+                dataset = self.store.update_dataset(dataset_id, body)
+                return self.send(serialize_dataset(dataset, files=False, files_format='objects', bundle=True))
+
+        if m := re.fullmatch(r'datasets/(\d+)/files', path):
+            self.store.add_files(int(m.group(1)), body)
+            return self.send({})
+
+        if m := re.fullmatch(r'datasets/(\d+)/states', path):
+            self.store.add_state(int(m.group(1)), body)
+            return self.send({})
+
+        if m := re.fullmatch(r'datasets/(\d+)/changes', path):
+            dataset_id = int(m.group(1))
+            changes = json.loads(body['changes']) if 'changes' in body else body
+            self.store.add_files(dataset_id, changes.get('files', []))
+            if 'state' in changes:
+                self.store.add_state(dataset_id, {'state': changes['state']})
+            dataset = self.store.update_dataset(dataset_id, changes.get('update', {}))
+            return self.send(serialize_dataset(dataset, files=False, files_format='objects', bundle=True))
+
+        if m := re.fullmatch(r'datasetUploads/(\d+)', path):
+            with self.store.lock:
+                upload_log = self.store.datasets[int(m.group(1))]['dataset_upload_log']['upload_log']
+                if 'status' in body:
+                    upload_log['status'] = body['status']
+                files = {f['id']: f for f in upload_log['files']}
+                for file_update in body.get('files', []):
+                    files[file_update['id']].update(file_update['data'])
+            return self.send({})
+
+        if path == 'datasets' and method == 'GET':
+            datasets = [
+                serialize_dataset(d, files=False, files_format='objects', bundle=flag('bundle'))
+                for d in self.store.datasets.values()
+            ]
+            return self.send({'metadata': {'count': len(datasets), 'next_cursor': None}, 'datasets': datasets})
+
+        if path == 'metrics':
+            with self.store.lock:
+                self.store.metrics.extend(body if isinstance(body, list) else [body])
+            return self.send({})
+
+        # reports, workflows, notifications, ...
+        return self.send({})
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def do_PATCH(self):
+        self.route('PATCH')
+
+    def do_PUT(self):
+        self.route('PUT')
+
+    def do_DELETE(self):
+        self.route('DELETE')
+
+
+class APIStub:
+    def __init__(self):
+        """serves the store on a free port of localhost in a background thread"""
+        self.store = Store()
+        handler = type('StubHandler', (Handler,), {'store': self.store})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address
+        return f'http://{host}:{port}/'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
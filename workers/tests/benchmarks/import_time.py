@@ -0,0 +1,70 @@
+"""
+Startup benchmark - measures the import time of the modules run by the worker and the scripts
+with `python -X importtime` in fresh interpreters.
+
+usage (from the workers directory, with the environment variables of the config set):
+
+python -m tests.benchmarks.import_time
+python -m tests.benchmarks.import_time workers.scripts.metrics workers.api --repeat 10
+"""
+import argparse
+import json
+import re
+import statistics
+import subprocess
+import sys
+
+DEFAULT_MODULES = [
+    'workers.config',
+    'workers.api',
+    'workers.celery_app',
+    'workers.tasks.declarations',
+    'workers.scripts.metrics',
+    'workers.scripts.purge_staged_datasets',
+    'workers.scripts.watch',
+]
+
+# import time:     self [us] |   cumulative | imported package
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$')
+
+
+def measure(module: str) -> dict:
+    """import module in a new interpreter and return its cumulative import time and the loaded packages"""
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                       capture_output=True, text=True, check=True)
+    cumulative_us = None
+    packages = set()
+    for line in p.stderr.splitlines():
+        m = IMPORT_TIME_LINE.match(line)
+        if m is None:
+            continue
+        _, cumulative, _, name = m.groups()
+        packages.add(name.split('.')[0])
+        if name == module:
+            cumulative_us = int(cumulative)
+    return {'cumulative_us': cumulative_us, 'packages': packages}
+
+
+def benchmark(modules: list[str], repeat: int) -> list[dict]:
+    results = []
+    for module in modules:
+        runs = [measure(module) for _ in range(repeat)]
+        times_ms = [r['cumulative_us'] / 1000 for r in runs]
+        packages = runs[0]['packages']
+        results.append({
+            'module': module,
+            'median_ms': round(statistics.median(times_ms), 1),
+            'min_ms': round(min(times_ms), 1),
+            'loads_celery': 'celery' in packages,
+            'loads_requests': 'requests' in packages,
+        })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the import time of modules with python -X importtime')
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES)
+    parser.add_argument('--repeat', type=int, default=5, help='number of fresh interpreters per module')
+    args = parser.parse_args()
+
+    print(json.dumps(benchmark(args.modules, args.repeat), indent=2))
@@ -0,0 +1,315 @@
+"""
+Pipeline benchmark - runs the workflow steps on a synthetic dataset against local fakes and reports
+per-step metrics as JSON.
+
+- hsi, fastqc and multiqc are replaced by the scripts in tests/benchmarks/fakes (put on the PATH).
+  The fake hsi stores the archives in a directory and can be throttled to the transfer rate of the tape system.
+- the API is replaced by an in-memory stub server (tests/benchmarks/api_stub.py).
+- the capacity ledger (result backend database) is bypassed.
+
+Each step runs in a forked process, so that its peak RSS and I/O counters are its own:
+    wall_s, bytes (size of the data processed by the step), bytes_per_s,
+    read_syscalls / write_syscalls (/proc/self/io of the step process, excluding its subprocesses),
+    phases (workers.telemetry measurements of tar, compress, put, get, extract and checksum),
+    peak_rss_kb (step process), children_peak_rss_kb (largest subprocess, ex: tar, hsi - linux counts the RSS of
+    the forked python process before it execs the command)
+
+usage (from the workers directory, with the environment variables of the config set):
+
+python -m tests.benchmarks.pipeline
+python -m tests.benchmarks.pipeline --num-files 10000 --mean-file-size 65536 --size-distribution lognormal
+python -m tests.benchmarks.pipeline --hsi-bytes-per-second 56e6 --output results.json
+python -m tests.benchmarks.pipeline --bundle-codec zstd
+python -m tests.benchmarks.pipeline --dedup-min-file-size 1048576
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+import traceback
+from contextlib import contextmanager
+from pathlib import Path
+
+from tests.benchmarks.api_stub import APIStub
+from workers import telemetry, utils
+from workers.config import config
+
+FAKES_DIR = Path(__file__).resolve().parent / 'fakes'
+DATASET_TYPE = 'RAW_DATA'
+CHUNK_SIZE = 1024 * 1024
+
+
+class FakeRequest:
+    def __init__(self):
+        self.id = 'benchmark'
+        self.kwargs = {}
+        self.retries = 0
+
+
+class FakeTask:
+    """the attributes of a WorkflowTask used by the steps"""
+    max_retries = 3
+
+    def __init__(self):
+        self.request = FakeRequest()
+        self.progress = None
+
+    def update_progress(self, progress):
+        self.progress = progress
+
+
+def file_sizes(num_files: int, mean: int, distribution: str, rng: random.Random) -> list[int]:
+    if distribution == 'fixed':
+        return [mean] * num_files
+    if distribution == 'uniform':
+        return [rng.randint(0, 2 * mean) for _ in range(num_files)]
+    # lognormal: many small files and a few large ones, like sequencing runs
+    sigma = 1.5
+    mu = max(0.0, math.log(mean) - sigma ** 2 / 2)
+    return [int(rng.lognormvariate(mu, sigma)) for _ in range(num_files)]
+
+
+def generate_tree(root: Path,
+                  num_files: int,
+                  mean_file_size: int,
+                  size_distribution: str,
+                  files_per_dir: int,
+                  fastq_fraction: float,
+                  seed: int) -> int:
+    """
+    create a dataset tree of random (incompressible) files
+    @return: total size of the files
+    """
+    rng = random.Random(seed)
+    total = 0
+    for i, size in enumerate(file_sizes(num_files, mean_file_size, size_distribution, rng)):
+        directory = root / f'lane_{i // files_per_dir:04d}'
+        directory.mkdir(parents=True, exist_ok=True)
+        suffix = '.fastq.gz' if rng.random() < fastq_fraction else '.bcl.gz'
+        with open(directory / f'sample_{i:06d}{suffix}', 'wb') as f:
+            remaining = size
+            while remaining > 0:
+                n = min(remaining, CHUNK_SIZE)
+                f.write(rng.randbytes(n))
+                remaining -= n
+        total += size
+    return total
+
+
+def configure(base: Path, api_url: str, bundle_codec: str | None, dedup_min_file_size: int | None) -> None:
+    """point the config to the benchmark directories and the stub API"""
+    dirs = {
+        'stage': base / 'stage',
+        'bundle_generate': base / 'bundle' / 'generate',
+        'bundle_stage': base / 'bundle' / 'stage',
+        'qc': base / 'qc',
+        'upload': base / 'upload',
+        'download': base / 'download',
+        'trash': base / 'trash',
+    }
+    for d in dirs.values():
+        d.mkdir(parents=True, exist_ok=True)
+
+    config['api']['base_url'] = api_url
+    for dataset_type in ['RAW_DATA', 'DATA_PRODUCT']:
+        paths = config['paths'][dataset_type]
+        paths['archive'] = f'archive/{dataset_type.lower()}'
+        paths['stage'] = str(dirs['stage'] / dataset_type.lower())
+        paths['bundle'] = {
+            'generate': str(dirs['bundle_generate']),
+            'stage': str(dirs['bundle_stage']),
+            'codec': bundle_codec,
+        }
+        paths['qc'] = str(dirs['qc'])
+    config['paths']['DATA_PRODUCT']['upload'] = str(dirs['upload'])
+    config['paths']['download_dir'] = str(dirs['download'])
+    config['paths']['root'] = str(base)
+    config['trash']['dirs'] = [str(dirs['trash'])]
+    config['trash']['log_file'] = str(base / 'logs' / 'empty_trash.log')
+    config['archive']['dedup']['sda_dir'] = 'archive/objects'
+    if dedup_min_file_size is not None:
+        config['archive']['dedup']['dataset_types'] = ['RAW_DATA', 'DATA_PRODUCT']
+        config['archive']['dedup']['min_file_size'] = dedup_min_file_size
+    # never evict: the staging areas are on whatever filesystem the benchmark runs on
+    config['stage']['cache']['high_water_mark'] = 1.0
+
+
+def bypass_capacity_ledger() -> None:
+    import workers.capacity as capacity
+
+    @contextmanager
+    def reserved(celery_task, requests):
+        yield
+
+    capacity.reserved = reserved
+
+
+def io_counters() -> dict:
+    with open('/proc/self/io') as f:
+        return {k: int(v) for k, v in (line.split(':') for line in f)}
+
+
+def run_step(fn, dataset_id: int, conn) -> None:
+    """child process: run the step and send its metrics"""
+    try:
+        # keep stdout for the results, the steps print their logs
+        os.dup2(2, 1)
+        bypass_capacity_ledger()
+        # record the phases (tar, put, get, ...) of the step
+        task_run = telemetry.TaskRun('benchmark', tags={})
+        telemetry._current = task_run
+        io_start = io_counters()
+        start = time.monotonic()
+        error = None
+        try:
+            fn(FakeTask(), dataset_id)
+        except Exception:
+            error = traceback.format_exc()
+        wall = time.monotonic() - start
+        io_end = io_counters()
+        phases = {m['measurement'].removeprefix('task.'): m['fields'] for m in task_run.metrics(state=None)[1:]}
+        conn.send({
+            'wall_s': round(wall, 3),
+            'read_syscalls': io_end['syscr'] - io_start['syscr'],
+            'write_syscalls': io_end['syscw'] - io_start['syscw'],
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'children_peak_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+            'phases': phases,
+            'error': error,
+        })
+    finally:
+        conn.close()
+
+
+def measure(name: str, fn, dataset_id: int, nbytes: int) -> dict:
+    parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+    p = multiprocessing.get_context('fork').Process(target=run_step, args=(fn, dataset_id, child_conn))
+    p.start()
+    child_conn.close()
+    result = parent_conn.recv()
+    p.join()
+    return {
+        'step': name,
+        **result,
+        'bytes': nbytes,
+        'bytes_per_s': round(nbytes / result['wall_s']) if result['wall_s'] else None,
+    }
+
+
+def create_upload(stub: APIStub, source: Path, chunk_size: int) -> tuple[int, int]:
+    """split the files of source into upload chunks, as the UI uploads them"""
+    dataset = stub.store.add_dataset(name=f'{source.name}_upload', type='DATA_PRODUCT',
+                                     workflows=[{'id': 'benchmark', 'name': 'integrated', 'status': 'RUNNING'}])
+    chunks_dir = Path(config['paths']['DATA_PRODUCT']['upload']) / str(dataset['id']) / 'uploaded_chunks'
+    files = []
+    total = 0
+    for i, path in enumerate(sorted(p for p in source.rglob('*') if p.is_file())):
+        md5 = utils.checksum(path)
+        file_chunks_dir = chunks_dir / str(i)
+        file_chunks_dir.mkdir(parents=True)
+        num_chunks = 0
+        with open(path, 'rb') as f:
+            for num_chunks, chunk in enumerate(iter(lambda: f.read(chunk_size), b''), start=1):
+                (file_chunks_dir / f'{md5}-{num_chunks - 1}').write_bytes(chunk)
+        if num_chunks == 0:
+            (file_chunks_dir / f'{md5}-0').touch()
+            num_chunks = 1
+        files.append({'id': i, 'name': path.name, 'md5': md5, 'num_chunks': num_chunks,
+                      'path': str(path.parent.relative_to(source)), 'status': 'UPLOADED'})
+        total += path.stat().st_size
+    stub.store.update_dataset(dataset['id'], {'dataset_upload_log': {
+        'id': dataset['id'],
+        'upload_log': {'status': 'UPLOADED', 'files': files},
+    }})
+    return dataset['id'], total
+
+
+def benchmark(args) -> dict:
+    from workers.tasks.archive import archive_dataset
+    from workers.tasks.download import setup_download
+    from workers.tasks.inspect import inspect_dataset
+    from workers.tasks.process_dataset_upload import process
+    from workers.tasks.qc import generate_qc
+    from workers.tasks.stage import stage_dataset
+    from workers.tasks.validate import validate_dataset
+
+    base = Path(tempfile.mkdtemp(prefix='bioloop-benchmark-', dir=args.dir))
+    os.environ['PATH'] = f'{FAKES_DIR}{os.pathsep}{os.environ["PATH"]}'
+    os.environ['FAKE_HSI_ROOT'] = str(base / 'sda')
+    os.environ['FAKE_HSI_BYTES_PER_SECOND'] = str(args.hsi_bytes_per_second)
+    os.environ['FAKE_HSI_LATENCY_SECONDS'] = str(args.hsi_latency_seconds)
+    os.environ['FAKE_FASTQC_SECONDS_PER_GB'] = str(args.fastqc_seconds_per_gb)
+
+    try:
+        with APIStub() as stub:
+            configure(base, stub.base_url,
+                      bundle_codec=args.bundle_codec,
+                      dedup_min_file_size=args.dedup_min_file_size)
+            origin = base / 'origin' / 'benchmark_dataset'
+            size = generate_tree(origin,
+                                 num_files=args.num_files,
+                                 mean_file_size=args.mean_file_size,
+                                 size_distribution=args.size_distribution,
+                                 files_per_dir=args.files_per_dir,
+                                 fastq_fraction=args.fastq_fraction,
+                                 seed=args.seed)
+            dataset = stub.store.add_dataset(name=origin.name, type=DATASET_TYPE, origin_path=str(origin))
+
+            steps = [
+                ('inspect_dataset', inspect_dataset),
+                ('archive_dataset', archive_dataset),
+                ('stage_dataset', stage_dataset),
+                ('validate_dataset', validate_dataset),
+                ('setup_dataset_download', setup_download),
+                ('generate_qc', generate_qc),
+            ]
+            results = []
+            for name, fn in steps:
+                results.append(measure(name, fn, dataset['id'], size))
+                if results[-1]['error'] is not None:
+                    break
+
+            upload_id, upload_size = create_upload(stub, origin, args.upload_chunk_size)
+            results.append(measure('process_dataset_upload', process, upload_id, upload_size))
+
+            return {
+                'params': {k: v for k, v in vars(args).items() if k not in ('output', 'dir')},
+                'dataset': {'num_files': args.num_files, 'size': size},
+                'steps': results,
+            }
+    finally:
+        if not args.keep:
+            shutil.rmtree(base, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the workflow steps on a synthetic dataset')
+    parser.add_argument('--num-files', type=int, default=1000)
+    parser.add_argument('--mean-file-size', type=int, default=1024 * 1024, help='bytes')
+    parser.add_argument('--size-distribution', choices=['fixed', 'uniform', 'lognormal'], default='lognormal')
+    parser.add_argument('--files-per-dir', type=int, default=100)
+    parser.add_argument('--fastq-fraction', type=float, default=0.5, help='fraction of the files that are fastq')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--hsi-bytes-per-second', type=float, default=0, help='0: unlimited')
+    parser.add_argument('--hsi-latency-seconds', type=float, default=0)
+    parser.add_argument('--fastqc-seconds-per-gb', type=float, default=0)
+    parser.add_argument('--bundle-codec', choices=['zstd'], help='default: uncompressed bundles')
+    parser.add_argument('--dedup-min-file-size', type=int,
+                        help='archive the files of at least this size as objects. default: no dedup')
+    parser.add_argument('--upload-chunk-size', type=int, default=2 * 1024 * 1024)
+    parser.add_argument('--dir', help='directory to create the benchmark files in. default: system temp dir')
+    parser.add_argument('--keep', action='store_true', help='do not delete the benchmark files')
+    parser.add_argument('--output', help='write the results to this file instead of stdout')
+    args = parser.parse_args()
+
+    results = json.dumps(benchmark(args), indent=2)
+    if args.output:
+        Path(args.output).write_text(results)
+    else:
+        print(results)
@@ -1,10 +1,10 @@
 import logging
 from datetime import datetime
+from pathlib import Path
 from urllib.parse import urljoin
 import json
 
 import requests
-from glom import glom, assign as glom_assign
 from requests.adapters import HTTPAdapter, Retry
 
 import workers.utils as utils
@@ -96,26 +96,39 @@ def int_to_str(d: dict, key: str):
     return d
 
 
+def parse_date(date_str: str) -> datetime | None:
+    """parse the UTC dates of the API (ex: 2023-06-01T10:20:30.123Z) to naive datetime objects"""
+    try:
+        return datetime.fromisoformat(date_str.removesuffix('Z'))
+    except ValueError:  # unable to parse date string
+        return None
+
+
 def dataset_getter(dataset: dict):
-    date_format = '%Y-%m-%dT%H:%M:%S.%fZ'
-    date_keys = ['created_at', 'updated_at']
+    date_keys = ['created_at', 'updated_at', 'last_accessed_at', 'last_staged_at']
 
-    # convert du_size and size from string to int
     if dataset is None:
         return dataset
 
+    # convert du_size and size from string to int
     for key in ['du_size', 'size']:
         str_to_int(dataset, key)
-    dataset['files'] = [str_to_int(f, 'size') for f in dataset.get('files', [])]
+
+    files = dataset.get('files', [])
+    if isinstance(files, dict):
+        # columnar files: {'path': [...], 'md5': [...], 'size': [...]}
+        if 'size' in files:
+            files['size'] = [utils.parse_number(size) for size in files['size']]
+    else:
+        for f in files:
+            f['size'] = utils.parse_number(f.get('size'))
+    dataset['files'] = files
 
     # convert date strings to date objects
     for date_key in date_keys:
-        date_str = glom(dataset, date_key, default=None)
+        date_str = dataset.get(date_key)
         if date_str is not None:
-            try:
-                glom_assign(dataset, date_key, datetime.strptime(date_str, date_format))
-            except ValueError:  # unable to parse date string
-                glom_assign(dataset, date_key, None)
+            dataset[date_key] = parse_date(date_str)
     return dataset
 
 
@@ -133,7 +146,11 @@ def get_all_datasets(
         days_since_last_staged=None,
         deleted=False,
         archived=None,
-        bundle=False):
+        staged=None,
+        bundle=False,
+        include_access_times=False,
+        updated_at_start: str = None,
+        updated_at_end: str = None):
     with APIServerSession() as s:
         payload = {
             'type': dataset_type,
@@ -141,7 +158,11 @@ def get_all_datasets(
             'days_since_last_staged': days_since_last_staged,
             'deleted': deleted,
             'archived': archived,
-            'bundle': bundle
+            'staged': staged,
+            'bundle': bundle,
+            'include_access_times': include_access_times,
+            'updated_at_start': updated_at_start,
+            'updated_at_end': updated_at_end,
         }
         r = s.get('datasets', params=payload)
         r.raise_for_status()
@@ -149,14 +170,67 @@ def get_all_datasets(
         return [dataset_getter(dataset) for dataset in datasets]
 
 
+def iter_datasets(
+        dataset_type=None,
+        name=None,
+        days_since_last_staged=None,
+        deleted=False,
+        archived=None,
+        staged=None,
+        bundle=False,
+        include_access_times=False,
+        updated_at_start: str = None,
+        updated_at_end: str = None,
+        fields: list[str] = None,
+        page_size: int = 1000):
+    """
+    Lazily iterate over the datasets matching the filters of get_all_datasets, fetching them in pages of page_size
+    datasets ordered by id (cursor pagination). Only one page is held in memory at a time.
+
+    @param fields: dataset columns to fetch (id is always fetched). default: datasets with their workflows,
+                   source and derived datasets, like get_all_datasets
+    @param page_size: number of datasets per request
+    """
+    with APIServerSession() as s:
+        payload = {
+            'type': dataset_type,
+            'name': name,
+            'days_since_last_staged': days_since_last_staged,
+            'deleted': deleted,
+            'archived': archived,
+            'staged': staged,
+            'bundle': bundle,
+            'include_access_times': include_access_times,
+            'updated_at_start': updated_at_start,
+            'updated_at_end': updated_at_end,
+            'fields': ','.join(fields) if fields else None,
+            'limit': page_size,
+            'cursor': 0,
+        }
+        while payload['cursor'] is not None:
+            r = s.get('datasets', params=payload)
+            r.raise_for_status()
+            body = r.json()
+            for dataset in body['datasets']:
+                yield dataset_getter(dataset)
+            payload['cursor'] = body['metadata']['next_cursor']
+
+
 def get_dataset(dataset_id: str,
                 files: bool = False,
                 bundle: bool = False,
                 include_upload_log: bool = False,
-                workflows: bool = False):
+                workflows: bool = False,
+                files_format: str = 'objects'):
+    """
+    @param files_format: 'objects' - dataset['files'] is a list of {'path', 'md5'} dicts
+                         'columnar' - dataset['files'] is a dict of lists {'path': [...], 'md5': [...], 'size': [...]}
+                         which is much smaller and faster to decode for datasets with many files
+    """
     with APIServerSession() as s:
         payload = {
             'files': files,
+            'files_format': files_format,
             'bundle': bundle,
             'workflows': workflows,
             'include_upload_log': include_upload_log
@@ -174,6 +248,19 @@ def create_dataset(dataset):
         return r.json()
 
 
+def create_datasets(datasets: list[dict]) -> dict:
+    """
+    Create many datasets in one request. Each dataset is created independently by the API.
+
+    @param datasets: list of payloads accepted by create_dataset
+    @return: {'datasets': [created datasets], 'errors': [{'name': dataset name, 'error': message}]}
+    """
+    with APIServerSession() as s:
+        r = s.post('datasets/bulk', json=[dataset_setter(dataset) for dataset in datasets])
+        r.raise_for_status()
+        return r.json()
+
+
 def update_dataset(dataset_id, update_data):
     with APIServerSession() as s:
         r = s.patch(f'datasets/{dataset_id}', json=dataset_setter(update_data))
@@ -198,12 +285,59 @@ def upload_report(dataset_id, report_filename):
         r.raise_for_status()
 
 
+def apply_dataset_changes(dataset_id,
+                          update: dict = None,
+                          state: str = None,
+                          files: list[dict] = None,
+                          report: Path = None):
+    """
+    Apply the changes of a workflow step to a dataset in one request. The API applies them in one transaction:
+    either all of them or none, so that a failed request does not leave a partial state to be retried.
+
+    @param update: as update_dataset
+    @param state: as add_state_to_dataset
+    @param files: as add_files_to_dataset
+    @param report: as upload_report, the report_id is in update['metadata'] or the dataset's metadata
+    @return: the updated dataset
+    """
+    changes = {
+        'update': dataset_setter(update),
+        'state': state,
+        'files': [int_to_str(f, 'size') for f in files] if files is not None else None,
+    }
+    changes = {k: v for k, v in changes.items() if v is not None}
+    # adding the files of a large dataset takes a while
+    timeout = (config['api']['conn_timeout'], config['api']['changes_read_timeout'])
+    with APIServerSession() as s:
+        if report is None:
+            r = s.post(f'datasets/{dataset_id}/changes', json=changes, timeout=timeout)
+        else:
+            with open(report, 'rb') as file_obj:
+                r = s.post(f'datasets/{dataset_id}/changes',
+                           data={'changes': json.dumps(changes)},
+                           files={'report': (report.name, file_obj)},
+                           timeout=timeout)
+        r.raise_for_status()
+        return r.json()
+
+
 def send_metrics(metrics):
     with APIServerSession() as s:
         r = s.post('metrics', json=metrics)
         r.raise_for_status()
 
 
+def send_task_metrics(metrics):
+    """
+    send_metrics for workers.telemetry, called by the pool processes after the tasks:
+    does not retry and does not wait on an unavailable API
+    """
+    timeout = config['telemetry']['send_timeout_seconds']
+    with APIServerSession(enable_retry=False) as s:
+        r = s.post('metrics', json=metrics, timeout=timeout)
+        r.raise_for_status()
+
+
 def add_associations(associations):
     with APIServerSession() as s:
         r = s.post(f'datasets/associations', json=associations)
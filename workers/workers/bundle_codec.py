@@ -0,0 +1,166 @@
+"""
+Bundle codec - optional compression of the dataset bundles
+
+The codec of the bundles of a dataset type is set in config['paths'][<type>]['bundle']['codec']:
+    None - the bundle is the uncompressed tar (<name>.tar)
+    'zstd' - the tar is compressed by the multi-threaded zstd command (<name>.tar.zst), if a sample of it
+             compresses to less than 1 / min_ratio of its size. Otherwise, the uncompressed tar is archived.
+
+The sampler compresses num_samples chunks of sample_size bytes, spread evenly over the tar, at the configured level.
+Datasets made of already compressed files (fastq.gz, bcl.gz, bam) are not worth the CPU time.
+
+Compressed bundles are detected by their magic number when they are extracted, so a bundle is read the same way
+whatever the codec of its dataset type is now.
+"""
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import subprocess
+from contextlib import contextmanager
+from pathlib import Path
+
+import workers.cmd as cmd
+from workers.config import config
+
+logger = logging.getLogger(__name__)
+
+CODECS = ['zstd']
+SUFFIXES = {'zstd': '.zst'}
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def detect_codec(path: Path | str) -> str | None:
+    with open(path, 'rb') as f:
+        magic = f.read(len(ZSTD_MAGIC))
+    return 'zstd' if magic == ZSTD_MAGIC else None
+
+
+def sample_ratio(path: Path | str, level: int, num_samples: int, sample_size: int) -> float:
+    """
+    estimated compression ratio (uncompressed size / compressed size) of the file
+
+    @param level: zstd compression level
+    @param num_samples: number of chunks read, spread evenly over the file
+    @param sample_size: size of the chunks
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return 1.0
+    step = max(size // num_samples, sample_size)
+    sample = bytearray()
+    with open(path, 'rb') as f:
+        for offset in range(0, size, step):
+            f.seek(offset)
+            sample += f.read(sample_size)
+    p = subprocess.run(['zstd', '-c', '-q', f'-{level}'], input=bytes(sample), capture_output=True, check=True)
+    return len(sample) / max(len(p.stdout), 1)
+
+
+def compress(src: Path, dst: Path, level: int, threads: int) -> None:
+    """
+    compress src to dst with zstd
+
+    @param threads: compression threads, 0: one per core
+    """
+    cmd.execute(['zstd', '-q', '-f', f'-{level}', f'-T{threads}', str(src), '-o', str(dst)])
+
+
+def maybe_compress(tar_path: Path, codec: str | None) -> tuple[Path, str | None]:
+    """
+    Compress the tar with the codec if it is worth it. The tar is deleted when it is compressed.
+
+    @param tar_path: uncompressed tar
+    @param codec: None | 'zstd'
+    @return: path of the bundle (the tar or the compressed tar), codec of the bundle
+    """
+    if codec is None:
+        return tar_path, None
+    if codec not in CODECS:
+        raise ValueError(f'unknown bundle codec {codec}, expected one of {CODECS}')
+
+    compression_config = config['archive']['compression']
+    level = compression_config['level']
+    ratio = sample_ratio(tar_path,
+                         level=level,
+                         num_samples=compression_config['num_samples'],
+                         sample_size=compression_config['sample_size'])
+    if ratio < compression_config['min_ratio']:
+        logger.info(f'not compressing {tar_path}: estimated compression ratio {ratio:.2f}')
+        return tar_path, None
+
+    logger.info(f'compressing {tar_path} with {codec}: estimated compression ratio {ratio:.2f}')
+    bundle_path = tar_path.with_name(tar_path.name + SUFFIXES[codec])
+    compress(tar_path, bundle_path, level=level, threads=compression_config['threads'])
+    tar_path.unlink()
+    return bundle_path, codec
+
+
+class BundleReader:
+    def __init__(self, f, compute_md5: bool):
+        """reads the (uncompressed) tar and computes its md5"""
+        self.f = f
+        self.hash = hashlib.md5() if compute_md5 else None
+
+    def read(self, n: int = -1) -> bytes:
+        data = self.f.read(n)
+        if self.hash is not None:
+            self.hash.update(data)
+        return data
+
+    def seekable(self) -> bool:
+        # a tar that is not hashed can be read as a file (tarfile is faster than with a stream)
+        return self.hash is None and self.f.seekable()
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self.f.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self.f.tell()
+
+    def md5(self, buffer_size: int) -> str | None:
+        """md5 of the tar. the rest of the tar (the padding after the end of archive blocks) is read"""
+        if self.hash is None:
+            return None
+        while self.read(buffer_size):
+            pass
+        return self.hash.hexdigest()
+
+
+@contextmanager
+def open_bundle(path: Path | str, buffer_size: int, compute_md5: bool = False):
+    """
+    Open the bundle as an uncompressed tar, whatever its codec.
+    The reader is seekable only if the bundle is an uncompressed tar and its md5 is not computed.
+
+    usage:
+
+    with open_bundle(path, buffer_size) as reader:
+        read the tar from reader
+        reader.md5(buffer_size)
+    """
+    codec = detect_codec(path)
+    if codec is None:
+        with open(path, 'rb', buffering=buffer_size) as f:
+            yield BundleReader(f, compute_md5)
+        return
+
+    p = subprocess.Popen(['zstd', '-d', '-c', '-q', str(path)],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=buffer_size)
+    try:
+        yield BundleReader(p.stdout, compute_md5)
+        # read the rest of the stream, so that zstd is not killed by SIGPIPE
+        while p.stdout.read(buffer_size):
+            pass
+    except BaseException:
+        p.kill()
+        raise
+    finally:
+        p.stdout.close()
+        stderr = p.stderr.read().decode(errors='replace')
+        p.stderr.close()
+        return_code = p.wait()
+    # ex: corrupt frame, checksum mismatch
+    if return_code != 0:
+        raise cmd.SubprocessError({'return_code': return_code, 'stdout': '', 'stderr': stderr, 'args': p.args})
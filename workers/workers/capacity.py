@@ -0,0 +1,273 @@
+"""
+Capacity - admission control for tasks that write large files
+
+Before writing, a task reserves the bytes it is going to write on each volume (filesystem). The reservations are
+recorded in a ledger in the result backend database shared by all the workers. A reservation is granted only if the
+bytes the active reservations of the volume have still to write, and the new one, fit in the free space of the volume
+(os.statvfs, and the lustre quota of the service user if configured).
+
+Tasks that cannot get a reservation are deferred - retried after a countdown - instead of starting and failing
+mid-copy when the volume fills up.
+"""
+from __future__ import annotations
+
+import logging
+import os
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from celery.exceptions import Retry
+from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
+from sca_rhythm import WorkflowTask
+
+from workers import hpfs
+from workers.config import config
+from workers.config.celeryconfig import result_backend
+
+logger = logging.getLogger(__name__)
+
+LEDGER_COLLECTION_NAME = 'capacity_ledger'
+# number of attempts to update the ledger of a volume that is concurrently updated by other tasks
+MAX_LEDGER_UPDATE_ATTEMPTS = 10
+
+
+class Volume:
+    def __init__(self, path: str, lfs_quota: bool = False):
+        """A filesystem, or a directory with a quota, whose free space is shared by concurrent tasks"""
+        self.path = path
+        self.lfs_quota = lfs_quota
+
+    def __repr__(self):
+        return f'Volume({self.path})'
+
+    def capacity(self) -> tuple[int, int]:
+        """
+        @return: total and free bytes of the volume
+        """
+        st = os.statvfs(self.path)
+        total = st.f_blocks * st.f_frsize
+        free = st.f_bavail * st.f_frsize
+        if self.lfs_quota:
+            size_usage, _ = hpfs.get_slate_scratch_usage(username=config['service_user'], path=self.path)
+            if size_usage['limit']:  # 0 - no limit
+                total = min(total, size_usage['limit'])
+                free = min(free, size_usage['limit'] - size_usage['usage'])
+        return total, max(free, 0)
+
+
+def get_volume(path: Path | str) -> Volume:
+    """
+    The configured volume that contains path (longest matching path),
+    otherwise the mount point of the filesystem of path.
+    """
+    path = Path(path).resolve()
+    volumes = [
+        v for v in config['capacity']['volumes']
+        if path == Path(v['path']).resolve() or Path(v['path']).resolve() in path.parents
+    ]
+    if volumes:
+        v = max(volumes, key=lambda v: len(str(Path(v['path']).resolve())))
+        return Volume(path=str(Path(v['path']).resolve()), lfs_quota=v.get('lfs_quota', False))
+
+    while not path.exists():
+        path = path.parent
+    while not os.path.ismount(path):
+        path = path.parent
+    return Volume(path=str(path))
+
+
+class InsufficientCapacity(Exception):
+    pass
+
+
+_mongo_client: MongoClient | None = None
+
+
+def get_ledger_collection():
+    """
+    The ledger collection, through a client shared by the reservations of this process.
+    It is created on first use, so that a process forked before (ex: a pool process) has its own client.
+    """
+    global _mongo_client
+    if _mongo_client is None:
+        _mongo_client = MongoClient(result_backend)
+    return _mongo_client.get_default_database()[LEDGER_COLLECTION_NAME]
+
+
+class CapacityLedger:
+    def __init__(self):
+        """
+        Reservations of each volume are stored in one document of the ledger collection
+        {
+            _id: volume path,
+            version: int,
+            free: free bytes of the volume at the last update,
+            reservations: {reservation_id: {bytes: int, written: int, expires_at: datetime}}
+        }
+
+        A document is updated only if its version has not changed since it was read, so that
+        concurrent reservations are never granted together against the same free space.
+
+        The free space of the volume already excludes what the holders of reservations have written. At each update,
+        the decrease of the free space since the previous update is credited to the reservations, oldest first, up to
+        their bytes, as an estimate of what they have written. A reservation is granted if it fits in the free space
+        with the bytes the holders have still to write. (Space used on the volume by other processes is credited to
+        the reservations too.)
+        """
+        self.collection = get_ledger_collection()
+        self.ttl = timedelta(seconds=config['capacity']['reservation_ttl_seconds'])
+
+    @staticmethod
+    def credit_written(reservations: dict[str, dict], prev_free: int | None, free: int) -> None:
+        """credit the space used since the previous update to the reservations, oldest first"""
+        used = (prev_free - free) if prev_free is not None else 0
+        for reservation in sorted(reservations.values(), key=lambda r: r['expires_at']):
+            if used <= 0:
+                break
+            written = reservation.get('written', 0)
+            credit = min(used, reservation['bytes'] - written)
+            reservation['written'] = written + credit
+            used -= credit
+
+    def _update(self, volume: Volume, update) -> bool:
+        """
+        Update the reservations of the volume.
+
+        @param update: update(reservations, total, free, now) modifies the active reservations and returns True,
+                       or returns False to leave the ledger as it is
+        @return: True if the ledger was updated
+        """
+        for _ in range(MAX_LEDGER_UPDATE_ATTEMPTS):
+            doc = self.collection.find_one({'_id': volume.path}) or {'version': 0, 'reservations': {}}
+            now = datetime.utcnow()
+            # drop the expired reservations
+            reservations = {k: v for k, v in doc['reservations'].items() if v['expires_at'] > now}
+            total, free = volume.capacity()
+            self.credit_written(reservations, doc.get('free'), free)
+
+            if not update(reservations, total, free, now):
+                return False
+
+            try:
+                result = self.collection.update_one(
+                    {'_id': volume.path, 'version': doc['version']},
+                    {'$set': {'reservations': reservations, 'free': free, 'version': doc['version'] + 1}},
+                    upsert=doc['version'] == 0
+                )
+            except DuplicateKeyError:
+                # another task created the ledger of this volume concurrently
+                continue
+            if result.modified_count == 1 or result.upserted_id is not None:
+                return True
+        return False
+
+    def _reserve(self, volume: Volume, reservation_id: str, nbytes: int) -> bool:
+        def update(reservations: dict, total: int, free: int, now: datetime) -> bool:
+            # the previous reservation of this id (ex: a retried task) is replaced
+            reservations.pop(reservation_id, None)
+            outstanding = sum(v['bytes'] - v.get('written', 0) for v in reservations.values())
+            if nbytes > total:
+                raise InsufficientCapacity(f'{nbytes} bytes is more than the capacity {total} of {volume}')
+            if outstanding + nbytes > free:
+                logger.info(f'unable to reserve {nbytes} bytes on {volume}: free: {free}, '
+                            f'to be written by the reservations: {outstanding}')
+                return False
+            reservations[reservation_id] = {'bytes': nbytes, 'written': 0, 'expires_at': now + self.ttl}
+            return True
+
+        if self._update(volume, update):
+            logger.info(f'reserved {nbytes} bytes on {volume} for {reservation_id}')
+            return True
+        return False
+
+    def release(self, volume: Volume, reservation_id: str) -> None:
+        def update(reservations: dict, total: int, free: int, now: datetime) -> bool:
+            reservations.pop(reservation_id, None)
+            return True
+
+        if not self._update(volume, update):
+            # the reservation expires after the ttl
+            logger.warning(f'unable to release the reservation {reservation_id} on {volume}: '
+                           f'the ledger is updated concurrently')
+
+    def reserve(self, reservation_id: str, requests: dict[Path | str, int]) -> list[Volume] | None:
+        """
+        Reserve bytes on the volumes of the given paths, all or nothing.
+
+        @param reservation_id: id of the reservation, unique per task
+        @param requests: bytes to be written to each path. paths on the same volume are added up.
+        @return: reserved volumes, None if the reservation could not be granted
+        """
+        volume_bytes: dict[str, tuple[Volume, int]] = {}
+        for path, nbytes in requests.items():
+            volume = get_volume(path)
+            _, prev = volume_bytes.get(volume.path, (volume, 0))
+            volume_bytes[volume.path] = (volume, prev + nbytes)
+
+        reserved = []
+        try:
+            for volume, nbytes in volume_bytes.values():
+                if not self._reserve(volume, reservation_id, nbytes):
+                    break
+                reserved.append(volume)
+            else:
+                return reserved
+        except Exception:
+            for volume in reserved:
+                self.release(volume, reservation_id)
+            raise
+
+        for volume in reserved:
+            self.release(volume, reservation_id)
+        return None
+
+
+def defer(celery_task: WorkflowTask, countdown: float) -> Retry:
+    """
+    Retry the task after countdown seconds.
+
+    The deferred run is sent with the number of retries of this run, so that deferrals are not counted against the
+    task's max_retries (autoretries on failures). Task.retry is not used: it counts the run as a retry, and its
+    max_retries argument is kept by the autoretry wrapper of the task for the next runs in this worker process.
+    Deferrals are counted in the task's kwargs.
+
+    @return: the Retry exception to raise
+    """
+    request = celery_task.request
+    if request.called_directly or request.is_eager:
+        raise InsufficientCapacity(f'not enough free space for task {request.id}')
+    task_kwargs = {**request.kwargs, 'deferrals': request.kwargs.get('deferrals', 0) + 1}
+    sig = celery_task.signature_from_request(request, None, task_kwargs, countdown=countdown, retries=request.retries)
+    sig.apply_async()
+    return Retry(when=countdown, sig=sig)
+
+
+@contextmanager
+def reserved(celery_task: WorkflowTask, requests: dict[Path | str, int]):
+    """
+    Reserve the bytes to be written to each path for the duration of the block.
+    If the reservation cannot be granted, the task is deferred by config['capacity']['defer_seconds'].
+
+    usage:
+
+    with capacity.reserved(celery_task, {bundle_dir: dataset['du_size']}):
+        write the bundle
+    """
+    ledger = CapacityLedger()
+    reservation_id = celery_task.request.id
+    volumes = ledger.reserve(reservation_id, requests)
+    if volumes is None:
+        countdown = config['capacity']['defer_seconds']
+        logger.warning(f'not enough free space for task {reservation_id}, deferring it by {countdown} seconds')
+        raise defer(celery_task, countdown)
+
+    try:
+        yield
+    finally:
+        for volume in volumes:
+            try:
+                ledger.release(volume, reservation_id)
+            except Exception as e:
+                logger.warning(f'unable to release the reservation {reservation_id} on {volume}', exc_info=e)
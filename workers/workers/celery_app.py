@@ -1,16 +1,12 @@
-# noinspection PyUnresolvedReferences
-import logging
-
 from celery import Celery
-# noinspection PyUnresolvedReferences
-from celery.signals import task_prerun
-
-import workers.config.celeryconfig as celeryconfig
-# noinspection PyUnresolvedReferences
-import workers.tasks.declarations
 
-app = Celery("tasks")
-app.config_from_object(celeryconfig)
+# The celery app shared by the worker, the task modules and the scripts.
+#
+# The task declarations and the worker's signal handlers (include) are imported by the worker when it starts.
+# Scripts that import this module to start workflows do not load them.
+# The configuration is loaded on first use of the app.
+app = Celery("tasks", include=['workers.recycling', 'workers.telemetry', 'workers.profiling', 'workers.tasks.declarations'])
+app.config_from_object('workers.config.celeryconfig')
 
 # @task_prerun.connect
 # def task_prerun_handler(sender=None, task=None, **kwargs):
@@ -11,13 +11,16 @@ from email.message import EmailMessage
 from pathlib import Path
 from queue import Queue
 from subprocess import Popen, PIPE
-
-from sca_rhythm import WorkflowTask
+from typing import TYPE_CHECKING
 
 from workers import api
 from workers import utils
 from workers.config import config
 
+if TYPE_CHECKING:
+    # only for type hints, so that scripts that run commands do not load celery
+    from sca_rhythm import WorkflowTask
+
 logger = logging.getLogger(__name__)
 
 
@@ -176,15 +179,19 @@ def fastqc_parallel(fastq_files: list[Path | str], output_dir: Path | str, num_t
     execute(cmd)
 
 
-def multiqc(source_dir: Path | str, output_dir: Path | str) -> None:
+def multiqc(source_dir: Path | str, output_dir: Path | str, prepend_dirs: bool = False) -> None:
     """
     Run the MultiQC tool to generate an aggregate report
 
     @param source_dir: (pathlib.Path): where fastqc generated reports
     @param output_dir: (pathlib.Path): where to create multiqc_report.html and multiqc_data
+    @param prepend_dirs: prepend the directory of the reports to the sample names
     @return: none
     """
-    cmd = ['multiqc', str(source_dir), '-o', str(output_dir)]
+    # -f: overwrite the report of the previous run instead of creating multiqc_report_1.html
+    cmd = ['multiqc', '-f', str(source_dir), '-o', str(output_dir)]
+    if prepend_dirs:
+        cmd.append('--dirs')
     execute(cmd)
 
 
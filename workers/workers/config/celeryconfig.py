@@ -38,6 +38,7 @@ result_extended = True
 result_serializer = 'json'
 
 # task entries in database are persisted forever
+# (see the task_meta mode of workers.scripts.purge_stale_workflows to archive them)
 # https://docs.celeryq.dev/en/stable/userguide/configuration.html#result-expires
 result_expires = 0
 
@@ -98,11 +99,19 @@ worker_prefetch_multiplier = 1
 worker_state_db = "./celery_state"
 
 # Maximum number of tasks a pool worker process can execute before it’s replaced with a new one.
-# Each worker process will die after processing one task
-# Used for hot module replacement (updating code while the celery main worker is running)
-# the next task run will use the updated code
+# None - the pool processes are reused across tasks, so that the tasks do not pay for a fork and the imports.
+# For hot module replacement (updating code while the celery main worker is running), the pool is restarted
+# when the version of the code changes (see workers.recycling) and the next task run will use the updated code
 # https://docs.celeryq.dev/en/stable/userguide/configuration.html#worker-max-tasks-per-child
-worker_max_tasks_per_child = 1
+worker_max_tasks_per_child = None
+
+# A pool process is replaced after a task if its resident memory exceeds this (in kilobytes)
+# https://docs.celeryq.dev/en/stable/userguide/configuration.html#worker-max-memory-per-child
+worker_max_memory_per_child = config['worker']['max_memory_per_child_kb']
+
+# allow the pool_restart remote control command, used to recycle the pool processes when the code changes
+# https://docs.celeryq.dev/en/stable/userguide/configuration.html#worker-pool-restarts
+worker_pool_restarts = True
 
 # cancel tasks (those that acks late) when rabbitmq closes connection
 # https://docs.celeryq.dev/en/stable/userguide/configuration.html#worker-cancel-long-running-tasks-on-connection-loss
@@ -33,7 +33,9 @@ config = {
         'base_url': 'http://api:3030',
         'auth_token': APP_API_TOKEN,
         'conn_timeout': 60,  # seconds
-        'read_timeout': 60  # seconds
+        'read_timeout': 60,  # seconds
+        # api.apply_dataset_changes, which adds the files of datasets in a transaction
+        'changes_read_timeout': 600  # seconds
     },
     'paths': {
         'scratch': '/path/to/scratch',
@@ -43,6 +45,8 @@ config = {
             'bundle': {
                 'generate': '/path/for/raw_data/bundle/generation',
                 'stage': '/path/for/raw_data/bundle/staging',
+                # None: uncompressed tar, 'zstd': compressed if worth it (see config['archive']['compression'])
+                'codec': None,
             },
             'qc': '/path/to/qc'
         },
@@ -53,6 +57,7 @@ config = {
             'bundle': {
                 'generate': '/path/for/data_products/bundle/generation',
                 'stage': '/path/for/data_products/bundle/staging',
+                'codec': None,
             },
         },
         'download_dir': '/path/to/download_dir',
@@ -70,7 +75,9 @@ config = {
         'recency_threshold_seconds': ONE_HOUR,
         'minimum_dataset_size': ONE_GIGABYTE,
         'wait_between_stability_checks_seconds': FIVE_MINUTES,
-        'poll_interval_seconds': 10
+        'poll_interval_seconds': 10,
+        # registered dataset names are cached here between restarts of the watcher
+        'name_index_dir': './registration_index',
     },
     'upload': {
         'UPLOAD_RETRY_THRESHOLD_HOURS': 72,
@@ -93,10 +100,120 @@ config = {
         'SUCCESS': 'SUCCESS'
     },
     'service_user': 'bioloopuser',
+    'worker': {
+        # the pool processes of the celery worker are recycled when the version of the code changes
+        # 'git': SHA of the checked out commit, 'files': hash of the sizes and modification times of the source files
+        'code_version': 'files',
+        'code_version_check_interval_seconds': 30,
+        # a pool process is recycled after a task if its memory exceeds this
+        'max_memory_per_child_kb': 2 * 1024 * 1024,
+    },
+    'routing': {
+        # tasks that are I/O or CPU heavy are routed to queues by the size of the dataset
+        # tasks not listed here are sent to the default queue <app_id>.q
+        'task_types': {
+            'inspect_dataset': 'io',
+            'archive_dataset': 'io',
+            'stage_dataset': 'io',
+            'validate_dataset': 'io',
+            'download_illumina_dataset': 'io',
+            'generate_qc': 'cpu',
+        },
+        # datasets larger than this are routed to the <app_id>.<task_type>.large.q queues
+        'large_dataset_size': 100 * ONE_GIGABYTE,
+        # [max dataset size, priority] - smaller datasets have higher priorities (0-9)
+        'priorities': [
+            [ONE_GIGABYTE, 8],
+            [10 * ONE_GIGABYTE, 6],
+            [100 * ONE_GIGABYTE, 4],
+            [1024 * ONE_GIGABYTE, 2],
+        ],
+        'default_priority': 0,
+    },
+    'archive': {
+        'tar': {
+            # 'python': workers.tar_writer - parallel reads and md5 of the archived files, 'gnu': tar --sparse
+            'writer': 'python',
+            # threads that stat and read the files ahead of the writer
+            'max_workers': 8,
+            'prefetch_files': 64,
+            # files up to this size are read whole by the threads, larger ones are streamed by the writer
+            'small_file_size': 1024 * 1024,
+            'buffer_size': 4 * 1024 * 1024,
+        },
+        # bundles of the dataset types with a codec (see workers.bundle_codec)
+        'compression': {
+            'level': 3,
+            # zstd threads, 0: one per core
+            'threads': 0,
+            # the tar is compressed if a sample of num_samples chunks of sample_size bytes
+            # compresses at least min_ratio times
+            'num_samples': 16,
+            'sample_size': 4 * 1024 * 1024,
+            'min_ratio': 1.2,
+        },
+        # content-addressed archive mode (see workers.object_store): the files of these dataset types that are
+        # at least min_file_size bytes are stored on the SDA in sda_dir, named by their md5, and are not in the bundle
+        'dedup': {
+            'dataset_types': [],
+            'min_file_size': ONE_GIGABYTE,
+            'sda_dir': 'development/objects',
+        },
+    },
+    'telemetry': {
+        # performance metrics of the tasks (see workers.telemetry), sent to the API's metrics endpoint
+        'enabled': True,
+        # metrics are sent when this many are buffered, or after the first task that ends after the interval
+        'batch_size': 50,
+        'flush_interval_seconds': 60,
+        # metrics that could not be sent are kept up to this many (metrics rejected by the API are dropped)
+        'max_buffered': 1000,
+        # metrics are sent without retries, after the tasks, by the pool processes
+        'send_timeout_seconds': 5,
+    },
+    'profiling': {
+        # task runs are profiled (see workers.profiling) if the task is listed here
+        # or if it is called with the kwarg profile=True | 'sample' | 'cprofile'
+        'tasks': [],
+        # default mode - 'sample': stack sampling (flamegraph), 'cprofile': every function call (pstats)
+        'mode': 'sample',
+        'sample_interval_seconds': 0.01,
+        'dir': '/path/to/scratch/profiles',
+    },
+    'progress': {
+        # the progress updates of a task are written to the result backend
+        # at most once per interval (see workers.progress)
+        'write_interval_seconds': 5,
+    },
+    'capacity': {
+        # filesystems whose free space is shared by concurrent archive and stage tasks
+        # lfs_quota: the space is also limited by the lustre quota of the service user on the path
+        'volumes': [
+            {'path': '/path/to/scratch', 'lfs_quota': False},
+        ],
+        # reservations of tasks that died without releasing them expire after this
+        'reservation_ttl_seconds': 48 * ONE_HOUR,
+        # tasks that cannot reserve the space they need are retried after this
+        'defer_seconds': 3 * FIVE_MINUTES,
+    },
     'stage': {
-        'purge': {
-            'days_to_live': 20,
-            'max_purges': 10
+        'cache': {
+            # fractions of the capacity of the filesystem of a staging directory
+            # when the usage is above the high water mark, the least recently used staged datasets are evicted
+            # until the usage is below the low water mark
+            'high_water_mark': 0.85,
+            'low_water_mark': 0.75,
+            # datasets downloaded within this many hours are not evicted
+            'pin_hours': 24,
+            # sanity check. max number of datasets evicted in one run
+            'max_evictions': 50
+        },
+        'extract': {
+            # threads that write the extracted files (see workers.tar_reader)
+            'max_workers': 8,
+            # max bytes read from the bundle and not written yet
+            'max_inflight_bytes': 256 * 1024 * 1024,
+            'buffer_size': 4 * 1024 * 1024,
         },
         'alias_salt': ALIAS_SALT
     },
@@ -203,13 +320,43 @@ config = {
         'from_addr': 'scauser@iu.edu',
         'sendmail_path': '/usr/sbin/sendmail'
     },
+    'trash': {
+        # directory trees are deleted by renaming them into the trash directory on the same filesystem
+        # and removing them in the background. Trash directories should not be inside watched (registration) dirs
+        'dirs': ['/path/to/trash'],
+        'max_workers': 8,
+        # throttle deletion to not overwhelm the filesystem's metadata server
+        'max_unlinks_per_second': 5000,
+        # output of the background processes that remove the trashed trees, relative to the workers directory
+        'log_file': '../logs/workers/empty_trash.log',
+    },
+    'qc': {
+        'fastqc': {
+            # max number of fastqc processes run concurrently. None - number of CPU cores
+            'max_workers': None,
+            # each fastqc process (JVM) reserves 250MB of heap per thread
+            'memory_per_worker': 512 * 1024 * 1024,
+        }
+    },
     'workflow': {
         'purge': {
             'types': ['integrated', 'stage', 'delete'],
             'age_threshold_seconds': 86400,
-            'max_purge_count': 10
+            'max_purge_count': 10,
+            # documents deleted by a query, pause between two queries
+            'batch_size': 1000,
+            'throttle_seconds': 0.5,
+            # task meta (celery_taskmeta) of the successful tasks
+            # mode: None - kept, 'archive' - the ones no current workflow refers to are moved to archive_collection
+            'task_meta': {
+                'mode': None,
+                'age_threshold_seconds': 90 * 24 * 60 * 60,
+                'archive_collection': 'celery_taskmeta_archive',
+            },
         }
     },
 'batch_script': '/opt/sca/test.sh',
 'csv_path': '/opt/sca/metadata.csv',
+# sqlite index of csv_path by bioloop_id, rebuilt when csv_path changes
+'csv_index_path': '/opt/sca/metadata_index/metadata.sqlite',
 }
@@ -73,7 +73,7 @@ def get_disk_usages():
     return parse_quota_output(stdout)
 
 
-def get_slate_scratch_usage(username):
-    command = ['lfs', 'quota', '-u', username, '/N/scratch']
+def get_slate_scratch_usage(username, path='/N/scratch'):
+    command = ['lfs', 'quota', '-u', username, path]
     stdout, stderr = cmd.execute(command)
     return parse_lfs_quota_output(stdout)
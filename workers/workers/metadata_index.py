@@ -0,0 +1,140 @@
+"""
+Metadata index - O(1) lookups of the rows of the metadata CSV by bioloop_id
+
+The metadata CSV is a large manifest shared by all datasets. Instead of scanning it for every dataset, its rows are
+loaded once into a SQLite database indexed on the key column. The index records the size and the modification time
+of the CSV it was built from and is rebuilt when the CSV changes.
+
+The index is built in a temporary file and renamed into place, so that concurrent readers (other worker processes)
+see either the previous or the new index, never a partially built one.
+"""
+from __future__ import annotations
+
+import csv
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+from pathlib import Path
+
+from workers.config import config
+
+logger = logging.getLogger(__name__)
+
+KEY_COLUMN = 'bioloop_id'
+# SQLite limits the number of parameters of a statement (999 in older versions)
+MAX_QUERY_PARAMS = 900
+
+
+class MetadataIndex:
+    def __init__(self, csv_path: Path | str = None, index_path: Path | str = None, key_column: str = KEY_COLUMN):
+        """
+        @param csv_path: default: config['csv_path']
+        @param index_path: default: config['csv_index_path']
+        @param key_column: column the rows are looked up by
+        """
+        self.csv_path = Path(csv_path or config['csv_path'])
+        self.index_path = Path(index_path or config['csv_index_path'])
+        self.key_column = key_column
+        self._conn: sqlite3.Connection | None = None
+        self._source: tuple[int, int] | None = None
+
+    def csv_source(self) -> tuple[int, int]:
+        st = self.csv_path.stat()
+        return st.st_size, st.st_mtime_ns
+
+    def build(self) -> None:
+        """load the rows of the CSV into a new index database and replace the current index with it"""
+        size, mtime_ns = self.csv_source()
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.index_path.parent, prefix=f'.{self.index_path.name}.')
+        os.close(fd)
+        try:
+            conn = sqlite3.connect(tmp_path)
+            with conn:
+                conn.execute('CREATE TABLE source (path TEXT, size INTEGER, mtime_ns INTEGER, key_column TEXT)')
+                conn.execute('INSERT INTO source VALUES (?, ?, ?, ?)',
+                             (str(self.csv_path), size, mtime_ns, self.key_column))
+                conn.execute('CREATE TABLE rows (key TEXT, row_num INTEGER, data TEXT)')
+                with open(self.csv_path, newline='') as f:
+                    reader = csv.DictReader(f)
+                    conn.executemany(
+                        'INSERT INTO rows VALUES (?, ?, ?)',
+                        ((row.get(self.key_column), i, json.dumps(row)) for i, row in enumerate(reader))
+                    )
+                # created after the bulk insert, which is faster than maintaining it row by row
+                conn.execute('CREATE INDEX rows_key ON rows (key, row_num)')
+            conn.close()
+            os.replace(tmp_path, self.index_path)
+        except Exception:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+        logger.info(f'built the metadata index {self.index_path} of {self.csv_path}')
+
+    def indexed_source(self, conn: sqlite3.Connection) -> tuple[int, int] | None:
+        try:
+            row = conn.execute('SELECT size, mtime_ns, key_column FROM source').fetchone()
+        except sqlite3.DatabaseError:
+            return None
+        if row is None or row[2] != self.key_column:
+            return None
+        return row[0], row[1]
+
+    def connection(self) -> sqlite3.Connection:
+        """connection to an index that is up-to-date with the CSV, (re)building the index if needed"""
+        source = self.csv_source()
+        if self._conn is not None and self._source == source:
+            return self._conn
+        self.close()
+
+        if self.index_path.exists():
+            conn = sqlite3.connect(f'file:{self.index_path}?mode=ro', uri=True)
+            if self.indexed_source(conn) == source:
+                self._conn, self._source = conn, source
+                return conn
+            conn.close()
+
+        self.build()
+        self._conn = sqlite3.connect(f'file:{self.index_path}?mode=ro', uri=True)
+        self._source = source
+        return self._conn
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+            self._source = None
+
+    def lookup(self, key: str) -> list[dict]:
+        """rows of the CSV whose key column is key, in file order"""
+        return self.lookup_many([key])[key]
+
+    def lookup_many(self, keys: list[str]) -> dict[str, list[dict]]:
+        """
+        Batch lookup - rows of each key, in file order, queried in a few statements.
+        Keys with no rows are mapped to an empty list.
+        """
+        keys = list(dict.fromkeys(keys))
+        results = {key: [] for key in keys}
+        conn = self.connection()
+        for i in range(0, len(keys), MAX_QUERY_PARAMS):
+            chunk = keys[i:i + MAX_QUERY_PARAMS]
+            placeholders = ','.join('?' * len(chunk))
+            rows = conn.execute(
+                f'SELECT key, data FROM rows WHERE key IN ({placeholders}) ORDER BY row_num', chunk
+            )
+            for key, data in rows:
+                results[key].append(json.loads(data))
+        return results
+
+
+_index: MetadataIndex | None = None
+
+
+def get_index() -> MetadataIndex:
+    """index of the configured CSV, shared by the tasks run in this process"""
+    global _index
+    if _index is None:
+        _index = MetadataIndex()
+    return _index
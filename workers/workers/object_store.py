@@ -0,0 +1,126 @@
+"""
+Object store - content-addressed storage of the large files of the datasets on the SDA
+
+In the dedup archive mode (dataset types listed in config['archive']['dedup']['dataset_types']), the files of a dataset
+that are at least min_file_size bytes are not written to its bundle. Each of them is stored on the SDA as an object
+named by its md5 (<sda_dir>/<md5>), unless an object with this md5 is already there: the same file archived with
+another dataset (ex: a reference index, a re-uploaded fastq) or by a previous archive of this dataset.
+
+The bundle record lists the objects of the dataset:
+bundle.objects = [{path, md5, size, mode, mtime}]
+and stage_dataset gets them into the extracted bundle.
+
+The md5 of the files are the ones computed by inspect_dataset. A file is checked against its md5 before it is stored
+or referenced, as the object of an md5 must have this content.
+
+Objects are shared by the datasets, they are never deleted by the workers.
+The bundle of a deduplicated dataset is not a complete copy of the dataset: it does not contain the objects.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import stat
+from pathlib import Path
+
+from sca_rhythm import WorkflowTask
+
+import workers.sda as sda
+import workers.telemetry as telemetry
+import workers.utils as utils
+import workers.workflow_utils as wf_utils
+from workers import exceptions as exc
+from workers.config import config
+
+logger = logging.getLogger(__name__)
+
+
+def is_enabled(dataset_type: str) -> bool:
+    return dataset_type in config['archive']['dedup']['dataset_types']
+
+
+def object_path(md5: str) -> str:
+    return f'{config["archive"]["dedup"]["sda_dir"]}/{md5}'
+
+
+def select_objects(dataset: dict) -> list[dict]:
+    """
+    files of the dataset to store as objects
+
+    @param dataset: with columnar files
+    @return: [{path, md5, size}]
+    """
+    files = dataset.get('files')
+    if not is_enabled(dataset['type']) or not isinstance(files, dict):
+        return []
+    min_file_size = config['archive']['dedup']['min_file_size']
+    return [
+        {'path': path, 'md5': md5, 'size': int(size)}
+        for path, md5, size in zip(files['path'], files['md5'], files['size'])
+        if md5 is not None and size is not None and int(size) >= min_file_size
+    ]
+
+
+def checksum(path: Path, size: int) -> str:
+    with telemetry.phase('checksum') as m:
+        md5 = utils.checksum(path)
+        m.bytes, m.files = size, 1
+    return md5
+
+
+def store_objects(celery_task: WorkflowTask, source_dir: Path, objects: list[dict]) -> list[dict]:
+    """
+    Put the files on the SDA as objects, except the ones whose object is there already.
+
+    @param source_dir: directory of the dataset
+    @param objects: [{path, md5, size}] (see select_objects)
+    @return: the objects with the mode and the modification time of the files
+    """
+    if len(objects) == 0:
+        return []
+    sda.ensure_directory(config['archive']['dedup']['sda_dir'])
+
+    stored = []
+    num_reused = 0
+    for obj in objects:
+        path = source_dir / obj['path']
+        st = path.stat()
+        md5 = checksum(path, st.st_size)
+        if md5 != obj['md5']:
+            raise exc.ValidationFailed(f'{obj["path"]} changed since the dataset was inspected: '
+                                       f'expected md5 {obj["md5"]}, evaluated {md5}')
+
+        sda_path = object_path(md5)
+        if sda.get_hash(sda_path, missing_ok=True) == md5:
+            logger.info(f'{obj["path"]} is on the SDA at {sda_path} - not uploading')
+            num_reused += 1
+        else:
+            wf_utils.upload_file_to_sda(local_file_path=path,
+                                        sda_file_path=sda_path,
+                                        celery_task=celery_task,
+                                        preflight_check=False)
+        stored.append({**obj, 'size': st.st_size, 'mode': stat.S_IMODE(st.st_mode), 'mtime': int(st.st_mtime)})
+
+    logger.info(f'{num_reused} of {len(objects)} objects were on the SDA already')
+    return stored
+
+
+def restore_objects(celery_task: WorkflowTask, target_dir: Path, objects: list[dict]) -> None:
+    """
+    Get the objects of a dataset from the SDA into its extracted bundle.
+
+    @param target_dir: directory the bundle was extracted to
+    @param objects: bundle.objects
+    """
+    for obj in objects:
+        path = target_dir / obj['path']
+        path.parent.mkdir(parents=True, exist_ok=True)
+        wf_utils.download_file_from_sda(sda_file_path=object_path(obj['md5']),
+                                        local_file_path=path,
+                                        celery_task=celery_task)
+        md5 = checksum(path, int(obj['size']))
+        if md5 != obj['md5']:
+            raise exc.ValidationFailed(f'Expected checksum of {obj["path"]} to be {obj["md5"]},'
+                                       f' but evaluated checksum was {md5}')
+        os.chmod(path, obj['mode'])
+        os.utime(path, (obj['mtime'], obj['mtime']))
@@ -0,0 +1,149 @@
+"""
+Profiling - opt-in profiling of task runs
+
+A task run is profiled when the task is listed in config['profiling']['tasks'], or when it is called with the kwarg
+`profile` (ex: in the kwargs of a workflow step: {'name': 'validate', 'task': 'validate_dataset',
+'kwargs': {'profile': 'sample'}}). The profiler is started and stopped by signal handlers around the task body,
+so the task's arguments, result and exceptions are unchanged.
+
+modes:
+    'sample' - a thread samples the stack of the task every sample_interval_seconds and counts the stacks.
+               The artifact (.folded) has one "frame;frame;...;frame count" line per stack, the input of
+               flamegraph.pl and speedscope. The overhead is low enough for production runs.
+    'cprofile' - deterministic profiling of every function call with cProfile. The artifact (.pstats) is read with
+                 pstats / snakeviz. The overhead is high for tasks that make many small calls.
+
+The artifacts are written to config['profiling']['dir']/<task name>/ and their path is added to the progress of the
+task (`profile` key), which is shown in the workflow's step.
+
+This module is imported by the main worker process, so it must not import the task modules or their dependencies.
+"""
+from __future__ import annotations
+
+import cProfile
+import logging
+import sys
+import threading
+from collections import Counter
+from pathlib import Path
+
+from celery.signals import task_prerun, task_postrun
+
+from workers.config import config
+
+logger = logging.getLogger(__name__)
+
+MODES = ['sample', 'cprofile']
+
+
+class StackSampler(threading.Thread):
+    def __init__(self, thread_id: int, interval: float):
+        """Counts the stacks of the thread thread_id sampled every interval seconds"""
+        super().__init__(name='stack-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.stacks = Counter()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def dump(self, path: Path) -> None:
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+class TaskProfile:
+    def __init__(self, mode: str, path: Path):
+        self.mode = mode
+        self.path = path
+        if mode == 'cprofile':
+            self.profiler = cProfile.Profile()
+        else:
+            self.profiler = StackSampler(thread_id=threading.get_ident(),
+                                         interval=config['profiling']['sample_interval_seconds'])
+
+    def start(self) -> None:
+        if self.mode == 'cprofile':
+            self.profiler.enable()
+        else:
+            self.profiler.start()
+
+    def stop(self) -> None:
+        if self.mode == 'cprofile':
+            self.profiler.disable()
+            self.profiler.dump_stats(self.path)
+        else:
+            self.profiler.stop()
+            self.profiler.dump(self.path)
+
+
+def get_mode(task_name: str, kwargs: dict) -> str | None:
+    """profiling mode of a task run, None if it is not profiled"""
+    profile = kwargs.get('profile')
+    if profile is True or (profile is None and task_name in config['profiling']['tasks']):
+        return config['profiling']['mode']
+    if profile in MODES:
+        return profile
+    if profile:
+        logger.warning(f'unknown profiling mode {profile}, expected one of {MODES}')
+    return None
+
+
+def artifact_path(task, task_id: str, dataset_id, mode: str) -> Path:
+    suffix = 'pstats' if mode == 'cprofile' else 'folded'
+    prefix = f'{dataset_id}-' if dataset_id is not None else ''
+    return Path(config['profiling']['dir']) / task.name / f'{prefix}{task_id}.{suffix}'
+
+
+_current: TaskProfile | None = None
+
+
+@task_prerun.connect
+def start_profiler(task_id=None, task=None, args=None, kwargs=None, **_):
+    global _current
+    try:
+        mode = get_mode(task.name, kwargs or {})
+        if mode is None:
+            return
+        path = artifact_path(task, task_id, dataset_id=args[0] if args else None, mode=mode)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # report the path of the artifact with every progress update of this run
+        update_progress = task.update_progress
+        task.update_progress = lambda progress_obj: update_progress({**progress_obj, 'profile': str(path)})
+        task.update_progress({})
+
+        _current = TaskProfile(mode=mode, path=path)
+        _current.start()
+        logger.info(f'profiling task {task.name} {task_id} ({mode}), writing the profile to {path}')
+    except Exception as e:
+        logger.warning(f'unable to start profiling task {task_id}', exc_info=e)
+
+
+@task_postrun.connect
+def stop_profiler(task_id=None, task=None, **_):
+    global _current
+    task_profile, _current = _current, None
+    if task_profile is None:
+        return
+    # restore the class' update_progress
+    task.__dict__.pop('update_progress', None)
+    try:
+        task_profile.stop()
+        logger.info(f'wrote the profile of task {task.name} {task_id} to {task_profile.path}')
+    except Exception as e:
+        logger.warning(f'unable to write the profile of task {task_id}', exc_info=e)
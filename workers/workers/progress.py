@@ -0,0 +1,144 @@
+"""
+Progress - coalesced progress updates of the tasks
+
+The progress of a task (celery_task.update_progress, called by sca_rhythm's Progress, track_progress_parallel, ...) is
+written to the result backend by update_state. A task that reports progress from several places, or for every item of
+a large iteration, writes much more often than the UI reads it.
+
+The tasks declared with base=ProgressTask send their progress updates to a ProgressSink, which writes at most one
+update per write_interval_seconds. An update received sooner is kept (replacing the previous pending one) and written
+by a timer when the interval is over, so the progress in the backend is never older than the interval.
+The pending update is flushed when the task body returns or raises, before celery stores the state of the task.
+
+The number of writes and of suppressed updates (received but replaced by a later update before being written) are
+added to the task's metric (workers.telemetry) and logged.
+
+This module is imported by the main worker process, so it must not import the task modules or their dependencies.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from typing import Callable
+
+from sca_rhythm import WorkflowTask
+
+import workers.telemetry as telemetry
+from workers.config import config
+
+logger = logging.getLogger(__name__)
+
+
+class ProgressSink:
+    def __init__(self, write: Callable[[dict], None], interval: float):
+        """
+        @param write: writes a progress update to the result backend
+        @param interval: min seconds between two writes
+        """
+        self.write = write
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending: dict | None = None
+        self.last_write: float | None = None
+        self.timer: threading.Timer | None = None
+        self.closed = False
+        self.num_writes = 0
+        self.num_suppressed = 0
+
+    def _write(self, progress_obj: dict) -> None:
+        # called with the lock held, so that the updates are written in order
+        self.pending = None
+        self.last_write = time.monotonic()
+        self.num_writes += 1
+        self.write(progress_obj)
+
+    def update(self, progress_obj: dict) -> None:
+        with self.lock:
+            if self.closed:
+                return
+            now = time.monotonic()
+            if self.last_write is None or now - self.last_write >= self.interval:
+                self._write(progress_obj)
+                return
+
+            if self.pending is not None:
+                self.num_suppressed += 1
+            self.pending = progress_obj
+            if self.timer is None:
+                self.timer = threading.Timer(self.last_write + self.interval - now, self.flush_pending)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush_pending(self) -> None:
+        """timer: write the pending update"""
+        with self.lock:
+            self.timer = None
+            if self.pending is None or self.closed:
+                return
+            try:
+                self._write(self.pending)
+            except Exception as e:
+                logger.warning('unable to write the progress of the task', exc_info=e)
+
+    def close(self) -> None:
+        """write the pending update. later updates are dropped"""
+        with self.lock:
+            self.closed = True
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.pending is not None:
+                self._write(self.pending)
+
+
+_current: ProgressSink | None = None
+
+
+def reset_after_fork() -> None:
+    # a child process forked by the task (ex: track_progress_parallel) has a copy of the sink
+    # without the timer thread, and maybe with the lock held by it
+    if _current is not None:
+        _current.lock = threading.Lock()
+        _current.timer = None
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+
+class ProgressTask(WorkflowTask):
+    """WorkflowTask whose progress updates are coalesced by a ProgressSink"""
+
+    def __call__(self, *args, **kwargs):
+        global _current
+        # the request is thread local: keep it for the writes of the timer thread
+        request = self.request
+
+        def write(progress_obj: dict) -> None:
+            # as WorkflowTask.update_progress
+            if not request.called_directly:
+                self.backend.store_result(request.id, progress_obj, 'STARTED', request=request)
+
+        _current = ProgressSink(write=write, interval=config['progress']['write_interval_seconds'])
+        try:
+            return super().__call__(*args, **kwargs)
+        finally:
+            sink, _current = _current, None
+            try:
+                sink.close()
+            except Exception as e:
+                logger.warning(f'unable to write the progress of task {request.id}', exc_info=e)
+            if sink.num_writes > 0:
+                logger.info(f'progress of task {request.id}: {sink.num_writes} writes, '
+                            f'{sink.num_suppressed} updates suppressed')
+            telemetry.add_fields({
+                'progress_writes': sink.num_writes,
+                'progress_updates_suppressed': sink.num_suppressed,
+            })
+
+    def update_progress(self, progress_obj):
+        sink = _current
+        if sink is None:
+            return super().update_progress(progress_obj)
+        sink.update(progress_obj)
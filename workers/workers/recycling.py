@@ -0,0 +1,77 @@
+"""
+Recycling of the worker's pool processes when the deployed code changes
+
+The pool processes run many tasks and keep the task modules that they imported (the task declarations import the
+task bodies lazily). The main worker process polls the version of the deployed code and when it changes, restarts
+the pool: each pool process exits after its current task and is replaced by a new process that imports the new code.
+Pool processes whose memory exceeds a limit are recycled by celery (worker_max_memory_per_child).
+
+The modules imported by the main worker process (celery_app, config, task declarations) are inherited by the pool
+processes and are not reloaded. Changes to them need a restart of the worker.
+This module is imported by the main worker process, so it must not import the task modules or their dependencies.
+"""
+from __future__ import annotations
+
+import hashlib
+import logging
+import subprocess
+import threading
+from pathlib import Path
+
+from celery.signals import worker_ready
+
+from workers.config import config
+
+logger = logging.getLogger(__name__)
+
+PACKAGE_DIR = Path(__file__).resolve().parent
+
+
+def get_code_version(source: str = None) -> str:
+    """
+    @param source: 'git' - SHA of the checked out commit,
+                   'files' - hash of the paths, sizes and modification times of the python files of the package
+                   default: config['worker']['code_version']
+    """
+    source = source or config['worker']['code_version']
+    if source == 'git':
+        p = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=PACKAGE_DIR, capture_output=True, text=True, check=True)
+        return p.stdout.strip()
+
+    h = hashlib.sha1()
+    for path in sorted(PACKAGE_DIR.rglob('*.py')):
+        st = path.stat()
+        h.update(f'{path.relative_to(PACKAGE_DIR)}:{st.st_size}:{st.st_mtime_ns}\n'.encode())
+    return h.hexdigest()
+
+
+class CodeVersionMonitor(threading.Thread):
+    def __init__(self, app, hostname: str, interval: float):
+        """Restarts the pool of the worker `hostname` when the version of the code changes"""
+        super().__init__(name='code-version-monitor', daemon=True)
+        self.app = app
+        self.hostname = hostname
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.version = get_code_version()
+
+    def run(self):
+        logger.info(f'code version: {self.version}')
+        while not self.stopped.wait(self.interval):
+            try:
+                version = get_code_version()
+                if version != self.version:
+                    logger.info(f'code version changed from {self.version} to {version}, restarting the pool')
+                    # processed by the worker's consumer, requires worker_pool_restarts
+                    self.app.control.pool_restart(destination=[self.hostname])
+                    self.version = version
+            except Exception as e:
+                logger.warning('unable to check the code version', exc_info=e)
+
+
+@worker_ready.connect
+def start_code_version_monitor(sender=None, **kwargs):
+    monitor = CodeVersionMonitor(app=sender.app,
+                                 hostname=sender.hostname,
+                                 interval=config['worker']['code_version_check_interval_seconds'])
+    monitor.start()
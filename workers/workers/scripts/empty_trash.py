@@ -0,0 +1,48 @@
+"""
+Removes trashed directory trees. Run by cron to empty the trash directories
+and by workers.trash.delete to remove a trashed tree in the background.
+"""
+import logging
+from pathlib import Path
+
+import fire
+
+from workers import trash
+from workers.config import config
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def empty_trash(*paths: str, max_workers: int = None, max_unlinks_per_second: float = None):
+    """
+    Remove the given trashed paths, or everything in the configured trash directories if no path is given.
+
+    @param paths: paths in the trash to remove
+    @param max_workers: number of threads. default: config['trash']['max_workers']
+    @param max_unlinks_per_second: throttle. default: config['trash']['max_unlinks_per_second']
+
+    example usage:
+
+    python -m workers.scripts.empty_trash --max_unlinks_per_second=1000
+    """
+    if len(paths) > 0:
+        trash_paths = [Path(p) for p in paths]
+    else:
+        trash_paths = [p for d in config['trash']['dirs'] if Path(d).is_dir() for p in Path(d).iterdir()]
+
+    for trash_path in trash_paths:
+        try:
+            if trash_path.is_symlink() or not trash_path.is_dir():
+                trash_path.unlink(missing_ok=True)
+            else:
+                trash.remove_tree(trash_path,
+                                  max_workers=max_workers,
+                                  max_unlinks_per_second=max_unlinks_per_second)
+            logger.info(f'removed {trash_path}')
+        except Exception as e:
+            logger.error(f'unable to remove {trash_path}', exc_info=e)
+
+
+if __name__ == '__main__':
+    fire.Fire(empty_trash)
@@ -0,0 +1,30 @@
+"""
+Loads the metadata of datasets from the metadata CSV (config['csv_path']) in one pass over its index.
+"""
+import logging
+
+import fire
+
+from workers.tasks.bc2_metadata import load_metadata as load
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def load_metadata(*dataset_ids: int):
+    """
+    Create the metadata of the given datasets.
+
+    @param dataset_ids: ids of the datasets
+
+    example usage:
+
+    python -m workers.scripts.load_metadata 12 13 14
+    """
+    missing = load(list(dataset_ids))
+    if missing:
+        logger.warning(f'no metadata found for datasets {missing}')
+
+
+if __name__ == '__main__':
+    fire.Fire(load_metadata)
@@ -95,7 +95,7 @@ def restart_process_dataset_upload_workflow(dataset_upload: dict) -> None:
         logger.info(f'No active workflows of type {PROCESS_DATASET_UPLOAD_WORKFLOW} found running '
                     f'for dataset {dataset_id}')
         logger.info(f'Starting workflow {PROCESS_DATASET_UPLOAD_WORKFLOW} for dataset {dataset_id}')
-        wf_body = wf_utils.get_wf_body(wf_name=PROCESS_DATASET_UPLOAD_WORKFLOW)
+        wf_body = wf_utils.get_wf_body(wf_name=PROCESS_DATASET_UPLOAD_WORKFLOW, dataset=dataset)
         wf = Workflow(celery_app=celery_app, **wf_body)
         wf_id = wf.workflow['_id']
         api.add_workflow_to_dataset(dataset_id=dataset_id, workflow_id=wf_id)
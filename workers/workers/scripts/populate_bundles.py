@@ -28,10 +28,11 @@ class BundleSyncManager:
 
 
     def populate_bundles(self):
-        archived_datasets = api.get_all_datasets(archived=True, bundle=True)
+        archived_datasets = api.iter_datasets(archived=True, bundle=True,
+                                              fields=['name', 'archive_path', 'bundle_size'])
 
-        processed_datasets = []
-        unprocessed_datasets = []
+        processed_datasets_ids = []
+        unprocessed_datasets_ids = []
 
         for dataset in archived_datasets:
             logger.info(f'processing dataset {dataset["id"]}')
@@ -53,13 +54,11 @@ class BundleSyncManager:
                     logger.info(err)
 
             if not bundle_metadata_populated:
-                unprocessed_datasets.append(dataset)
+                unprocessed_datasets_ids.append(dataset['id'])
             else:
-                processed_datasets.append(dataset)
+                processed_datasets_ids.append(dataset['id'])
 
-        unprocessed_datasets_ids = [dataset['id'] for dataset in unprocessed_datasets]
         logger.info(f'unprocessed datasets: {unprocessed_datasets_ids}')
-        processed_datasets_ids = [dataset['id'] for dataset in processed_datasets]
         logger.info(f'processed datasets: {processed_datasets_ids}')
 
 
@@ -1,21 +1,51 @@
 import logging
+import time
 from datetime import datetime, timedelta
 
 import fire
+import pymongo
 import workers.api as api
+import workers.utils as utils
+from celery import states
 from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
 from workers.config import config
 from workers.config.celeryconfig import result_backend
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+DUPLICATE_KEY_ERROR = 11000
+
 
 class WorkflowPurgeManager:
+    """
+    The result backend has a document per workflow (workflow_meta) and per task run (celery_taskmeta), which are
+    kept forever (result_expires = 0). The purge
+
+    - creates the indexes of its queries, if they are missing
+    - streams the workflows of the app with a cursor, reading only their id and the ids of their task runs, and
+      selects the orphaned ones: workflows that the API does not know about
+    - deletes their tasks and themselves in batches of batch_size documents, with a pause of throttle_seconds
+      between the batches so that the workers using the result backend are not slowed down
+    - handles the task meta of the successful tasks according to task_meta_mode:
+        None - kept
+        'archive' - moved to the archive collection task_meta_age_threshold seconds after they completed
+      Only the task meta that no workflow known to the API (or of another app) refers to are archived: the status
+      of a step whose task meta is missing is pending, and the API does not create a workflow for a dataset while
+      another one of the same name is not done. The task meta of failed tasks are kept, until their workflows are
+      purged.
+    """
     WORKFLOW_COLLECTION_NAME = 'workflow_meta'
     TASK_COLLECTION_NAME = 'celery_taskmeta'
+    TASK_META_MODES = [None, 'archive']
+
+    def __init__(self, app_id, workflow_types, age_threshold, max_purge_count, dry_run=False,
+                 batch_size=1000, throttle_seconds=0.0,
+                 task_meta_mode=None, task_meta_age_threshold=None, task_meta_archive_collection=None):
+        if task_meta_mode not in self.TASK_META_MODES:
+            raise ValueError(f'unknown task_meta_mode {task_meta_mode}, expected one of {self.TASK_META_MODES}')
 
-    def __init__(self, app_id, workflow_types, age_threshold, max_purge_count, dry_run=False):
         self.mongo_client = MongoClient(result_backend)
         self.celery_db = self.mongo_client.get_default_database()
         self.workflow_collection = self.celery_db[self.WORKFLOW_COLLECTION_NAME]
@@ -26,18 +56,49 @@ class WorkflowPurgeManager:
         self.age_threshold = age_threshold
         self.max_purges = max_purge_count
         self.dry_run = dry_run
+        self.batch_size = batch_size
+        self.throttle_seconds = throttle_seconds
+        self.task_meta_mode = task_meta_mode
+        self.task_meta_age_threshold = task_meta_age_threshold
+        self.task_meta_archive_collection = self.celery_db[task_meta_archive_collection] \
+            if task_meta_archive_collection else None
 
         logger.warning(f'app_id: {app_id}, '
                        f'workflow_types: {workflow_types}, '
                        f'age_threshold: {age_threshold}, '
-                       f'max_purges: {max_purge_count}')
+                       f'max_purges: {max_purge_count}, '
+                       f'batch_size: {batch_size}, '
+                       f'throttle_seconds: {throttle_seconds}, '
+                       f'task_meta_mode: {task_meta_mode}, '
+                       f'task_meta_age_threshold: {task_meta_age_threshold}')
+
+    def ensure_indexes(self):
+        """
+        Create the indexes of the purge queries. create_index does nothing if the index exists.
+        """
+        if self.dry_run:
+            logger.warning('dry run: not creating the indexes')
+            return
+        # orphaned workflows query
+        self.workflow_collection.create_index([
+            ('app_id', pymongo.ASCENDING),
+            ('name', pymongo.ASCENDING),
+            ('created_at', pymongo.ASCENDING),
+        ])
+        # completed tasks query (archive mode)
+        self.task_collection.create_index([
+            ('status', pymongo.ASCENDING),
+            ('date_done', pymongo.ASCENDING),
+        ])
 
     def purge(self):
         """
         Purge orphaned workflows and associated tasks from the result backend
         """
+        self.ensure_indexes()
+
         app_workflows = api.get_all_workflows()
-        app_workflow_ids = [wf['id'] for wf in app_workflows]
+        app_workflow_ids = {wf['id'] for wf in app_workflows}
 
         orphaned_wfs = self.get_orphaned_workflows(
             app_id=self.app_id,
@@ -46,17 +107,44 @@ class WorkflowPurgeManager:
             age_threshold_sec=self.age_threshold
         )
 
-        logger.warning(f'Found {len(orphaned_wfs)} orphaned workflows')
-
         # sanity check. If the API accidentally returns no workflows then do not blindly delete all the workflows in
-        # result backend
-        if len(orphaned_wfs) > self.max_purges:
+        # result backend: only the first max_purges orphaned workflows are purged, the others are counted
+        num_orphaned = 0
+        num_deleted_tasks = 0
+        num_deleted_wfs = 0
+        batch = []
+        for wf in orphaned_wfs:
+            num_orphaned += 1
+            if num_orphaned > self.max_purges:
+                continue
+            batch.append(wf)
+            if len(batch) == self.batch_size:
+                num_tasks, num_wfs = self.delete_workflows(batch)
+                num_deleted_tasks += num_tasks
+                num_deleted_wfs += num_wfs
+                batch = []
+                self.throttle()
+        if batch:
+            num_tasks, num_wfs = self.delete_workflows(batch)
+            num_deleted_tasks += num_tasks
+            num_deleted_wfs += num_wfs
+
+        logger.warning(f'Found {num_orphaned} orphaned workflows')
+        if num_orphaned > self.max_purges:
             logger.warning(
-                f"Number of orphaned workflows ({len(orphaned_wfs)}) to purge is more than {self.max_purges} (MAX_PURGES). "
-                f"Only the first {self.max_purges} will be purged")
+                f"Number of orphaned workflows ({num_orphaned}) to purge is more than {self.max_purges} (MAX_PURGES). "
+                f"Only the first {self.max_purges} were purged")
+        logger.warning(f'Deleted {num_deleted_tasks} tasks and {num_deleted_wfs} workflows')
+
+        self.purge_task_meta(current_wf_ids=app_workflow_ids)
 
-        wfs = orphaned_wfs[:self.max_purges]
+    def delete_workflows(self, wfs: list[dict]) -> tuple[int, int]:
+        """
+        Delete a batch of workflows and their tasks
 
+        @param wfs: workflows with their _id and the task ids of their steps
+        @return: number of deleted tasks, number of deleted workflows
+        """
         wf_ids = [wf['_id'] for wf in wfs]
 
         _task_ids = [task_run.get('task_id', None)
@@ -66,6 +154,7 @@ class WorkflowPurgeManager:
                      ]
         task_ids = [t for t in _task_ids if t is not None]
 
+        num_deleted_tasks = 0
         if len(task_ids):
             logger.warning(f'Deletes {len(task_ids)} tasks')
             if not self.dry_run:
@@ -74,60 +163,161 @@ class WorkflowPurgeManager:
                         '$in': task_ids
                     }
                 })
-                logger.warning(f'Deleted {res.deleted_count} tasks')
+                num_deleted_tasks = res.deleted_count
 
-        if len(wf_ids):
-            logger.warning(f'Deletes {len(wf_ids)} workflows')
-            if not self.dry_run:
-                res = self.workflow_collection.delete_many({
-                    '_id': {
-                        '$in': wf_ids
-                    }
-                })
-                logger.warning(f'Deleted {res.deleted_count} workflows')
+        logger.warning(f'Deletes {len(wf_ids)} workflows')
+        num_deleted_wfs = 0
+        if not self.dry_run:
+            res = self.workflow_collection.delete_many({
+                '_id': {
+                    '$in': wf_ids
+                }
+            })
+            num_deleted_wfs = res.deleted_count
+        return num_deleted_tasks, num_deleted_wfs
 
     def get_orphaned_workflows(
         self,
         app_id: str,
-        current_wf_ids: list[str],
+        current_wf_ids: set[str],
         workflows_types: list[str],
         age_threshold_sec: int
-    ) -> list[dict]:
+    ):
+        """
+        Stream the workflows of the app that are older than the threshold and are not current.
+
+        The current workflows are filtered out here rather than with a $nin over all their ids in the query, which
+        grows with the number of workflows of the app and cannot use the index.
+
+        @return: generator of {_id, steps: [{task_runs: [{task_id}]}]}
+        """
         threshold_date_utc = datetime.utcnow() - timedelta(seconds=age_threshold_sec)
-        cursor = self.workflow_collection.find({
-            'app_id': app_id,
-            'name': {
-                '$in': workflows_types
+        cursor = self.workflow_collection.find(
+            {
+                'app_id': app_id,
+                'name': {
+                    '$in': workflows_types
+                },
+                'created_at': {
+                    '$lte': threshold_date_utc
+                },
             },
-            'created_at': {
-                '$lte': threshold_date_utc
+            projection={'_id': 1, 'steps.task_runs.task_id': 1},
+            batch_size=self.batch_size,
+        )
+        with cursor:
+            for wf in cursor:
+                if wf['_id'] not in current_wf_ids:
+                    yield wf
+
+    def purge_task_meta(self, current_wf_ids: set[str]):
+        if self.dry_run:
+            if self.task_meta_mode is not None:
+                logger.warning(f'dry run: not applying the task meta mode {self.task_meta_mode}')
+            return
+        if self.task_meta_mode == 'archive':
+            self.archive_task_meta(self.get_referenced_task_ids(current_wf_ids))
+
+    def get_referenced_task_ids(self, current_wf_ids: set[str]) -> set[str]:
+        """
+        ids of the tasks of the workflows known to the API and of the workflows of the other apps
+        """
+        def task_ids(cursor):
+            with cursor:
+                for wf in cursor:
+                    for step in wf.get('steps', []):
+                        for task_run in step.get('task_runs', []):
+                            if task_run.get('task_id') is not None:
+                                yield task_run['task_id']
+
+        projection = {'_id': 1, 'steps.task_runs.task_id': 1}
+        referenced = set()
+        for wf_ids in utils.batched(list(current_wf_ids), n=self.batch_size):
+            referenced.update(task_ids(self.workflow_collection.find({'_id': {'$in': list(wf_ids)}},
+                                                                      projection=projection)))
+        referenced.update(task_ids(self.workflow_collection.find({'app_id': {'$ne': self.app_id}},
+                                                                  projection=projection,
+                                                                  batch_size=self.batch_size)))
+        return referenced
+
+    def archive_task_meta(self, referenced_task_ids: set[str]):
+        """
+        Move the task meta of the tasks that succeeded before the threshold, and that are not referenced, to the
+        archive collection, in batches.
+        The batches are inserted before they are deleted: the documents of a batch inserted by an interrupted run are
+        skipped.
+        """
+        threshold_date_utc = datetime.utcnow() - timedelta(seconds=self.task_meta_age_threshold)
+        cursor = self.task_collection.find(
+            {
+                'status': states.SUCCESS,
+                'date_done': {
+                    '$lte': threshold_date_utc
+                },
             },
-            '_id': {
-                '$nin': current_wf_ids
-            }
-        })
-        return list(cursor)
+            projection={'_id': 1},
+            batch_size=self.batch_size,
+        )
+        num_archived = 0
+        with cursor:
+            for ids in utils.batched((doc['_id'] for doc in cursor if doc['_id'] not in referenced_task_ids),
+                                     n=self.batch_size):
+                batch = list(self.task_collection.find({'_id': {'$in': list(ids)}}))
+                if not batch:
+                    continue
+                try:
+                    self.task_meta_archive_collection.insert_many(batch, ordered=False)
+                except BulkWriteError as e:
+                    if any(err['code'] != DUPLICATE_KEY_ERROR for err in e.details['writeErrors']):
+                        raise
+                res = self.task_collection.delete_many({
+                    '_id': {
+                        '$in': [doc['_id'] for doc in batch]
+                    }
+                })
+                num_archived += res.deleted_count
+                self.throttle()
+        logger.warning(f'Archived {num_archived} task meta to {self.task_meta_archive_collection.name}')
+
+    def throttle(self):
+        if self.throttle_seconds > 0:
+            time.sleep(self.throttle_seconds)
 
 
 def purge_stale_workflows(app_id: str = config['app_id'],
                           workflow_types: list[str] = config['workflow']['purge']['types'],
                           age_threshold: int = config['workflow']['purge']['age_threshold_seconds'],
                           max_purge_count: int = config['workflow']['purge']['max_purge_count'],
-                          dry_run=False):
+                          dry_run=False,
+                          batch_size: int = config['workflow']['purge']['batch_size'],
+                          throttle_seconds: float = config['workflow']['purge']['throttle_seconds'],
+                          task_meta_mode: str = config['workflow']['purge']['task_meta']['mode'],
+                          task_meta_age_threshold: int = config['workflow']['purge']['task_meta'][
+                              'age_threshold_seconds']):
     """
     Purge orphaned workflows and associated tasks from the result backend.
-    
+
     @param app_id: app_id to purge workflows for
     @param workflow_types: list of workflow types to purge
     @param age_threshold: purge workflows older than this threshold (in seconds)
     @param max_purge_count: max number of workflows to purge
     @param dry_run: if True, do not delete workflows
+    @param batch_size: max number of workflows or task meta deleted by a query
+    @param throttle_seconds: pause between two batches
+    @param task_meta_mode: None | 'archive' - what happens to the task meta of the successful tasks
+    @param task_meta_age_threshold: age (in seconds since they completed) of the task meta archived
+
+    example usage:
 
-    example usage: 
-    
     python -m workers.scripts.purge_stale_workflows --app_id='bioloop-dev.sca.iu.edu' --workflow_types='["stage", "integrated"]' --age_threshold=86400 --max_purge_count=10 --dry_run
     """
-    WorkflowPurgeManager(app_id, workflow_types, age_threshold, max_purge_count, dry_run).purge()
+    WorkflowPurgeManager(app_id, workflow_types, age_threshold, max_purge_count, dry_run,
+                         batch_size=batch_size,
+                         throttle_seconds=throttle_seconds,
+                         task_meta_mode=task_meta_mode,
+                         task_meta_age_threshold=task_meta_age_threshold,
+                         task_meta_archive_collection=config['workflow']['purge']['task_meta'][
+                             'archive_collection']).purge()
 
 
 if __name__ == "__main__":
@@ -1,11 +1,6 @@
 import argparse
 
-from celery import Celery
-
-from workers.config import celeryconfig
-
-app = Celery("tasks")
-app.config_from_object(celeryconfig)
+from workers.celery_app import app
 
 
 def revoke_active_tasks(hostname: str) -> None:
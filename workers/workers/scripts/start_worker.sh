@@ -7,5 +7,5 @@ python -m celery \
   --pidfile celery_worker.pid \
   --hostname 'bioloop-celery-w1@%h' \
   --autoscale 8,3 \
-  --queues 'bioloop-dev.sca.iu.edu.q' 
+  --queues 'bioloop-dev.sca.iu.edu.q,bioloop-dev.sca.iu.edu.io.small.q,bioloop-dev.sca.iu.edu.io.large.q,bioloop-dev.sca.iu.edu.cpu.small.q,bioloop-dev.sca.iu.edu.cpu.large.q' 
   # --detach
@@ -1,5 +1,9 @@
+import datetime
 import fnmatch
+import json
 import logging
+import os
+import re
 import time
 from pathlib import Path
 from typing import Callable
@@ -8,6 +12,7 @@ from sca_rhythm import Workflow
 from slugify import slugify
 
 import workers.api as api
+import workers.utils as utils
 import workers.workflow_utils as wf_utils
 from workers.celery_app import app as celery_app
 from workers.config import config
@@ -34,8 +39,9 @@ class Observer:
         added_directories = current_directories - self.directories
         deleted_directories = self.directories - current_directories
 
-        if len(added_directories) > 0:
-            self.callback('add', [self.dir_path / name for name in added_directories])
+        # the add callback is called at every poll, even without new directories,
+        # so that it can retry the directories it failed to process
+        self.callback('add', [self.dir_path / name for name in added_directories])
         if len(deleted_directories) > 0:
             self.callback('delete', [self.dir_path / name for name in deleted_directories])
 
@@ -82,64 +88,221 @@ def slugify_(name: str) -> str:
     return slugify(name, lowercase=False, regex_pattern=r'[^a-zA-Z0-9_]')
 
 
+def compile_patterns(patterns) -> re.Pattern | None:
+    """
+    Combine shell-style patterns (fnmatch) into a single compiled regex.
+    Returns None if there are no patterns.
+    """
+    patterns = list(patterns)
+    if len(patterns) == 0:
+        return None
+    return re.compile('|'.join(fnmatch.translate(pat) for pat in patterns))
+
+
+class DatasetNameIndex:
+    """
+    Persisted index of registered dataset names of a type - {dataset id: name}
+
+    The index is refreshed incrementally from the API using the datasets' updated_at as a cursor,
+    so that restarting the watcher does not re-fetch every dataset that was ever registered.
+    """
+    DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+    # re-fetch the datasets updated slightly before the cursor to not miss the updates
+    # that were committed while the previous refresh was running
+    CURSOR_OVERLAP = datetime.timedelta(minutes=5)
+
+    def __init__(self, dataset_type: str, index_dir: str):
+        self.dataset_type = dataset_type
+        self.index_path = Path(index_dir) / f'{dataset_type}.json'
+        self.cursor: datetime.datetime | None = None
+        self.datasets: dict[str, str] = {}
+        self.load()
+
+    def load(self) -> None:
+        if not self.index_path.exists():
+            return
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+            self.cursor = datetime.datetime.strptime(index['cursor'], self.DATE_FORMAT) if index['cursor'] else None
+            self.datasets = dict(index['datasets'])
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f'unable to read dataset name index {self.index_path}, rebuilding it', exc_info=e)
+            self.cursor = None
+            self.datasets = {}
+
+    def save(self) -> None:
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        index = {
+            'cursor': self.cursor.strftime(self.DATE_FORMAT) if self.cursor else None,
+            'datasets': self.datasets
+        }
+        # write to a temp file and rename, so that a crash does not leave a partially written index
+        tmp_path = self.index_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def refresh(self) -> None:
+        """
+        Fetch the datasets updated since the cursor (all datasets if the index is empty)
+        and remove the datasets that were deleted since.
+        """
+        filters = {'dataset_type': self.dataset_type, 'fields': ['name', 'updated_at']}
+        if self.cursor is None:
+            updated = api.iter_datasets(**filters)
+            deleted = []
+        else:
+            updated_at_range = {
+                'updated_at_start': (self.cursor - self.CURSOR_OVERLAP).strftime(self.DATE_FORMAT),
+                'updated_at_end': datetime.datetime.utcnow().strftime(self.DATE_FORMAT),
+            }
+            updated = api.iter_datasets(**filters, **updated_at_range)
+            deleted = api.iter_datasets(**filters, **updated_at_range, deleted=True)
+
+        # the datasets are streamed page by page, track the counts and the cursor as they arrive
+        cursor = self.cursor
+        n_updated = n_deleted = 0
+        for dataset in updated:
+            self.datasets[str(dataset['id'])] = dataset['name']
+            cursor = max(filter(None, [cursor, dataset['updated_at']]), default=None)
+            n_updated += 1
+        for dataset in deleted:
+            self.datasets.pop(str(dataset['id']), None)
+            cursor = max(filter(None, [cursor, dataset['updated_at']]), default=None)
+            n_deleted += 1
+        self.cursor = cursor
+
+        logger.info(f'{self.dataset_type} name index: fetched {n_updated} updated and {n_deleted} deleted '
+                    f'datasets, {len(self.datasets)} datasets are registered')
+        self.save()
+
+    def add(self, *datasets: dict) -> None:
+        for dataset in datasets:
+            self.datasets[str(dataset['id'])] = dataset['name']
+        self.save()
+
+    def names(self) -> set[str]:
+        return set(self.datasets.values())
+
+
 class Register:
+    # max number of datasets registered in one API call
+    BATCH_SIZE = 100
+
     def __init__(self, dataset_type, default_wf_name='integrated'):
         self.dataset_type = dataset_type
         self.reg_config = config['registration'][self.dataset_type]
-        self.rejects: set[str] = set(self.reg_config['rejects'])
-        self.completed: set[str] = set(self.get_registered_dataset_names())  # HTTP GET
+        self.rejects: re.Pattern | None = compile_patterns(self.reg_config['rejects'])
+        self.name_index = DatasetNameIndex(dataset_type, config['registration']['name_index_dir'])
+        self.completed: set[str] = self.get_registered_dataset_names()  # HTTP GET
+        # candidates that failed to be registered, retried at every poll: {dataset name: directory}
+        self.pending: dict[str, Path] = {}
         self.default_wf_name = default_wf_name
 
     def is_a_reject(self, name):
-        return any([fnmatch.fnmatchcase(name, pat) for pat in self.rejects])
+        return self.rejects is not None and self.rejects.match(name) is not None
 
-    def get_registered_dataset_names(self):
-        datasets = api.get_all_datasets(dataset_type=self.dataset_type)
-        return [b['name'] for b in datasets]
+    def get_registered_dataset_names(self) -> set[str]:
+        self.name_index.refresh()
+        return self.name_index.names()
 
     def register(self, event: str, new_dirs: list[Path]) -> None:
         if event != 'add':
             return
 
+        # the directories are not reported as added again, the failed ones are retried from pending
+        dirs = {slugify_(p.name): p for p in [*self.pending.values(), *new_dirs] if p.is_dir()}
+        self.pending = {}
         candidates: list[Path] = [
-            p for p in new_dirs
+            p for name, p in dirs.items()
             if all([
-                slugify_(p.name) not in self.completed,
-                not self.is_a_reject(slugify_(p.name)),
+                name not in self.completed,
+                not self.is_a_reject(name),
                 # cmd.total_size(p) >= config['registration']['minimum_dataset_size']
             ])
         ]
 
+        for batch in utils.batched(candidates, n=self.BATCH_SIZE):
+            try:
+                self.register_candidates(batch)
+            except Exception as e:
+                logger.error(f'unable to register {len(batch)} {self.dataset_type} datasets', exc_info=e)
+                self.pending.update((slugify_(p.name), p) for p in batch)
+
+    def register_candidates(self, candidates: list[Path]) -> None:
+        """
+        Register the candidates with one API call and start a workflow on each created dataset.
+        A failure to register or to start the workflow of a candidate does not affect the others.
+        The candidates that could not be registered are added to pending.
+        """
+        logger.info(f'registering {len(candidates)} {self.dataset_type} datasets - '
+                    f'{", ".join(c.name for c in candidates)}')
+
+        # workflows are created first so that the API associates them with the datasets on creation
+        # workflows of the datasets that fail to be created are orphaned and purged by purge_stale_workflows
+        # a candidate whose workflow cannot be created is not registered: it is retried at the next poll
+        workflows: dict[str, Workflow | None] = {}
         for candidate in candidates:
-            self.register_candidate(candidate)
-            self.completed.add(candidate.name)
-
-    def register_candidate(self, candidate: Path):
-        logger.info(f'registering {self.dataset_type} dataset - {candidate.name}')
-        dataset_payload = {
-            'data': {
-                'name': slugify_(candidate.name),
-                'type': self.dataset_type,
-                'origin_path': str(candidate.resolve()),
-            }
-        }
-        created_dataset = api.create_dataset(dataset_payload)
-        self.run_workflows(created_dataset)
+            name = slugify_(candidate.name)
+            try:
+                workflows[name] = self.create_workflow()
+            except Exception as e:
+                logger.error(f'unable to create the workflow of {self.dataset_type} dataset - {name}', exc_info=e)
+                self.pending[name] = candidate
+        candidates = [c for c in candidates if slugify_(c.name) in workflows]
+        if len(candidates) == 0:
+            return
 
-    def run_workflows(self, dataset):
-        dataset_id = dataset['id']
+        dataset_payloads = [
+            {
+                'data': {
+                    'name': slugify_(candidate.name),
+                    'type': self.dataset_type,
+                    'origin_path': str(candidate.resolve()),
+                },
+                'workflow_id': self.workflow_id(workflows[slugify_(candidate.name)]),
+            }
+            for candidate in candidates
+        ]
+        res = api.create_datasets(dataset_payloads)
+        created_datasets, errors = res['datasets'], res['errors']
+
+        candidates_by_name = {slugify_(c.name): c for c in candidates}
+        for error in errors:
+            logger.error(f'unable to register {self.dataset_type} dataset - {error["name"]}: {error["error"]}')
+            if error['name'] in candidates_by_name:
+                self.pending[error['name']] = candidates_by_name[error['name']]
+
+        self.name_index.add(*created_datasets)
+        for dataset in created_datasets:
+            self.completed.add(dataset['name'])
+            wf = workflows.get(dataset['name'])
+            if wf is not None:
+                try:
+                    wf.start(dataset['id'])
+                except Exception as e:
+                    logger.error(f'unable to start workflow {wf.workflow["_id"]} of dataset {dataset["id"]}',
+                                 exc_info=e)
+
+        logger.info(f'registered {len(created_datasets)} of {len(candidates)} {self.dataset_type} datasets')
+
+    def create_workflow(self) -> Workflow | None:
         wf_body = wf_utils.get_wf_body(wf_name=self.default_wf_name)
-        wf = Workflow(celery_app=celery_app, **wf_body)
-        api.add_workflow_to_dataset(dataset_id=dataset_id, workflow_id=wf.workflow['_id'])
-        wf.start(dataset_id)
+        return Workflow(celery_app=celery_app, **wf_body)
+
+    @staticmethod
+    def workflow_id(wf: Workflow | None) -> str | None:
+        return wf.workflow['_id'] if wf is not None else None
 
 
 class RegisterDataProduct(Register):
     def __init__(self):
         super().__init__(dataset_type='DATA_PRODUCT')
 
-    def run_workflows(self, dataset):
-        pass
+    def create_workflow(self) -> Workflow | None:
+        return None
 
 
 if __name__ == "__main__":
@@ -0,0 +1,180 @@
+"""
+Staging cache - keeps the staging areas below a high water mark
+
+Staged datasets (extracted directory trees) and their bundles are copies of the archived data and can be staged again.
+When the usage of a filesystem that has a staging area goes above the high water mark, the least recently used
+staged datasets (latest of last staged and last downloaded) are evicted until the usage is below the low water mark.
+
+Datasets that were downloaded recently are pinned and are never evicted.
+"""
+from __future__ import annotations
+
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import workers.api as api
+from workers import trash
+from workers.config import config
+from workers.dataset import get_bundle_staged_path
+
+logger = logging.getLogger(__name__)
+
+
+def existing_ancestor(path: Path | str) -> Path:
+    """path, or its nearest ancestor that exists"""
+    path = Path(path).resolve()
+    while not path.exists():
+        path = path.parent
+    return path
+
+
+class FilesystemUsage:
+    def __init__(self, path: Path):
+        st = os.statvfs(path)
+        self.total = st.f_blocks * st.f_frsize
+        self.used = (st.f_blocks - st.f_bfree) * st.f_frsize
+        self.free = st.f_bavail * st.f_frsize
+
+
+def last_used(dataset: dict) -> datetime:
+    times = [t for t in (dataset.get('last_accessed_at'), dataset.get('last_staged_at')) if t is not None]
+    return max(times, default=datetime.min)
+
+
+def evict_dataset(dataset: dict, background: bool = True) -> None:
+    """delete the staged directory and the staged bundle of a dataset and mark it as not staged"""
+    if dataset.get('staged_path'):
+        trash.delete(dataset['staged_path'], background=background)
+    if dataset.get('bundle'):
+        Path(get_bundle_staged_path(dataset=dataset)).unlink(missing_ok=True)
+
+    update_data = {
+        'is_staged': False,
+        'staged_path': None
+    }
+    api.apply_dataset_changes(dataset_id=dataset['id'], update=update_data, state='PURGED')
+
+    logger.info(f'evicted staged dataset id:{dataset["id"]} name:{dataset["name"]} '
+                f'staged_path:{dataset.get("staged_path")}')
+
+
+class StagingCache:
+    def __init__(self):
+        cache_config = config['stage']['cache']
+        self.high_water_mark = cache_config['high_water_mark']
+        self.low_water_mark = cache_config['low_water_mark']
+        self.pin_hours = cache_config['pin_hours']
+        self.max_evictions = cache_config['max_evictions']
+
+        # filesystem (st_dev) of the staging directory and the bundle staging directory of each dataset type
+        self.stage_devices: dict[str, int] = {}
+        self.bundle_devices: dict[str, int] = {}
+        # an existing path on each of these filesystems to measure its usage
+        self.filesystems: dict[int, Path] = {}
+
+        for dataset_type, paths in config['paths'].items():
+            if not isinstance(paths, dict) or 'stage' not in paths:
+                continue
+            self.stage_devices[dataset_type] = self.add_filesystem(paths['stage'])
+            self.bundle_devices[dataset_type] = self.add_filesystem(paths['bundle']['stage'])
+
+    def add_filesystem(self, path: str) -> int:
+        path = existing_ancestor(path)
+        device = path.stat().st_dev
+        self.filesystems.setdefault(device, path)
+        return device
+
+    def dataset_bytes(self, dataset: dict) -> dict[int, int]:
+        """bytes used by the staged copy of a dataset and its bundle on each filesystem"""
+        usage = defaultdict(int)
+        usage[self.stage_devices[dataset['type']]] += dataset.get('du_size') or 0
+        if dataset.get('bundle'):
+            usage[self.bundle_devices[dataset['type']]] += int(dataset['bundle'].get('size') or 0)
+        return usage
+
+    def bytes_to_free(self, required: dict[int, int]) -> dict[int, int]:
+        """
+        bytes to free on each filesystem so that the usage, including the required bytes, goes below the low
+        water mark. Nothing needs to be freed on filesystems where it stays below the high water mark.
+        """
+        to_free = {}
+        for device, path in self.filesystems.items():
+            usage = FilesystemUsage(path)
+            used = usage.used + required.get(device, 0)
+            if used > self.high_water_mark * usage.total:
+                to_free[device] = int(used - self.low_water_mark * usage.total)
+        return to_free
+
+    def is_pinned(self, dataset: dict) -> bool:
+        """datasets that were downloaded recently may still be being downloaded"""
+        last_accessed_at = dataset.get('last_accessed_at')
+        return last_accessed_at is not None and \
+            datetime.utcnow() - last_accessed_at < timedelta(hours=self.pin_hours)
+
+    def evict(self,
+              required: dict[int, int] = None,
+              exclude_ids: list[str] = (),
+              background: bool = True) -> list[dict]:
+        """
+        Evict the least recently used staged datasets until the usage of every filesystem of the staging areas,
+        including the required bytes, is below the low water mark.
+
+        @param required: bytes that are about to be written to each filesystem
+        @param exclude_ids: ids of datasets that must not be evicted
+        @param background: delete the evicted directories in a background process
+        @return: evicted datasets
+        """
+        to_free = self.bytes_to_free(required or {})
+        if not to_free:
+            return []
+        logger.info(f'staging areas are above the high water mark, bytes to free: {to_free}')
+
+        datasets = api.iter_datasets(staged=True, bundle=True, include_access_times=True,
+                                     fields=['name', 'type', 'du_size', 'staged_path'])
+        candidates = sorted(
+            (d for d in datasets if d['id'] not in exclude_ids and not self.is_pinned(d)),
+            key=last_used
+        )
+
+        evicted = []
+        for dataset in candidates:
+            if all(n <= 0 for n in to_free.values()):
+                break
+            if len(evicted) >= self.max_evictions:
+                logger.warning(f'evicted {self.max_evictions} (max_evictions) staged datasets, stopping')
+                break
+
+            dataset_bytes = self.dataset_bytes(dataset)
+            if not any(to_free.get(device, 0) > 0 and n > 0 for device, n in dataset_bytes.items()):
+                # does not free space on the filesystems that are short of space
+                continue
+
+            try:
+                evict_dataset(dataset, background=background)
+            except Exception as e:
+                logger.error(f'Error evicting staged dataset #{dataset["id"]} {dataset["name"]}', exc_info=e)
+                continue
+
+            for device, n in dataset_bytes.items():
+                if device in to_free:
+                    to_free[device] -= n
+            evicted.append(dataset)
+
+        short = {device: n for device, n in to_free.items() if n > 0}
+        if short:
+            logger.warning(f'unable to free enough space in the staging areas, bytes short: {short}')
+        return evicted
+
+    def make_room(self, dataset: dict) -> bool:
+        """
+        Evict staged datasets, if needed, to make room for staging the dataset and its bundle.
+        The evicted datasets are deleted in the foreground so that the space is free when this function returns.
+
+        @return: whether there is enough free space to stage the dataset
+        """
+        required = self.dataset_bytes(dataset)
+        self.evict(required=required, exclude_ids=[dataset['id']], background=False)
+        return all(FilesystemUsage(self.filesystems[device]).free >= n for device, n in required.items())
@@ -0,0 +1,187 @@
+"""
+Tar reader - extracts a tar with a pool of writer threads
+
+The tar is read sequentially, from a file or a stream (ex: the output of a decompressor). The content of each
+regular file is handed to a pool of threads that create and write the files, so that the latency of creating, writing
+and closing many files on a parallel filesystem overlaps. The bytes read but not written yet are bounded by
+max_inflight_bytes. Files larger than a quarter of that are written by the reader itself, streamed with large
+buffers, as are sparse files (their zero blocks are written as holes).
+
+Directories are created as they are read. Hard links are created once all the files are written. The modes and the
+modification times of the files and directories are applied in a final pass, deepest directories first, so that
+writing into a directory does not change its restored mtime and read-only directories are filled before they are
+made read-only. Ownership is not restored, as by tarfile when not run as root.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import tarfile
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, Callable
+
+logger = logging.getLogger(__name__)
+
+SPARSE_BLOCK_SIZE = 64 * 1024
+
+
+class InflightBytes:
+    def __init__(self, limit: int):
+        """bytes read from the tar that are not written yet, shared by the reader and the writer threads"""
+        self.limit = limit
+        self.n = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, n: int) -> None:
+        """blocks until n bytes fit under the limit (a member larger than the limit waits for all the others)"""
+        with self.cond:
+            self.cond.wait_for(lambda: self.n == 0 or self.n + n <= self.limit)
+            self.n += n
+
+    def release(self, n: int) -> None:
+        with self.cond:
+            self.n -= n
+            self.cond.notify_all()
+
+
+def member_path(dest_dir: Path, name: str) -> Path:
+    """path of a member under dest_dir. members outside dest_dir (absolute paths, ..) are rejected"""
+    normalized = os.path.normpath(name)
+    if os.path.isabs(normalized) or normalized == '..' or normalized.startswith('../'):
+        raise tarfile.OutsideDestinationError(tarfile.TarInfo(name), str(dest_dir / normalized))
+    return dest_dir / normalized
+
+
+def write_file(path: Path, data: bytes) -> None:
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def copy_member(tar: tarfile.TarFile, member: tarfile.TarInfo, path: Path, buffer_size: int) -> None:
+    """
+    stream the content of a member to path.
+    the tar is a stream that cannot seek: the holes of sparse members are read as zeros and skipped in path
+    """
+    src = tar.extractfile(member)
+    zeros = None
+    if member.sparse is not None:
+        # holes are detected at this granularity
+        buffer_size = SPARSE_BLOCK_SIZE
+        zeros = bytes(buffer_size)
+    with open(path, 'wb') as dst:
+        remaining = member.size
+        while remaining > 0:
+            chunk = src.read(min(remaining, buffer_size))
+            if not chunk:
+                raise tarfile.ReadError(f'unexpected end of data in {member.name}')
+            if zeros is not None and chunk == zeros[:len(chunk)]:
+                dst.seek(len(chunk), os.SEEK_CUR)
+            else:
+                dst.write(chunk)
+            remaining -= len(chunk)
+        # a sparse file may end with a hole
+        dst.truncate(member.size)
+
+
+def apply_attributes(path: Path, member: tarfile.TarInfo) -> None:
+    os.chmod(path, member.mode)
+    os.utime(path, (member.mtime, member.mtime))
+
+
+def extract_tar(tar: Path | str | BinaryIO,
+                dest_dir: Path | str,
+                max_workers: int = 8,
+                max_inflight_bytes: int = 256 * 1024 * 1024,
+                buffer_size: int = 4 * 1024 * 1024,
+                before_attributes: Callable[[str], None] | None = None) -> str:
+    """
+    Extract the tar into dest_dir (which must exist).
+
+    @param tar: path of the tar or a file object to read the tar from (it does not need to be seekable)
+    @param max_workers: number of threads that write the files
+    @param max_inflight_bytes: max bytes read from the tar and not written yet
+    @param buffer_size: read buffer of the tar and of the streamed files
+    @param before_attributes: called with the common prefix of the member names once the files are written,
+                              before the final pass. ex: to add files to the extracted directories
+    @return: the common prefix of the member names (the top level directory of the archive)
+    """
+    dest_dir = Path(dest_dir)
+    inflight = InflightBytes(max_inflight_bytes)
+    errors = []
+    prefix = None
+    # metadata applied in the final pass
+    files: list[tuple[Path, tarfile.TarInfo]] = []
+    directories: list[tuple[Path, tarfile.TarInfo]] = []
+    hard_links: list[tuple[Path, tarfile.TarInfo]] = []
+    # directories known to exist, to not call mkdir for every file
+    created_dirs = set()
+
+    def write(path: Path, data: bytes, size: int) -> None:
+        try:
+            write_file(path, data)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            inflight.release(size)
+
+    is_path = isinstance(tar, (str, Path))
+    with (open(tar, 'rb', buffering=buffer_size) if is_path else nullcontext(tar)) as f, \
+            tarfile.open(fileobj=f, mode='r:' if f.seekable() else 'r|') as archive, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for member in archive:
+            if errors:
+                break
+            prefix = member.name if prefix is None else os.path.commonprefix([prefix, member.name])
+            path = member_path(dest_dir, member.name)
+
+            if member.isdir():
+                path.mkdir(parents=True, exist_ok=True)
+                created_dirs.add(path)
+                directories.append((path, member))
+                continue
+
+            if path.parent not in created_dirs:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                created_dirs.add(path.parent)
+            if member.isreg():
+                files.append((path, member))
+                if member.sparse is None and member.size <= max_inflight_bytes // 4:
+                    inflight.acquire(member.size)
+                    try:
+                        data = archive.extractfile(member).read()
+                    except Exception:
+                        inflight.release(member.size)
+                        raise
+                    executor.submit(write, path, data, member.size)
+                else:
+                    copy_member(archive, member, path, buffer_size)
+            elif member.issym():
+                if path.is_symlink() or path.exists():
+                    path.unlink()
+                os.symlink(member.linkname, path)
+            elif member.islnk():
+                hard_links.append((path, member))
+            else:
+                # fifos and devices
+                archive.extract(member, path=dest_dir, set_attrs=False)
+                files.append((path, member))
+
+    if errors:
+        raise errors[0]
+
+    # final pass: hard links to the written files, then the metadata
+    for path, member in hard_links:
+        path.unlink(missing_ok=True)
+        os.link(member_path(dest_dir, member.linkname), path)
+    if before_attributes is not None:
+        before_attributes(prefix or '')
+    for path, member in files:
+        apply_attributes(path, member)
+    for path, member in sorted(directories, key=lambda d: len(d[0].parts), reverse=True):
+        apply_attributes(path, member)
+
+    return prefix or ''
+
@@ -0,0 +1,320 @@
+"""
+Tar writer - creates the tar of a directory tree, reading the files in parallel
+
+The files of a dataset are read by a pool of threads ahead of the writer (up to prefetch_files entries), so that the
+latency of opening and reading many small files overlaps and the archive is written sequentially at the speed of
+the disk. Small files are read whole by the pool; larger files are streamed by the writer with large buffers.
+
+The md5 of each regular file is computed from the bytes read to write it.
+
+Sparse files (holes detected with SEEK_DATA / SEEK_HOLE) are written as GNU sparse 1.0 PAX entries, which GNU tar
+and python's tarfile extract as sparse files. Member names are the same as the ones of `tar cf - -C source_dir .`
+('.', './dir', './dir/file').
+"""
+from __future__ import annotations
+
+import errno
+import grp
+import hashlib
+import logging
+import os
+import pwd
+import stat
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+BLOCKSIZE = tarfile.BLOCKSIZE
+RECORDSIZE = tarfile.RECORDSIZE
+NUL = tarfile.NUL
+
+
+class FileChanged(Exception):
+    pass
+
+
+class Member:
+    __slots__ = ('path', 'arcname', 'st', 'linkname', 'data', 'md5', 'segments')
+
+    def __init__(self, path: str, arcname: str, st: os.stat_result):
+        self.path = path
+        self.arcname = arcname
+        self.st = st
+        self.linkname: str | None = None
+        # whole content of a small file, read by the pool
+        self.data: bytes | None = None
+        self.md5: str | None = None
+        # data segments [(offset, length)] of a sparse file
+        self.segments: list[tuple[int, int]] | None = None
+
+
+@lru_cache(maxsize=None)
+def uname(uid: int) -> str:
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return ''
+
+
+@lru_cache(maxsize=None)
+def gname(gid: int) -> str:
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return ''
+
+
+def data_segments(path: str, size: int) -> list[tuple[int, int]] | None:
+    """
+    data segments (offset, length) of a file that has holes,
+    None if it has no holes or the filesystem cannot report them
+    """
+    segments = []
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:  # no data after offset
+                    break
+                if e.errno == errno.EINVAL:  # not supported
+                    return None
+                raise
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            segments.append((start, end - start))
+            offset = end
+    finally:
+        os.close(fd)
+    if segments == [(0, size)]:
+        return None
+    return segments
+
+
+def load_member(path: str, arcname: str, small_file_size: int) -> Member:
+    """runs on the pool: stat the entry and read the content of small files"""
+    st = os.lstat(path)
+    m = Member(path, arcname, st)
+    if stat.S_ISLNK(st.st_mode):
+        m.linkname = os.readlink(path)
+    elif stat.S_ISREG(st.st_mode) and st.st_size > 0:
+        # a file that occupies fewer blocks than its size may have holes
+        if st.st_blocks * 512 < st.st_size:
+            m.segments = data_segments(path, st.st_size)
+        if m.segments is None and st.st_size <= small_file_size:
+            with open(path, 'rb') as f:
+                m.data = f.read()
+            m.md5 = hashlib.md5(m.data).hexdigest()
+    return m
+
+
+def iter_entries(source_dir: Path, exclude: set[str]):
+    """
+    (path, arcname) of source_dir and everything under it, parents before their contents
+    @param exclude: paths relative to source_dir of files that are skipped
+    """
+    yield str(source_dir), '.'
+    for dir_path, dir_names, file_names in os.walk(source_dir):
+        dir_names.sort()
+        rel_dir = os.path.relpath(dir_path, source_dir)
+        prefix = '.' if rel_dir == '.' else f'./{rel_dir}'
+        for name in sorted(dir_names + file_names):
+            arcname = f'{prefix}/{name}'
+            if arcname[2:] not in exclude:
+                yield os.path.join(dir_path, name), arcname
+
+
+def make_tarinfo(m: Member) -> tarfile.TarInfo | None:
+    st = m.st
+    ti = tarfile.TarInfo(m.arcname)
+    ti.mode = stat.S_IMODE(st.st_mode)
+    ti.uid, ti.gid = st.st_uid, st.st_gid
+    ti.uname, ti.gname = uname(st.st_uid), gname(st.st_gid)
+    # whole seconds, like GNU tar. fractional mtimes would add a PAX header to every member
+    ti.mtime = int(st.st_mtime)
+    if stat.S_ISREG(st.st_mode):
+        ti.type = tarfile.REGTYPE
+        ti.size = st.st_size
+    elif stat.S_ISDIR(st.st_mode):
+        ti.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(st.st_mode):
+        ti.type = tarfile.SYMTYPE
+        ti.linkname = m.linkname
+    elif stat.S_ISFIFO(st.st_mode):
+        ti.type = tarfile.FIFOTYPE
+    elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+        ti.type = tarfile.CHRTYPE if stat.S_ISCHR(st.st_mode) else tarfile.BLKTYPE
+        ti.devmajor, ti.devminor = os.major(st.st_rdev), os.minor(st.st_rdev)
+    else:
+        # sockets, ignored by tar as well
+        return None
+    return ti
+
+
+class TarWriter:
+    def __init__(self, fileobj, buffer_size: int):
+        """writes the members to fileobj without keeping them in memory (unlike tarfile.TarFile)"""
+        self.fileobj = fileobj
+        self.buffer_size = buffer_size
+        self.offset = 0
+        # (st_dev, st_ino) -> arcname of the first link of files with multiple hard links
+        self.inodes: dict[tuple[int, int], str] = {}
+        # relative path -> md5 of the regular files
+        self.checksums: dict[str, str] = {}
+        self.zeros = bytes(buffer_size)
+
+    def write(self, b: bytes) -> None:
+        self.fileobj.write(b)
+        self.offset += len(b)
+
+    def write_header(self, ti: tarfile.TarInfo) -> None:
+        self.write(ti.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape'))
+
+    def pad(self, size: int) -> None:
+        remainder = size % BLOCKSIZE
+        if remainder:
+            self.write(NUL * (BLOCKSIZE - remainder))
+
+    def hash_zeros(self, m, n: int) -> None:
+        while n > 0:
+            k = min(n, len(self.zeros))
+            m.update(memoryview(self.zeros)[:k])
+            n -= k
+
+    def copy(self, f, n: int, m, path: str) -> None:
+        """copy exactly n bytes of f to the archive"""
+        while n > 0:
+            chunk = f.read(min(n, self.buffer_size))
+            if not chunk:
+                raise FileChanged(f'{path} shrank while it was archived')
+            self.write(chunk)
+            m.update(chunk)
+            n -= len(chunk)
+
+    def add(self, member: Member) -> None:
+        ti = make_tarinfo(member)
+        if ti is None:
+            logger.warning(f'{member.path}: socket ignored')
+            return
+        if not ti.isreg():
+            self.write_header(ti)
+            return
+
+        relpath = member.arcname.removeprefix('./')
+        st = member.st
+        if st.st_nlink > 1:
+            key = (st.st_dev, st.st_ino)
+            if key in self.inodes:
+                ti.type, ti.linkname, ti.size = tarfile.LNKTYPE, self.inodes[key], 0
+                self.write_header(ti)
+                first = self.inodes[key].removeprefix('./')
+                if first in self.checksums:
+                    self.checksums[relpath] = self.checksums[first]
+                return
+            self.inodes[key] = member.arcname
+
+        if member.data is not None:
+            ti.size = len(member.data)
+            self.write_header(ti)
+            self.write(member.data)
+            self.pad(ti.size)
+            self.checksums[relpath] = member.md5
+        elif member.segments is not None:
+            self.add_sparse(ti, member, relpath)
+        else:
+            m = hashlib.md5()
+            with open(member.path, 'rb') as f:
+                self.write_header(ti)
+                self.copy(f, ti.size, m, member.path)
+                if f.read(1):
+                    raise FileChanged(f'{member.path} grew while it was archived')
+            self.pad(ti.size)
+            self.checksums[relpath] = m.hexdigest()
+
+    def add_sparse(self, ti: tarfile.TarInfo, member: Member, relpath: str) -> None:
+        """GNU sparse format 1.0: the sparse map followed by the data segments, named <dir>/GNUSparseFile.0/<name>"""
+        real_size = ti.size
+        segments = list(member.segments)
+        # an entry at the end of the file records its size when it ends with a hole
+        if not segments or sum(segments[-1]) < real_size:
+            segments.append((real_size, 0))
+
+        sparse_map = f'{len(segments)}\n' + ''.join(f'{offset}\n{length}\n' for offset, length in segments)
+        sparse_map = sparse_map.encode()
+        sparse_map += NUL * (-len(sparse_map) % BLOCKSIZE)
+        data_size = sum(length for _, length in segments)
+
+        dir_name, base_name = os.path.split(member.arcname)
+        ti.name = f'{dir_name}/GNUSparseFile.0/{base_name}'
+        ti.size = len(sparse_map) + data_size
+        ti.pax_headers = {
+            'GNU.sparse.major': '1',
+            'GNU.sparse.minor': '0',
+            'GNU.sparse.name': member.arcname,
+            'GNU.sparse.realsize': str(real_size),
+        }
+
+        m = hashlib.md5()
+        with open(member.path, 'rb') as f:
+            self.write_header(ti)
+            self.write(sparse_map)
+            position = 0
+            for offset, length in segments:
+                self.hash_zeros(m, offset - position)
+                f.seek(offset)
+                self.copy(f, length, m, member.path)
+                position = offset + length
+            self.hash_zeros(m, real_size - position)
+        self.pad(ti.size)
+        self.checksums[relpath] = m.hexdigest()
+
+    def close(self) -> None:
+        # two zero blocks, padded to a full record
+        self.write(NUL * (2 * BLOCKSIZE))
+        self.pad_record()
+
+    def pad_record(self) -> None:
+        remainder = self.offset % RECORDSIZE
+        if remainder:
+            self.write(NUL * (RECORDSIZE - remainder))
+
+
+def write_tar(tar_path: Path | str,
+              source_dir: Path | str,
+              max_workers: int = 8,
+              prefetch_files: int = 64,
+              small_file_size: int = 1024 * 1024,
+              buffer_size: int = 4 * 1024 * 1024,
+              exclude: set[str] | None = None) -> dict[str, str]:
+    """
+    Create an uncompressed tar of source_dir at tar_path.
+
+    @param max_workers: number of threads that stat and read the files
+    @param prefetch_files: max number of entries loaded ahead of the writer
+    @param small_file_size: files up to this size are read whole by the pool
+    @param buffer_size: size of the reads of larger files and of the write buffer
+    @param exclude: paths relative to source_dir of files that are not archived
+    @return: md5 of the regular files by path relative to source_dir
+    """
+    source_dir = Path(source_dir)
+    with open(tar_path, 'wb', buffering=buffer_size) as f, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        writer = TarWriter(f, buffer_size=buffer_size)
+        window = deque()
+        try:
+            for path, arcname in iter_entries(source_dir, exclude=exclude or set()):
+                window.append(executor.submit(load_member, path, arcname, small_file_size))
+                if len(window) >= prefetch_files:
+                    writer.add(window.popleft().result())
+            while window:
+                writer.add(window.popleft().result())
+        except Exception:
+            for future in window:
+                future.cancel()
+            raise
+        writer.close()
+    return writer.checksums
@@ -1,30 +1,37 @@
 import shutil
 from pathlib import Path
-from celery import Celery
 from celery.utils.log import get_task_logger
 from sca_rhythm import WorkflowTask
 import json
 
 import workers.api as api
+import workers.bundle_codec as bundle_codec
+import workers.capacity as capacity
 import workers.cmd as cmd
-import workers.config.celeryconfig as celeryconfig
+import workers.object_store as object_store
+import workers.telemetry as telemetry
 import workers.utils as utils
 import workers.workflow_utils as wf_utils
+from workers import exceptions as exc
 from workers.config import config
+from workers.tar_writer import write_tar
 
-app = Celery("tasks")
-app.config_from_object(celeryconfig)
 logger = get_task_logger(__name__)
 
 
-def make_tarfile(celery_task: WorkflowTask, tar_path: Path, source_dir: str, source_size: int):
+def make_tarfile(celery_task: WorkflowTask,
+                 tar_path: Path,
+                 source_dir: str,
+                 source_size: int,
+                 exclude: set[str] | None = None) -> dict | None:
     """
 
     @param celery_task:
     @param tar_path:
     @param source_dir:
     @param source_size:
-    @return:
+    @param exclude: paths relative to source_dir of files that are not archived (only with the python writer)
+    @return: md5 of the archived files by relative path, None if the tar is created by GNU tar
     """
     logger.info(f'creating tar of {source_dir} at {tar_path}')
     # if the tar file already exists, delete it
@@ -36,29 +43,89 @@ def make_tarfile(celery_task: WorkflowTask, tar_path: Path, source_dir: str, sou
                                           progress_fn=lambda: tar_path.stat().st_size,
                                           total=source_size,
                                           units='bytes'):
-        # using python to create tar files does not support --sparse
         # SDA has trouble uploading sparse tar files
-        cmd.tar(tar_path=tar_path, source_dir=source_dir)
-
-    # TODO: validate files inside tar
-    return tar_path
+        # both writers store sparse files in the GNU sparse format, which is not sparse itself
+        tar_config = config['archive']['tar']
+        with telemetry.phase('tar') as m:
+            if tar_config['writer'] == 'gnu' and not exclude:
+                cmd.tar(tar_path=tar_path, source_dir=source_dir)
+                checksums = None
+            else:
+                checksums = write_tar(tar_path=tar_path,
+                                      source_dir=source_dir,
+                                      max_workers=tar_config['max_workers'],
+                                      prefetch_files=tar_config['prefetch_files'],
+                                      small_file_size=tar_config['small_file_size'],
+                                      buffer_size=tar_config['buffer_size'],
+                                      exclude=exclude)
+                m.files = len(checksums)
+            m.bytes = tar_path.stat().st_size
+
+    return checksums
+
+
+def verify_checksums(dataset: dict, checksums: dict[str, str]) -> None:
+    """
+    The archived files must be the ones that were inspected.
+    @param dataset: with columnar files
+    @param checksums: md5 of the archived files by relative path
+    """
+    files = dataset.get('files')
+    if not isinstance(files, dict):
+        return
+    mismatches = [
+        path for path, md5 in zip(files['path'], files['md5'])
+        if md5 is not None and path in checksums and checksums[path] != md5
+    ]
+    if len(mismatches) > 0:
+        raise exc.ValidationFailed(f'{len(mismatches)} files changed since the dataset was inspected: '
+                                   f'{mismatches[:10]}')
 
 
 def archive(celery_task: WorkflowTask, dataset: dict, delete_local_file: bool = False):
     # Tar the dataset directory and compute checksum
-    bundle = Path(f'{config["paths"][dataset["type"]]["bundle"]["generate"]}/{dataset["name"]}.tar')
-
-    make_tarfile(celery_task=celery_task,
-                 tar_path=bundle,
-                 source_dir=dataset['origin_path'],
-                 source_size=dataset['du_size'])
+    tar_path = Path(f'{config["paths"][dataset["type"]]["bundle"]["generate"]}/{dataset["name"]}.tar')
+
+    # in the dedup mode, the large files are stored as objects on the SDA instead of in the tar
+    objects = object_store.store_objects(celery_task=celery_task,
+                                         source_dir=Path(dataset['origin_path']),
+                                         objects=object_store.select_objects(dataset))
+
+    checksums = make_tarfile(celery_task=celery_task,
+                             tar_path=tar_path,
+                             source_dir=dataset['origin_path'],
+                             source_size=dataset['du_size'] - sum(obj['size'] for obj in objects),
+                             exclude={obj['path'] for obj in objects})
+    if checksums is not None:
+        verify_checksums(dataset, checksums)
+
+    raw_size = tar_path.stat().st_size
+    with telemetry.phase('checksum') as m:
+        raw_checksum = utils.checksum(tar_path)
+        m.bytes, m.files = raw_size, 1
+
+    # compress the tar if the codec of the dataset type is set and the tar compresses well
+    bundle, codec = tar_path, config['paths'][dataset['type']]['bundle'].get('codec')
+    if codec is not None:
+        with telemetry.phase('compress') as m:
+            bundle, codec = bundle_codec.maybe_compress(tar_path=tar_path, codec=codec)
+            m.bytes, m.files = raw_size, 1
 
     bundle_size = bundle.stat().st_size
-    bundle_checksum = utils.checksum(bundle)
+    if codec is None:
+        bundle_checksum = raw_checksum
+    else:
+        with telemetry.phase('checksum') as m:
+            bundle_checksum = utils.checksum(bundle)
+            m.bytes, m.files = bundle_size, 1
     bundle_attrs = {
         'name': bundle.name,
         'size': bundle_size,
         'md5': bundle_checksum,
+        'codec': codec,
+        'raw_size': raw_size,
+        'raw_md5': raw_checksum,
+        'objects': objects or None,
     }
 
     sda_dir = wf_utils.get_archive_dir(dataset['type'])
@@ -77,13 +144,19 @@ def archive(celery_task: WorkflowTask, dataset: dict, delete_local_file: bool =
 
 
 def archive_dataset(celery_task, dataset_id, **kwargs):
-    dataset = api.get_dataset(dataset_id=dataset_id, bundle=True)
-    sda_bundle_path, bundle_attrs = archive(celery_task, dataset)
+    dataset = api.get_dataset(dataset_id=dataset_id, bundle=True, files=True, files_format='columnar')
+
+    # the tar of the dataset is written to the bundle generation directory
+    # when it is compressed, the tar and the compressed tar are there until the compression is done
+    bundle_config = config['paths'][dataset['type']]['bundle']
+    bundle_dir = bundle_config['generate']
+    required_space = dataset['du_size'] * (2 if bundle_config.get('codec') else 1)
+    with capacity.reserved(celery_task, {bundle_dir: required_space}):
+        sda_bundle_path, bundle_attrs = archive(celery_task, dataset)
     update_data = {
         'archive_path': sda_bundle_path,
         'bundle': bundle_attrs
     }
-    api.update_dataset(dataset_id=dataset_id, update_data=update_data)
-    api.add_state_to_dataset(dataset_id=dataset_id, state='ARCHIVED')
+    api.apply_dataset_changes(dataset_id=dataset_id, update=update_data, state='ARCHIVED')
 
     return dataset_id,
@@ -3,17 +3,18 @@ import itertools
 import time
 from pathlib import Path
 
-from celery import Celery
 from celery.utils.log import get_task_logger
 
 import workers.api as api
-import workers.config.celeryconfig as celeryconfig
 from workers.config import config
 
 logger = get_task_logger(__name__)
 
-app = Celery("tasks")
-app.config_from_object(celeryconfig)
+
+# number of consecutive failed checks (ex: API is down, files deleted while scanning) tolerated
+# before the task fails
+MAX_FAILED_CHECKS = 3
+FAILED_CHECK_RETRY_DELAY = 5
 
 
 def dir_last_modified_time(dataset_path: Path) -> float:
@@ -50,21 +51,58 @@ def update_progress(celery_task, mod_time, delta):
     celery_task.update_progress(prog_obj)
 
 
-def await_stability(celery_task, dataset_id, wait_seconds: int = None, **kwargs):
-    dataset = api.get_dataset(dataset_id=dataset_id)
+def reschedule(celery_task, countdown: float, failed_checks: int = 0):
+    """
+    Re-enqueue this task to run the next stability check after countdown seconds.
+
+    The task is retried with the same task id, so the workflow step keeps a single task run
+    and the worker process is released while the dataset is waiting.
+    """
+    task_kwargs = {**celery_task.request.kwargs, 'failed_checks': failed_checks}
+    return celery_task.retry(countdown=countdown, kwargs=task_kwargs)
+
+
+def check_stability(celery_task, dataset: dict) -> float:
+    """
+    Scan the dataset's origin path once.
+
+    Returns the number of seconds to wait before the dataset can be considered stable,
+    0 if it is already stable (or if the origin path does not exist).
+    """
     origin_path = Path(dataset['origin_path'])
+    if not origin_path.exists():
+        return 0
+
+    mod_time = dir_last_modified_time(origin_path)
+    delta = time.time() - mod_time
 
-    while origin_path.exists():
-        mod_time = dir_last_modified_time(origin_path)
-        delta = time.time() - mod_time
+    logger.info(f'{dataset["name"]} dataset is last modified {int(delta)}s ago')
+    update_progress(celery_task, mod_time, delta)
 
-        logger.info(f'{dataset["name"]} dataset is last modified {int(delta)}s ago')
-        update_progress(celery_task, mod_time, delta)
+    return max(0, config['registration']['recency_threshold_seconds'] - delta)
 
-        if delta > config['registration']['recency_threshold_seconds']:
-            break
 
-        time.sleep(wait_seconds or config['registration']['wait_between_stability_checks_seconds'])
+def await_stability(celery_task, dataset_id, wait_seconds: int = None, failed_checks: int = 0, **kwargs):
+    """
+    Check once if the dataset has not been modified in the last recency_threshold_seconds.
+    If not, the task re-schedules itself instead of sleeping, so that it does not occupy a worker slot.
+
+    The next check happens after the dataset could have first become stable, but not before wait_seconds.
+    """
+    wait_seconds = wait_seconds or config['registration']['wait_between_stability_checks_seconds']
+    try:
+        dataset = api.get_dataset(dataset_id=dataset_id)
+        time_to_stable = check_stability(celery_task, dataset)
+    except Exception as e:
+        if failed_checks >= MAX_FAILED_CHECKS:
+            raise
+        logger.warning(f'stability check {failed_checks + 1} of dataset {dataset_id} failed: {e}')
+        raise reschedule(celery_task, countdown=FAILED_CHECK_RETRY_DELAY, failed_checks=failed_checks + 1)
+
+    if time_to_stable > 0:
+        countdown = max(wait_seconds, time_to_stable)
+        logger.info(f'dataset {dataset_id} is not stable yet, checking again in {int(countdown)}s')
+        raise reschedule(celery_task, countdown=countdown)
 
     api.add_state_to_dataset(dataset_id=dataset_id, state='READY')
     return dataset_id,
@@ -1,40 +1,51 @@
-import csv
 import workers.api as api
-from workers.config import config
+from workers.metadata_index import get_index
 
-def parse_csv(file_path, orien_avatar_key):
-  data = []
-  with open(file_path, mode='r') as file:
-    csv_reader = csv.DictReader(file)
-    for row in csv_reader:
-      if row['bioloop_id'] == orien_avatar_key:
-        data.append(row)
-  return data
+def parse_csv(orien_avatar_key):
+  # rows of the metadata CSV of this key, from the index of the CSV (see workers.metadata_index)
+  return get_index().lookup(orien_avatar_key)
 
-def get_metadata_from_csv(celery_task, dataset_id, **kwargs):
-
-  dataset = api.get_dataset(dataset_id=dataset_id)
+def create_metadata(dataset_id, rows):
+  if len(rows) == 0:
+    raise Exception(f'no metadata found for dataset {dataset_id}')
 
-  file_path = config['csv_path']
   data = { "metadata": []}
-  parsed_data = parse_csv(file_path, dataset['name'])
-
-
   keys = []
 
   # iterate through key value pairs in data - put in format api expects
-  for key, value in parsed_data[0].items():
+  for key, value in rows[0].items():
     keys.append(key)
     data['metadata'].append({
       "name": key,
       "data": value
     })
-    
 
   # check if metadata fields already exist - create it if not
-  api.update_metadata_fields(data=keys)  
-    
+  api.update_metadata_fields(data=keys)
+
   # create metadata for new dataset
   api.create_metadata(dataset_id=dataset_id, data=data)
 
+def get_metadata_from_csv(celery_task, dataset_id, **kwargs):
+
+  dataset = api.get_dataset(dataset_id=dataset_id)
+  create_metadata(dataset_id, parse_csv(dataset['name']))
+
   return dataset_id,
+
+def load_metadata(dataset_ids):
+  """
+  batch mode - looks up the metadata of many datasets with one query of the index
+  @return: ids of the datasets that have no metadata in the CSV
+  """
+  datasets = [api.get_dataset(dataset_id=dataset_id) for dataset_id in dataset_ids]
+  rows_by_name = get_index().lookup_many([dataset['name'] for dataset in datasets])
+
+  missing = []
+  for dataset in datasets:
+    rows = rows_by_name[dataset['name']]
+    if len(rows) == 0:
+      missing.append(dataset['id'])
+      continue
+    create_metadata(dataset['id'], rows)
+  return missing
@@ -1,14 +1,10 @@
-import shutil
 from pathlib import Path
-from celery import Celery
 from celery.utils.log import get_task_logger
 
 from workers.config import config
-import workers.config.celeryconfig as celeryconfig
 import workers.api as api
+from workers import trash
 
-app = Celery("tasks")
-app.config_from_object(celeryconfig)
 logger = get_task_logger(__name__)
 
 
@@ -20,7 +16,7 @@ def purge_uploaded_resources(celery_task, dataset_id, **kwargs):
     dataset_path = Path(config['paths'][dataset['type']]['upload']) / str(dataset_id)
     if dataset_path.exists():
         print(f"Found dataset {dataset_id}'s uploaded resources at: {dataset_path}")
-        shutil.rmtree(dataset_path)
+        trash.delete(dataset_path)
         print(f"Deleted dataset {dataset_id}'s uploaded resources")
     else:
         print(f"No uploaded resources found for dataset {dataset_id} at: {dataset_path}")
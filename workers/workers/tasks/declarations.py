@@ -1,16 +1,11 @@
-from celery import Celery
-from sca_rhythm import WorkflowTask
-
-import workers.config.celeryconfig as celeryconfig
 from workers import exceptions as exc
-
-app = Celery("tasks")
-app.config_from_object(celeryconfig)
+from workers.celery_app import app
+from workers.progress import ProgressTask
 
 
 TWO_DAYS = 2 * 24 * 60 * 60
 
-@app.task(base=WorkflowTask, bind=True, name='archive_dataset',
+@app.task(base=ProgressTask, bind=True, name='archive_dataset',
           autoretry_for=(Exception,),
           max_retries=3,
           default_retry_delay=5)
@@ -19,7 +14,7 @@ def archive_dataset(celery_task, dataset_id, **kwargs):
     return task_body(celery_task, dataset_id, **kwargs)
 
 
-@app.task(base=WorkflowTask, bind=True, name='delete_dataset',
+@app.task(base=ProgressTask, bind=True, name='delete_dataset',
           autoretry_for=(Exception,),
           max_retries=3,
           default_retry_delay=5)
@@ -28,7 +23,7 @@ def delete_dataset(celery_task, dataset_id, **kwargs):
     return task_body(celery_task, dataset_id, **kwargs)
 
 
-@app.task(base=WorkflowTask, bind=True, name='download_illumina_dataset',
+@app.task(base=ProgressTask, bind=True, name='download_illumina_dataset',
           autoretry_for=(Exception,),
           max_retries=3,
           default_retry_delay=5)
@@ -37,7 +32,7 @@ def download_illumina_dataset(celery_task, dataset_id, **kwargs):
     return task_body(celery_task, dataset_id, **kwargs)
 
 
-@app.task(base=WorkflowTask, bind=True, name='inspect_dataset',
+@app.task(base=ProgressTask, bind=True, name='inspect_dataset',
           autoretry_for=(exc.RetryableException,),
           max_retries=3,
           default_retry_delay=5)
@@ -51,7 +46,7 @@ def inspect_dataset(celery_task, dataset_id, **kwargs):
         raise exc.RetryableException(e)
 
 
-@app.task(base=WorkflowTask, bind=True, name='generate_qc',
+@app.task(base=ProgressTask, bind=True, name='generate_qc',
           autoretry_for=(Exception,),
           max_retries=3,
           default_retry_delay=5)
@@ -60,7 +55,7 @@ def generate_qc(celery_task, dataset_id, **kwargs):
     return task_body(celery_task, dataset_id, **kwargs)
 
 
-@app.task(base=WorkflowTask, bind=True, name='stage_dataset',
+@app.task(base=ProgressTask, bind=True, name='stage_dataset',
           autoretry_for=(Exception,),
           max_retries=3,
           default_retry_delay=5)
@@ -69,7 +64,7 @@ def stage_dataset(celery_task, dataset_id, **kwargs):
     return task_body(celery_task, dataset_id, **kwargs)
 
 
-@app.task(base=WorkflowTask, bind=True, name='validate_dataset',
+@app.task(base=ProgressTask, bind=True, name='validate_dataset',
           autoretry_for=(exc.RetryableException,),
           max_retries=3,
           default_retry_delay=5)
@@ -83,7 +78,7 @@ def validate_dataset(celery_task, dataset_id, **kwargs):
         raise exc.RetryableException(e)
 
 
-@app.task(base=WorkflowTask, bind=True, name='setup_dataset_download',
+@app.task(base=ProgressTask, bind=True, name='setup_dataset_download',
           autoretry_for=(exc.RetryableException,),
           max_retries=3,
           default_retry_delay=5)
@@ -97,16 +92,16 @@ def setup_dataset_download(celery_task, dataset_id, **kwargs):
         raise exc.RetryableException(e)
 
 
-@app.task(base=WorkflowTask, bind=True, name='await_stability',
-          autoretry_for=(Exception,),
-          max_retries=3,
-          default_retry_delay=5)
+# await_stability re-schedules itself (celery_task.retry) until the dataset is stable
+# failed checks are bounded in the task body, not by max_retries
+@app.task(base=ProgressTask, bind=True, name='await_stability',
+          max_retries=None)
 def await_stability(celery_task, dataset_id, **kwargs):
     from workers.tasks.await_stability import await_stability as task_body
     return task_body(celery_task, dataset_id, **kwargs)
 
 
-@app.task(base=WorkflowTask, bind=True, name='delete_source',
+@app.task(base=ProgressTask, bind=True, name='delete_source',
           autoretry_for=(Exception,),
           max_retries=3,
           default_retry_delay=5)
@@ -115,7 +110,7 @@ def delete_source(celery_task, dataset_id, **kwargs):
     return task_body(celery_task, dataset_id, **kwargs)
 
 
-@app.task(base=WorkflowTask, bind=True, name='mark_archived_and_delete',
+@app.task(base=ProgressTask, bind=True, name='mark_archived_and_delete',
           autoretry_for=(Exception,),
           max_retries=3,
           default_retry_delay=5)
@@ -124,7 +119,7 @@ def delete_dataset(celery_task, dataset_id, **kwargs):
     return task_body(celery_task, dataset_id, **kwargs)
 
 
-@app.task(base=WorkflowTask, bind=True, name='metadata',
+@app.task(base=ProgressTask, bind=True, name='metadata',
           autoretry_for=(Exception,),
           max_retries=3,
           default_retry_delay=5)
@@ -134,13 +129,13 @@ def metadata(celery_task, dataset_id, **kwargs):
 
 # https://stackoverflow.com/questions/11672179/setting-time-limit-on-specific-task-with-celery
 # set time limit for this task to 2 days
-@app.task(base=WorkflowTask, bind=True, name='batch_download', time_limit=TWO_DAYS,)
+@app.task(base=ProgressTask, bind=True, name='batch_download', time_limit=TWO_DAYS,)
 def batch_download(celery_task, batch_id, **kwargs):
     from workers.tasks.bc2_batch_download import batch_download as task_body
     return task_body(celery_task, batch_id, **kwargs)
 
 
-@app.task(base=WorkflowTask, bind=True, name='process_dataset_upload',
+@app.task(base=ProgressTask, bind=True, name='process_dataset_upload',
           autoretry_for=(exc.RetryableException,),
           max_retries=3,
           default_retry_delay=5)
@@ -149,7 +144,7 @@ def process_dataset_upload(celery_task, dataset_id, **kwargs):
     return task_body(celery_task, dataset_id, **kwargs)
 
 
-@app.task(base=WorkflowTask, bind=True, name='cancel_dataset_upload',
+@app.task(base=ProgressTask, bind=True, name='cancel_dataset_upload',
           autoretry_for=(exc.RetryableException,),
           max_retries=3,
           default_retry_delay=5)
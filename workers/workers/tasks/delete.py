@@ -1,12 +1,7 @@
-from celery import Celery
 
 import workers.api as api
-import workers.config.celeryconfig as celeryconfig
 import workers.sda as sda
 
-app = Celery("tasks")
-app.config_from_object(celeryconfig)
-
 
 def delete_dataset(celery_task, dataset_id, **kwargs):
     dataset = api.get_dataset(dataset_id=dataset_id)
@@ -18,6 +13,5 @@ def delete_dataset(celery_task, dataset_id, **kwargs):
         'is_deleted': True,
         'name': f"{dataset['name']}-{dataset['id']}"
     }
-    api.update_dataset(dataset_id=dataset_id, update_data=update_data)
-    api.add_state_to_dataset(dataset_id=dataset_id, state='DELETED')
+    api.apply_dataset_changes(dataset_id=dataset_id, update=update_data, state='DELETED')
     return dataset_id,
@@ -1,13 +1,8 @@
-import shutil
 from pathlib import Path
 
-from celery import Celery
 
 import workers.api as api
-import workers.config.celeryconfig as celeryconfig
-
-app = Celery("tasks")
-app.config_from_object(celeryconfig)
+from workers import trash
 
 
 def delete_source(celery_task, dataset_id, **kwargs):
@@ -15,6 +10,6 @@ def delete_source(celery_task, dataset_id, **kwargs):
     origin_path = Path(dataset['origin_path']).resolve()
 
     if origin_path.exists():
-        shutil.rmtree(origin_path)
+        trash.delete(origin_path)
 
     return dataset_id,
@@ -1,20 +1,17 @@
-import itertools
+import os
 import shutil
 import stat
 from pathlib import Path
 
-from celery import Celery
 from celery.utils.log import get_task_logger
 from glom import glom
 
 import workers.api as api
-import workers.config.celeryconfig as celeryconfig
+import workers.utils as utils
 from workers.config import config
 from workers.exceptions import ValidationFailed
 from workers.dataset import get_bundle_staged_path
 
-app = Celery("tasks")
-app.config_from_object(celeryconfig)
 logger = get_task_logger(__name__)
 
 
@@ -29,12 +26,48 @@ def rm(p: Path):
                 p.unlink()
 
 
-def grant_read_permissions_to_others(root: Path):
-    for p in itertools.chain([root], root.rglob('*')):
-        if p.is_dir():
-            p.chmod(p.stat().st_mode | stat.S_IROTH | stat.S_IXOTH)
-        else:
-            p.chmod(p.stat().st_mode | stat.S_IROTH)
+def grant_read_permission_to_others(path: str, st_mode: int) -> bool:
+    """
+    Add read permission for others to path, and execute (traverse) permission if it is a directory.
+    The mode is only changed when the permission bits are missing.
+
+    @return: True if the mode was changed
+    """
+    required = stat.S_IROTH | stat.S_IXOTH if stat.S_ISDIR(st_mode) else stat.S_IROTH
+    if st_mode & required == required:
+        return False
+    os.chmod(path, stat.S_IMODE(st_mode) | required)
+    return True
+
+
+def grant_read_permissions_to_entries(dir_path: str, entries: list[os.DirEntry]) -> int:
+    num_changed = 0
+    for entry in entries:
+        try:
+            # follows symlinks, as chmod does
+            st_mode = entry.stat().st_mode
+        except FileNotFoundError:
+            # broken symlink
+            continue
+        num_changed += grant_read_permission_to_others(entry.path, st_mode)
+    return num_changed
+
+
+def grant_read_permissions_to_others(root: Path) -> int:
+    """
+    Grant read permission to others on root and everything under it,
+    and execute (traverse) permission on the directories.
+
+    Directories are processed concurrently, and only the entries that are missing the permissions are modified.
+    Re-running on a tree whose permissions are correct only stats the entries.
+
+    @return: number of files and directories whose mode was changed
+    """
+    num_changed = int(grant_read_permission_to_others(str(root), root.stat().st_mode))
+    if root.is_dir():
+        num_changed += sum(utils.scandir_parallel(root, grant_read_permissions_to_entries))
+    logger.info(f'granted read permissions to others on {num_changed} entries under {root}')
+    return num_changed
 
 
 def grant_access_to_parent_chain(leaf: Path, root: Path):
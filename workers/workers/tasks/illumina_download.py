@@ -1,17 +1,12 @@
 from pathlib import Path
 
-from celery import Celery
 from sca_rhythm import WorkflowTask
 from sca_rhythm.progress import Progress
 
 import workers.api as api
-import workers.config.celeryconfig as celeryconfig
 from workers import illumina
 from workers.config import config
 
-app = Celery("tasks")
-app.config_from_object(celeryconfig)
-
 
 def download_recent_datasets(celery_task: WorkflowTask, download_dir: Path, n_days: int):
     download_dir.mkdir(exist_ok=True, parents=True)
@@ -36,6 +31,5 @@ def download_illumina_dataset(celery_task, dataset_id, **kwargs):
     update_data = {
         'origin_path': str(download_path)
     }
-    api.update_dataset(dataset_id=dataset_id, update_data=update_data)
-    api.add_state_to_dataset(dataset_id=dataset_id, state='DOWNLOADED')
+    api.apply_dataset_changes(dataset_id=dataset_id, update=update_data, state='DOWNLOADED')
     return dataset_id,
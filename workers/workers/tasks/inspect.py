@@ -1,18 +1,16 @@
 from pathlib import Path
 
-from celery import Celery
 from celery.utils.log import get_task_logger
 from sca_rhythm.progress import Progress
 
 import workers.api as api
 import workers.cmd as cmd
-import workers.config.celeryconfig as celeryconfig
+import workers.telemetry as telemetry
 import workers.utils as utils
+import workers.workflow_utils as wf_utils
 from workers import exceptions as exc
 from workers.config import config
 
-app = Celery("tasks")
-app.config_from_object(celeryconfig)
 logger = get_task_logger(__name__)
 
 
@@ -36,28 +34,30 @@ def generate_metadata(celery_task, source: Path):
     paths = list(source.rglob('*'))
     progress = Progress(celery_task=celery_task, name='', units='items')
 
-    for p in progress(paths):
-        if utils.is_readable(p):
-            if p.is_file():
-                num_files += 1
-                # if symlink, only add the size of the symlink, not the pointed file
-                file_size = p.lstat().st_size
-                size += file_size
-                # do not compute checksum for symlinks
-                hex_digest = utils.checksum(p) if not p.is_symlink() else None
-                relpath = p.relative_to(source)
-                metadata.append({
-                    'path': str(relpath),
-                    'md5': hex_digest,
-                    'size': file_size,
-                    'type': utils.filetype(p)
-                })
-                if ''.join(p.suffixes) in config['genome_file_types'] and not p.is_symlink():
-                    num_genome_files += 1
-            elif p.is_dir():
-                num_directories += 1
-        else:
-            errors.append(f'{p} is not readable/traversable')
+    with telemetry.phase('checksum') as m:
+        for p in progress(paths):
+            if utils.is_readable(p):
+                if p.is_file():
+                    num_files += 1
+                    # if symlink, only add the size of the symlink, not the pointed file
+                    file_size = p.lstat().st_size
+                    size += file_size
+                    # do not compute checksum for symlinks
+                    hex_digest = utils.checksum(p) if not p.is_symlink() else None
+                    relpath = p.relative_to(source)
+                    metadata.append({
+                        'path': str(relpath),
+                        'md5': hex_digest,
+                        'size': file_size,
+                        'type': utils.filetype(p)
+                    })
+                    if ''.join(p.suffixes) in config['genome_file_types'] and not p.is_symlink():
+                        num_genome_files += 1
+                elif p.is_dir():
+                    num_directories += 1
+            else:
+                errors.append(f'{p} is not readable/traversable')
+        m.bytes, m.files = size, num_files
 
     if len(errors) > 0:
         raise exc.InspectionFailed(errors)
@@ -69,6 +69,14 @@ def inspect_dataset(celery_task, dataset_id, **kwargs):
     dataset = api.get_dataset(dataset_id=dataset_id)
     source = Path(dataset['origin_path']).resolve()
     du_size = cmd.total_size(source)
+
+    # the size of the dataset is known now, route the next steps of the workflow by it
+    # a failure to re-route does not fail the inspection: the steps keep the routes they have
+    try:
+        wf_utils.route_remaining_steps(celery_task, dataset={**dataset, 'du_size': du_size})
+    except Exception as e:
+        logger.error(f'unable to route the next steps of the workflow of dataset {dataset_id}', exc_info=e)
+
     num_files, num_directories, size, num_genome_files, metadata = generate_metadata(celery_task, source)
 
     update_data = {
@@ -81,7 +89,6 @@ def inspect_dataset(celery_task, dataset_id, **kwargs):
         }
 
     }
-    api.update_dataset(dataset_id=dataset_id, update_data=update_data)
-    api.add_files_to_dataset(dataset_id=dataset_id, files=metadata)
+    api.apply_dataset_changes(dataset_id=dataset_id, update=update_data, files=metadata)
 
     return dataset_id,
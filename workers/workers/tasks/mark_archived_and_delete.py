@@ -14,8 +14,7 @@ def mark_archived_and_delete(celery_task, dataset_id, **kwargs):
     update_data = {
         'archive_path': sda_tar_path
     }
-    api.update_dataset(dataset_id=dataset_id, update_data=update_data)
-    api.add_state_to_dataset(dataset_id=dataset_id, state='ARCHIVED')
+    api.apply_dataset_changes(dataset_id=dataset_id, update=update_data, state='ARCHIVED')
 
     # delete tar file
     bundle_path.unlink(missing_ok=True)
@@ -1,20 +1,16 @@
 import os
-import shutil
 from pathlib import Path
-from celery import Celery
 from celery.utils.log import get_task_logger
 from celery import current_app
 from sca_rhythm import WorkflowTask, Workflow
 
 from workers import exceptions as exc
+from workers import trash
 import workers.api as api
 from workers.config import config
-import workers.config.celeryconfig as celeryconfig
 import workers.workflow_utils as wf_utils
 import workers.utils as utils
 
-app = Celery("tasks")
-app.config_from_object(celeryconfig)
 logger = get_task_logger(__name__)
 
 INTEGRATED_WORKFLOW = 'integrated'
@@ -253,7 +249,7 @@ def process(celery_task, dataset_id, **kwargs):
     else:
         print(f"No active workflows of type {INTEGRATED_WORKFLOW} found for dataset {dataset_id}")
         print(f"Starting {INTEGRATED_WORKFLOW} workflow for dataset {dataset['id']}")
-        integrated_wf_body = wf_utils.get_wf_body(wf_name=INTEGRATED_WORKFLOW)
+        integrated_wf_body = wf_utils.get_wf_body(wf_name=INTEGRATED_WORKFLOW, dataset=dataset)
         int_wf = Workflow(celery_app=current_app, **integrated_wf_body)
         int_wf_id = int_wf.workflow['_id']
         api.add_workflow_to_dataset(dataset_id=dataset_id, workflow_id=int_wf_id)
@@ -264,6 +260,6 @@ def process(celery_task, dataset_id, **kwargs):
     dataset_path = Path(config['paths']['DATA_PRODUCT']['upload']) / str(dataset['id'])
     uploaded_chunks_path = dataset_path / 'uploaded_chunks'
     if uploaded_chunks_path.exists():
-        shutil.rmtree(uploaded_chunks_path)
+        trash.delete(uploaded_chunks_path)
 
     return dataset_id,
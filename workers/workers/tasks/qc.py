@@ -1,20 +1,102 @@
 from __future__ import annotations
 
+import json
+import os
 import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
-from celery import Celery
+from celery.utils.log import get_task_logger
 from sca_rhythm import WorkflowTask
 from sca_rhythm.progress import Progress
 
 import workers.api as api
 import workers.cmd as cmd
-import workers.config.celeryconfig as celeryconfig
 import workers.utils as utils
 from workers.config import config
 
-app = Celery("tasks")
-app.config_from_object(celeryconfig)
+logger = get_task_logger(__name__)
+
+# records the inputs of the fastqc reports in the qc directory
+FASTQC_MANIFEST = 'fastqc_inputs.json'
+
+
+def num_fastqc_workers() -> int:
+    """
+    Number of fastqc processes to run concurrently.
+    Bounded by the CPU cores available to this process and by the available memory.
+    """
+    fastqc_config = config['qc']['fastqc']
+    num_workers = utils.num_cpus()
+    if fastqc_config['max_workers']:
+        num_workers = min(num_workers, fastqc_config['max_workers'])
+    available_memory = utils.available_memory()
+    if available_memory is not None:
+        num_workers = min(num_workers, available_memory // fastqc_config['memory_per_worker'])
+    return max(1, num_workers)
+
+
+def fastqc_report_name(fastq_relpath: Path | str) -> str:
+    """
+    Path, relative to the qc directory, of the zip file fastqc creates for the fastq file.
+    The reports are created in the directory of the fastq file relative to the dataset, so that the files with the same
+    name in different directories do not share a report. ex: L001/sample.fastq.gz -> L001/sample_fastqc.zip
+    """
+    fastq_relpath = Path(fastq_relpath)
+    name = fastq_relpath.name.removesuffix('.gz').removesuffix('.fastq')
+    return str(fastq_relpath.parent / f'{name}_fastqc.zip')
+
+
+def file_signature(p: Path) -> dict:
+    st = p.stat()
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def load_fastqc_manifest(output_dir: Path) -> dict:
+    """
+    The manifest records the size and mtime of each fastq file (relative path) when its fastqc report was created
+    {'<relative path>': {'size': int, 'mtime_ns': int, 'report': '<relative dir>/<name>_fastqc.zip'}}
+    """
+    manifest_path = output_dir / FASTQC_MANIFEST
+    if not manifest_path.exists():
+        return {}
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except ValueError as e:
+        logger.warning(f'unable to read fastqc manifest {manifest_path}, re-running fastqc on all files', exc_info=e)
+        return {}
+
+
+def save_fastqc_manifest(output_dir: Path, manifest: dict) -> None:
+    manifest_path = output_dir / FASTQC_MANIFEST
+    tmp_path = manifest_path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+
+def prune_fastqc_reports(output_dir: Path, manifest: dict, fastq_relpaths: set[str]) -> None:
+    """
+    remove the reports of the files that are no longer in the dataset,
+    and the reports that are not where the report of their file is created now (ex: created by a previous version)
+
+    Without a manifest (ex: the reports were created by a version that did not write one), the reports are found
+    by their name in the qc directory instead.
+    """
+    current_reports = {fastqc_report_name(p) for p in fastq_relpaths}
+    if not manifest:
+        for report_file in [*output_dir.glob('**/*_fastqc.zip'), *output_dir.glob('**/*_fastqc.html')]:
+            report = str(report_file.relative_to(output_dir))
+            if report.removesuffix('.html').removesuffix('.zip') + '.zip' not in current_reports:
+                logger.info(f'removing untracked fastqc report {report}')
+                report_file.unlink(missing_ok=True)
+    for relpath in [p for p in manifest if p not in fastq_relpaths or manifest[p]['report'] != fastqc_report_name(p)]:
+        report = manifest.pop(relpath)['report']
+        if report not in current_reports:
+            logger.info(f'removing fastqc report {report} of {relpath}')
+            (output_dir / report).unlink(missing_ok=True)
+            (output_dir / report.replace('.zip', '.html')).unlink(missing_ok=True)
 
 
 def run_fastqc(celery_task: WorkflowTask, source_dir, output_dir):
@@ -22,28 +104,74 @@ def run_fastqc(celery_task: WorkflowTask, source_dir, output_dir):
     Run the FastQC tool to check the quality of all fastq files 
     (.fastq.gz) in the source directory recursively.
 
+    Files whose size and mtime match the ones recorded in the manifest when their report was created,
+    and whose report exists, are not processed again.
+
+    Each file is processed by its own single threaded fastqc process. The files are scheduled largest first
+    on a pool of num_fastqc_workers() slots, and a slot picks the next file as soon as it is free.
+    This keeps all the slots busy instead of waiting on the slowest file of a fixed size batch.
+
     @param celery_task: WorkflowTask
     @param source_dir: (pathlib.Path): The dataset / sequencing run directory
     @param output_dir: (pathlib.Path): where to create the reports (a .zip and .html file)
     @return: None
 
     """
-    NUM_THREADS = 8
-    BATCH_SIZE = NUM_THREADS
-    fastq_files = [str(p) for p in source_dir.glob('**/*.fastq.gz')]
-    prog = Progress(celery_task=celery_task, name='fastqc', total=len(fastq_files), units='items')
+    signatures = {p: file_signature(p) for p in source_dir.glob('**/*.fastq.gz')}
+    relpaths = {p: str(p.relative_to(source_dir)) for p in signatures}
+
+    manifest = load_fastqc_manifest(output_dir)
+    prune_fastqc_reports(output_dir, manifest, set(relpaths.values()))
+
+    def has_valid_report(p: Path) -> bool:
+        entry = manifest.get(relpaths[p])
+        return (entry is not None
+                and entry['size'] == signatures[p]['size']
+                and entry['mtime_ns'] == signatures[p]['mtime_ns']
+                and (output_dir / entry['report']).exists())
+
+    fastq_files = sorted([p for p in signatures if not has_valid_report(p)],
+                         key=lambda p: signatures[p]['size'], reverse=True)
+    prog = Progress(celery_task=celery_task, name='fastqc', total=len(signatures), units='items')
 
-    done = 0
+    done = len(signatures) - len(fastq_files)
     prog.update(done=done)
-    for batch in utils.batched(fastq_files, n=BATCH_SIZE):
-        cmd.fastqc_parallel(fastq_files=batch, output_dir=output_dir, num_threads=NUM_THREADS)
-        done += len(batch)
-        prog.update(done=done)
+    save_fastqc_manifest(output_dir, manifest)
+    if len(fastq_files) == 0:
+        return
+
+    num_workers = num_fastqc_workers()
+    logger.info(f'running fastqc on {len(fastq_files)} files with {num_workers} workers, '
+                f'reusing the reports of {done} unchanged files')
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {}
+        for fastq_file in fastq_files:
+            report_dir = output_dir / Path(relpaths[fastq_file]).parent
+            report_dir.mkdir(parents=True, exist_ok=True)
+            futures[executor.submit(cmd.fastqc_parallel,
+                                    fastq_files=[fastq_file], output_dir=report_dir, num_threads=1)] = fastq_file
+        try:
+            for future in as_completed(futures):
+                future.result()
+                fastq_file = futures[future]
+                manifest[relpaths[fastq_file]] = {
+                    **signatures[fastq_file],
+                    'report': fastqc_report_name(relpaths[fastq_file])
+                }
+                save_fastqc_manifest(output_dir, manifest)
+                done += 1
+                prog.update(done=done)
+        except Exception:
+            # do not start the pending files, wait for the running ones to finish
+            for future in futures:
+                future.cancel()
+            raise
 
 
 def create_report(celery_task: WorkflowTask, dataset_dir: Path, dataset_qc_dir: Path, report_id: str = None) -> str:
     """
-    Runs fastqc and multiqc on dataset files. The qc files are placed in dataset_qc_dir
+    Runs fastqc on new / changed dataset files and multiqc on all the fastqc reports.
+    The qc files are placed in dataset_qc_dir
 
     @param celery_task: WorkflowTask
     @param dataset_dir: (Path): Staged dataset directory path
@@ -56,7 +184,11 @@ def create_report(celery_task: WorkflowTask, dataset_dir: Path, dataset_qc_dir:
     dataset_qc_dir.mkdir(parents=True, exist_ok=True)
 
     run_fastqc(celery_task, dataset_dir, dataset_qc_dir)
-    cmd.multiqc(dataset_qc_dir, dataset_qc_dir)
+    # the samples of the reports in sub-directories are named after their directory, to tell apart the files with
+    # the same name in different directories
+    manifest = load_fastqc_manifest(dataset_qc_dir)
+    prepend_dirs = any(Path(entry['report']).parent != Path('.') for entry in manifest.values())
+    cmd.multiqc(dataset_qc_dir, dataset_qc_dir, prepend_dirs=prepend_dirs)
 
     return report_id
 
@@ -83,9 +215,7 @@ def generate_qc(celery_task, dataset_id, **kwargs):
                 'report_id': report_id
             }
         }
-        api.update_dataset(dataset_id=dataset_id, update_data=update_data)
-        api.upload_report(dataset_id=dataset_id, report_filename=report_filename)
-        api.add_state_to_dataset(dataset_id=dataset_id, state='QC')
+        api.apply_dataset_changes(dataset_id=dataset_id, update=update_data, state='QC', report=report_filename)
     else:
         pass
         # TODO: fail the task if there is no report?
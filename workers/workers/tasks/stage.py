@@ -1,28 +1,29 @@
-import os
 import shutil
-import tarfile
 import tempfile
 from pathlib import Path
 
-from celery import Celery
 from celery.utils.log import get_task_logger
 from sca_rhythm import WorkflowTask
 
 import workers.api as api
+import workers.bundle_codec as bundle_codec
+import workers.capacity as capacity
+import workers.object_store as object_store
+import workers.telemetry as telemetry
 import workers.utils as utils
 from workers.config import config
-import workers.config.celeryconfig as celeryconfig
 import workers.workflow_utils as wf_utils
 from workers.dataset import compute_staging_path
 from workers.dataset import compute_bundle_path, get_bundle_staged_path
 from workers import exceptions as exc
+from workers.staging_cache import StagingCache
+from workers.tar_reader import extract_tar
 
-app = Celery("tasks")
-app.config_from_object(celeryconfig)
 logger = get_task_logger(__name__)
 
 
-def extract_tarfile(tar_path: Path, target_dir: Path, override_arcname=False):
+def extract_tarfile(tar_path: Path, target_dir: Path, override_arcname=False, raw_md5: str | None = None,
+                    celery_task: WorkflowTask | None = None, objects: list[dict] | None = None):
     """
     tar_path: path to the tar file to extract
     target_dir: path to the top level directory after extraction
@@ -35,27 +36,53 @@ def extract_tarfile(tar_path: Path, target_dir: Path, override_arcname=False):
     then set override_arcname = True
 
     If a directory with the same name as extracted dir already exists, it will be deleted.
+
+    The members are written by a pool of threads (see workers.tar_reader).
+    Compressed tars (see workers.bundle_codec) are decompressed on the fly.
     @param tar_path:
     @param target_dir:
     @param override_arcname:
+    @param raw_md5: expected md5 of the uncompressed tar, checked before the extracted directory is moved in place
+    @param celery_task: task getting the objects
+    @param objects: objects of a deduplicated dataset (bundle.objects, see workers.object_store), added to the
+                    extracted directory before the attributes of its directories are restored and it is moved in place
     """
-    with tarfile.open(tar_path, mode='r') as archive:
-        # find the top-level directory in the extracted archive
-        archive_name = os.path.commonprefix(archive.getnames())
+    extract_config = config['stage']['extract']
+
+    # create parent directories if missing
+    target_dir.parent.mkdir(parents=True, exist_ok=True)
+
+    # extracts the tar contents to a temp directory
+    # move the contents to the extraction_dir
+    with tempfile.TemporaryDirectory(dir=target_dir.parent) as tmp_dir:
+        def restore_objects(archive_name: str) -> None:
+            if objects:
+                logger.info(f'getting {len(objects)} objects from SDA to {tmp_dir}')
+                object_store.restore_objects(celery_task=celery_task,
+                                             target_dir=Path(tmp_dir) / archive_name,
+                                             objects=objects)
+
+        # the top-level directory in the extracted archive
+        with bundle_codec.open_bundle(tar_path,
+                                      buffer_size=extract_config['buffer_size'],
+                                      compute_md5=raw_md5 is not None) as reader:
+            archive_name = extract_tar(tar=reader,
+                                       dest_dir=tmp_dir,
+                                       max_workers=extract_config['max_workers'],
+                                       max_inflight_bytes=extract_config['max_inflight_bytes'],
+                                       buffer_size=extract_config['buffer_size'],
+                                       before_attributes=restore_objects)
+            evaluated_raw_md5 = reader.md5(buffer_size=extract_config['buffer_size'])
+        if raw_md5 is not None and evaluated_raw_md5 != raw_md5:
+            raise exc.ValidationFailed(f'Expected checksum of the extracted tar to be {raw_md5},'
+                                       f' but evaluated checksum was {evaluated_raw_md5}')
         extraction_dir = target_dir if override_arcname else (target_dir.parent / archive_name)
 
         # if extraction_dir exists then delete it
         if extraction_dir.exists():
             shutil.rmtree(extraction_dir)
 
-        # create parent directories if missing
-        extraction_dir.parent.mkdir(parents=True, exist_ok=True)
-
-        # extracts the tar contents to a temp directory
-        # move the contents to the extraction_dir
-        with tempfile.TemporaryDirectory(dir=extraction_dir.parent) as tmp_dir:
-            archive.extractall(path=tmp_dir)
-            shutil.move(Path(tmp_dir) / archive_name, extraction_dir)
+        shutil.move(Path(tmp_dir) / archive_name, extraction_dir)
 
 
 def stage(celery_task: WorkflowTask, dataset: dict) -> (str, str):
@@ -80,14 +107,25 @@ def stage(celery_task: WorkflowTask, dataset: dict) -> (str, str):
                                     local_file_path=bundle_download_path,
                                     celery_task=celery_task)
 
-    evaluated_checksum = utils.checksum(bundle_download_path)
+    with telemetry.phase('checksum') as m:
+        evaluated_checksum = utils.checksum(bundle_download_path)
+        m.bytes, m.files = bundle_download_path.stat().st_size, 1
     if evaluated_checksum != bundle_md5:
         raise exc.ValidationFailed(f'Expected checksum of downloaded file to be {bundle_md5},'
                                    f' but evaluated checksum was {evaluated_checksum}')
 
     # extract the tar file to stage directory
     logger.info(f'extracting tar {bundle_download_path} to {staging_dir}')
-    extract_tarfile(tar_path=bundle_download_path, target_dir=staging_dir, override_arcname=True)
+    with telemetry.phase('extract') as m:
+        # the uncompressed tar of a compressed bundle is checked as it is extracted
+        extract_tarfile(tar_path=bundle_download_path,
+                        target_dir=staging_dir,
+                        override_arcname=True,
+                        raw_md5=bundle.get('raw_md5') if bundle.get('codec') else None,
+                        # the large files of a deduplicated dataset are objects on the SDA, not in the bundle
+                        celery_task=celery_task,
+                        objects=bundle.get('objects'))
+        m.bytes = bundle_download_path.stat().st_size
 
     # delete the local tar copy after extraction
     # bundle_path.unlink()
@@ -97,7 +135,21 @@ def stage(celery_task: WorkflowTask, dataset: dict) -> (str, str):
 
 def stage_dataset(celery_task, dataset_id, **kwargs):
     dataset = api.get_dataset(dataset_id=dataset_id, bundle=True)
-    staged_path, alias, bundle_alias = stage(celery_task, dataset)
+
+    # evict least recently used staged datasets if there is not enough free space
+    if not StagingCache().make_room(dataset):
+        logger.warning(f'there may not be enough free space to stage dataset {dataset_id}')
+
+    # the bundle is downloaded to the bundle staging directory and extracted to the staging directory
+    # a compressed bundle is extracted to its raw size, the objects of a deduplicated dataset are added to it
+    bundle_size = int(dataset['bundle']['size'])
+    raw_size = int(dataset['bundle'].get('raw_size') or bundle_size)
+    objects_size = sum(int(obj['size']) for obj in dataset['bundle'].get('objects') or [])
+    with capacity.reserved(celery_task, {
+        config['paths'][dataset['type']]['bundle']['stage']: bundle_size,
+        config['paths'][dataset['type']]['stage']: raw_size + objects_size,
+    }):
+        staged_path, alias, bundle_alias = stage(celery_task, dataset)
 
     update_data = {
         'staged_path': staged_path,
@@ -106,6 +158,5 @@ def stage_dataset(celery_task, dataset_id, **kwargs):
             'bundle_alias': bundle_alias
         }
     }
-    api.update_dataset(dataset_id=dataset_id, update_data=update_data)
-    api.add_state_to_dataset(dataset_id=dataset_id, state='FETCHED')
+    api.apply_dataset_changes(dataset_id=dataset_id, update=update_data, state='FETCHED')
     return dataset_id,
@@ -0,0 +1,220 @@
+"""
+Telemetry - performance metrics of the tasks, reported to the API's metrics endpoint
+
+Every task run by the worker is measured by signal handlers (wall and CPU time, bytes read and written by the process
+from /proc/self/io). Inside a task, the expensive phases (tar, compress, put, get, extract, checksum) are measured with
+`phase`, which also records the bytes and the number of files processed to compute transfer rates.
+
+The metrics of a task run are tagged with the workflow, the step and the dataset, and are buffered and sent in batches
+by api.send_task_metrics, without retries and with a short timeout. Telemetry never fails or holds up a task: metrics
+that cannot be sent are kept for the next flush (up to max_buffered) and then dropped, metrics rejected by the API
+are dropped.
+
+metric {
+    measurement: 'task' | 'task.<phase>',
+    subject: celery task id,
+    timestamp: start of the task / phase,
+    fields: {wall_seconds, cpu_seconds, read_bytes, write_bytes, bytes, files, bytes_per_second,
+             progress_writes, progress_updates_suppressed (task)},
+    tags: {task, workflow_id, step, dataset_id, hostname, state}
+}
+
+This module is imported by the main worker process, so it must not import the task modules or their dependencies.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from celery.signals import task_prerun, task_postrun, worker_process_shutdown
+
+from workers.config import config
+
+logger = logging.getLogger(__name__)
+
+
+def io_counters() -> dict[str, int]:
+    """bytes read and written by this process (storage layer), {} if /proc/self/io is not available"""
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(':') for line in f)
+        return {'read_bytes': int(counters['read_bytes']), 'write_bytes': int(counters['write_bytes'])}
+    except (OSError, KeyError, ValueError):
+        return {}
+
+
+def cpu_seconds() -> float:
+    """CPU time of this process and its terminated subprocesses (ex: tar, hsi)"""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+class Measurement:
+    def __init__(self):
+        """wall time, CPU time and I/O from the creation of the measurement to stop()"""
+        self.timestamp = datetime.utcnow()
+        self.bytes: int | None = None
+        self.files: int | None = None
+        self._start = (time.monotonic(), cpu_seconds(), io_counters())
+        self.fields: dict = {}
+
+    def stop(self) -> dict:
+        start_wall, start_cpu, start_io = self._start
+        end_io = io_counters()
+        self.fields = {
+            'wall_seconds': round(time.monotonic() - start_wall, 3),
+            'cpu_seconds': round(cpu_seconds() - start_cpu, 3),
+            **{k: end_io[k] - start_io[k] for k in start_io if k in end_io},
+        }
+        return self.fields
+
+
+class TaskRun:
+    def __init__(self, task_id: str, tags: dict):
+        self.task_id = task_id
+        self.tags = tags
+        self.measurement = Measurement()
+        # aggregated measurements of the phases by name
+        self.phases: dict[str, dict] = {}
+        # fields of the task's metric added by other modules (ex: workers.progress)
+        self.fields: dict = {}
+        self.lock = threading.Lock()
+
+    def add_phase(self, name: str, m: Measurement) -> None:
+        with self.lock:
+            phase = self.phases.setdefault(name, {'timestamp': m.timestamp, 'fields': {}})
+            for k, v in m.fields.items():
+                phase['fields'][k] = phase['fields'].get(k, 0) + v
+            for k in ('bytes', 'files'):
+                v = getattr(m, k)
+                if v is not None:
+                    phase['fields'][k] = phase['fields'].get(k, 0) + v
+
+    def metrics(self, state: str) -> list[dict]:
+        tags = {**self.tags, 'state': state}
+        metrics = [{
+            'measurement': 'task',
+            'subject': self.task_id,
+            'timestamp': self.measurement.timestamp.isoformat() + 'Z',
+            'fields': {**self.measurement.stop(), **self.fields},
+            'tags': tags,
+        }]
+        for name, phase in self.phases.items():
+            fields = phase['fields']
+            if fields.get('bytes') and fields.get('wall_seconds'):
+                fields['bytes_per_second'] = round(fields['bytes'] / fields['wall_seconds'])
+            metrics.append({
+                'measurement': f'task.{name}',
+                'subject': self.task_id,
+                'timestamp': phase['timestamp'].isoformat() + 'Z',
+                'fields': fields,
+                'tags': tags,
+            })
+        return metrics
+
+
+class MetricsBuffer:
+    def __init__(self):
+        self.metrics: list[dict] = []
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add(self, metrics: list[dict]) -> None:
+        telemetry_config = config['telemetry']
+        with self.lock:
+            self.metrics.extend(metrics)
+            due = (len(self.metrics) >= telemetry_config['batch_size']
+                   or time.monotonic() - self.last_flush >= telemetry_config['flush_interval_seconds'])
+        if due:
+            self.flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            batch, self.metrics = self.metrics, []
+            self.last_flush = time.monotonic()
+        if not batch:
+            return
+        try:
+            import workers.api as api  # requests is not loaded by the main worker process
+            api.send_task_metrics(batch)
+        except Exception as e:
+            response = getattr(e, 'response', None)
+            if response is not None and 400 <= response.status_code < 500:
+                # rejected by the API, sending them again would fail the same way
+                logger.warning(f'dropping {len(batch)} task metrics rejected by the API', exc_info=e)
+                return
+            logger.warning(f'unable to send {len(batch)} task metrics', exc_info=e)
+            with self.lock:
+                # keep the most recent metrics for the next flush
+                self.metrics = (batch + self.metrics)[-config['telemetry']['max_buffered']:]
+
+
+_buffer = MetricsBuffer()
+_current: TaskRun | None = None
+
+
+@contextmanager
+def phase(name: str):
+    """
+    Measure a phase of the current task. Outside a task (ex: scripts), the measurement is not recorded.
+
+    usage:
+
+    with telemetry.phase('tar') as m:
+        create the tar
+        m.bytes = tar size
+        m.files = number of files
+    """
+    m = Measurement()
+    try:
+        yield m
+    finally:
+        m.stop()
+        task_run = _current
+        if task_run is not None:
+            task_run.add_phase(name, m)
+
+
+def add_fields(fields: dict) -> None:
+    """add fields to the metric of the current task. Outside a task, the fields are not recorded"""
+    task_run = _current
+    if task_run is not None:
+        with task_run.lock:
+            task_run.fields.update(fields)
+
+
+@task_prerun.connect
+def start_task_measurement(task_id=None, task=None, args=None, kwargs=None, **_):
+    global _current
+    if not config['telemetry']['enabled']:
+        return
+    kwargs = kwargs or {}
+    _current = TaskRun(task_id, tags={
+        'task': task.name,
+        'workflow_id': kwargs.get('workflow_id'),
+        'step': kwargs.get('step'),
+        'dataset_id': args[0] if args else None,
+        'hostname': socket.getfqdn(),
+    })
+
+
+@task_postrun.connect
+def record_task_measurement(task_id=None, state=None, **_):
+    global _current
+    task_run, _current = _current, None
+    if task_run is None or task_run.task_id != task_id:
+        return
+    try:
+        _buffer.add(task_run.metrics(state=state))
+    except Exception as e:
+        logger.warning(f'unable to record the metrics of task {task_id}', exc_info=e)
+
+
+@worker_process_shutdown.connect
+def flush_metrics(**_):
+    _buffer.flush()
@@ -0,0 +1,210 @@
+"""
+Trash - fast deletion of large directory trees
+
+A directory tree is renamed into a trash directory on the same filesystem, which is instantaneous,
+and is removed by a detached process. The removal unlinks the files of different directories concurrently
+and is throttled so that it does not overwhelm the metadata server of the filesystem.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from pathlib import Path
+
+from workers import utils
+from workers.config import config
+
+logger = logging.getLogger(__name__)
+
+# number of unlinks done between checks of the rate limit
+UNLINK_BATCH_SIZE = 100
+
+
+class RateLimiter:
+    def __init__(self, rate: float | None):
+        """
+        Allows at most `rate` operations per second, shared by all the threads using it.
+
+        @param rate: operations per second. None or 0 - unlimited
+        """
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def acquire(self, n: int = 1) -> None:
+        """blocks until n more operations are allowed"""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(self.next_time, now)
+            self.next_time = start + n / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class DeletionProgress:
+    def __init__(self, path: Path, log_interval: float = 30):
+        """Thread safe counter of deleted entries that is logged every log_interval seconds"""
+        self.path = path
+        self.log_interval = log_interval
+        self.num_deleted = 0
+        self.start_time = time.monotonic()
+        self.last_log_time = self.start_time
+        self.lock = threading.Lock()
+
+    def add(self, n: int) -> None:
+        with self.lock:
+            self.num_deleted += n
+            now = time.monotonic()
+            if now - self.last_log_time >= self.log_interval:
+                self.last_log_time = now
+                self.log()
+
+    def log(self) -> None:
+        elapsed = time.monotonic() - self.start_time
+        logger.info(f'deleted {self.num_deleted} entries of {self.path} in {int(elapsed)}s '
+                    f'({int(self.num_deleted / max(elapsed, 1e-6))} entries/s)')
+
+
+def remove_tree(path: Path | str,
+                max_workers: int = None,
+                max_unlinks_per_second: float = None) -> int:
+    """
+    Remove a directory tree in place.
+    The files of different directories are unlinked concurrently (unlinkat relative to the directory)
+    and the directories are removed bottom-up once they are empty.
+
+    Entries that are removed by another process during the deletion are ignored.
+
+    @param path: directory to remove
+    @param max_workers: number of threads. default: config['trash']['max_workers']
+    @param max_unlinks_per_second: throttle. default: config['trash']['max_unlinks_per_second']
+    @return: number of deleted entries
+    """
+    path = Path(path)
+    max_workers = max_workers or config['trash']['max_workers']
+    limiter = RateLimiter(max_unlinks_per_second or config['trash']['max_unlinks_per_second'])
+    progress = DeletionProgress(path)
+
+    def unlink_files(dir_path: str, entries: list[os.DirEntry]) -> str | None:
+        files = [entry.name for entry in entries if not entry.is_dir(follow_symlinks=False)]
+        try:
+            dir_fd = os.open(dir_path, os.O_RDONLY | os.O_DIRECTORY)
+        except FileNotFoundError:
+            return None
+        try:
+            for batch in utils.batched(files, n=UNLINK_BATCH_SIZE):
+                limiter.acquire(len(batch))
+                for name in batch:
+                    try:
+                        os.unlink(name, dir_fd=dir_fd)
+                    except FileNotFoundError:
+                        pass
+                progress.add(len(batch))
+        finally:
+            os.close(dir_fd)
+        return dir_path
+
+    dir_paths = [d for d in utils.scandir_parallel(path, unlink_files, max_workers=max_workers, missing_ok=True)
+                 if d is not None]
+
+    def rmdir(dir_path: str) -> None:
+        limiter.acquire()
+        try:
+            os.rmdir(dir_path)
+        except FileNotFoundError:
+            pass
+
+    # remove the directories deepest first, the directories at the same depth concurrently
+    def depth(dir_path: str) -> int:
+        return dir_path.count(os.sep)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for _, same_depth_dirs in groupby(sorted(dir_paths, key=depth, reverse=True), key=depth):
+            same_depth_dirs = list(same_depth_dirs)
+            list(executor.map(rmdir, same_depth_dirs))
+            progress.add(len(same_depth_dirs))
+
+    progress.log()
+    return progress.num_deleted
+
+
+def get_trash_dir(path: Path) -> Path | None:
+    """
+    Returns the configured trash directory that is on the same filesystem as path, None if there is no such directory.
+    """
+    device = path.parent.stat().st_dev
+    for trash_dir in config['trash']['dirs']:
+        trash_dir = Path(trash_dir)
+        if trash_dir.is_dir() and trash_dir.stat().st_dev == device:
+            return trash_dir
+    return None
+
+
+def move_to_trash(path: Path) -> Path | None:
+    """
+    Rename path into the trash directory on its filesystem.
+
+    @return: the path in the trash, None if there is no trash directory on the filesystem of path
+    """
+    trash_dir = get_trash_dir(path)
+    if trash_dir is None:
+        return None
+    trash_path = trash_dir / f'{int(time.time())}-{uuid.uuid4().hex[:8]}-{path.name}'
+    try:
+        os.rename(path, trash_path)
+    except OSError as e:
+        logger.warning(f'unable to move {path} to trash {trash_path}', exc_info=e)
+        return None
+    logger.info(f'moved {path} to trash {trash_path}')
+    return trash_path
+
+
+def empty_in_background(trash_path: Path) -> None:
+    """
+    start a detached process to remove trash_path.
+    its output is appended to config['trash']['log_file'] (relative to the workers directory, as the logs of the
+    pm2 processes)
+    """
+    project_dir = Path(__file__).resolve().parent.parent
+    log_path = project_dir / config['trash']['log_file']
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(log_path, 'ab') as log_file:
+        subprocess.Popen([sys.executable, '-m', 'workers.scripts.empty_trash', str(trash_path)],
+                         cwd=project_dir,
+                         stdin=subprocess.DEVNULL,
+                         stdout=log_file,
+                         stderr=subprocess.STDOUT,
+                         start_new_session=True)
+
+
+def delete(path: Path | str, background: bool = True) -> None:
+    """
+    Delete a file or a directory tree.
+
+    If background is True and there is a trash directory on the same filesystem, the directory is moved to
+    the trash and removed by a detached process, so this function returns immediately.
+    Otherwise, the directory is removed in place by remove_tree.
+
+    Anything left in the trash (ex: the detached process was killed) is removed by the empty_trash script.
+    """
+    path = Path(path)
+    if path.is_symlink() or not path.is_dir():
+        path.unlink(missing_ok=True)
+        return
+
+    if background:
+        trash_path = move_to_trash(path)
+        if trash_path is not None:
+            empty_in_background(trash_path)
+            return
+
+    remove_tree(path)
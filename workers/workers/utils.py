@@ -3,12 +3,14 @@ from __future__ import annotations  # type unions by | are only available in ver
 import hashlib
 import json
 import os
-from collections.abc import Iterable
+from collections.abc import Callable, Iterable
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from contextlib import contextmanager
 from datetime import datetime, timezone, date, time
 from enum import Enum, unique
 from itertools import islice
 from pathlib import Path
+from typing import Any
 
 
 def str_func_call(func, args, kwargs):
@@ -111,6 +113,79 @@ def batched(iterable: Iterable, n: int) -> list:
         yield batch
 
 
+def num_cpus() -> int:
+    """Number of CPU cores this process is allowed to run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def available_memory() -> int | None:
+    """
+    Memory (bytes) available for starting new processes without swapping.
+    Uses MemAvailable from /proc/meminfo, falls back to the total physical memory.
+    Returns None if it cannot be determined.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def scandir_parallel(root: Path | str,
+                     fn: Callable[[str, list[os.DirEntry]], Any],
+                     max_workers: int = 8,
+                     missing_ok: bool = False) -> list:
+    """
+    Traverse the directory tree under root with a pool of threads, without following symlinks.
+
+    fn(dir_path, entries) is called once for each directory (including root) on a pool thread
+    with the entries (os.DirEntry) of that directory. The subdirectories are traversed after fn returns.
+    Metadata operations (scandir, stat, chmod, unlink) release the GIL, so directories are processed concurrently.
+
+    @param root: directory to traverse
+    @param fn: callable invoked with the path of a directory and its entries
+    @param max_workers: number of threads
+    @param missing_ok: skip the directories that are removed (by another process) before they are traversed
+    @return: list of the values returned by fn (in no particular order)
+    """
+
+    def visit(dir_path: str):
+        try:
+            with os.scandir(dir_path) as it:
+                entries = list(it)
+        except FileNotFoundError:
+            if missing_ok:
+                return None, []
+            raise
+        result = fn(dir_path, entries)
+        subdirs = [entry.path for entry in entries if entry.is_dir(follow_symlinks=False)]
+        return result, subdirs
+
+    results = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(visit, str(root))}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result, subdirs = future.result()
+                    results.append(result)
+                    pending.update(executor.submit(visit, subdir) for subdir in subdirs)
+        except Exception:
+            for future in pending:
+                future.cancel()
+            raise
+    return results
+
+
 @contextmanager
 def empty_context_manager():
     try:
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import copy
 import logging
 import time
 from contextlib import contextmanager
@@ -8,10 +9,11 @@ from pathlib import Path
 # import multiprocessing
 # https://stackoverflow.com/questions/30624290/celery-daemonic-processes-are-not-allowed-to-have-children
 import billiard as multiprocessing
-from sca_rhythm import WorkflowTask
+from glom import glom
+from sca_rhythm import Workflow, WorkflowTask
 from sca_rhythm.progress import Progress
 
-from workers import sda, utils
+from workers import sda, telemetry, utils
 from workers.config import config
 
 logger = logging.getLogger(__name__)
@@ -22,16 +24,77 @@ logger = logging.getLogger(__name__)
 #     return f'{app_id}.{task_name}'
 
 
-def get_wf_body(wf_name: str) -> dict:
-    wf_body = config['workflow_registry'][wf_name]
+def get_dataset_size(dataset: dict | None) -> int | None:
+    """du_size of the dataset, or the size of its bundle. None if neither is known yet"""
+    if dataset is None:
+        return None
+    size = dataset.get('du_size') or glom(dataset, 'bundle.size', default=None)
+    return int(size) if size else None
+
+
+def get_route(task_name: str, dataset: dict | None = None) -> dict:
+    """
+    Queue and priority of a task by its type and the size of the dataset it processes.
+
+    I/O and CPU heavy tasks are sent to <app_id>.<task_type>.<small|large>.q queues so that the workers can be
+    specialized and small datasets do not wait behind large ones. Datasets of unknown size are considered large.
+    Among them, smaller datasets have higher priorities.
+    Light tasks are sent to the default queue and keep the priority assigned by the workflow (the step position).
+    """
+    routing = config['routing']
+    task_type = routing['task_types'].get(task_name)
+    if task_type is None:
+        return {'queue': f'{config["app_id"]}.q'}
+
+    size = get_dataset_size(dataset)
+    size_class = 'small' if size is not None and size <= routing['large_dataset_size'] else 'large'
+    route = {'queue': f'{config["app_id"]}.{task_type}.{size_class}.q'}
+    if size is not None:
+        route['priority'] = next(
+            (priority for max_size, priority in routing['priorities'] if size <= max_size),
+            routing['default_priority']
+        )
+    return route
+
+
+def get_wf_body(wf_name: str, dataset: dict = None) -> dict:
+    # copy the registered workflow, the steps are routed per dataset
+    wf_body = copy.deepcopy(config['workflow_registry'][wf_name])
     wf_body['name'] = wf_body.get('name', wf_name)
     wf_body['app_id'] = config['app_id']
     for step in wf_body['steps']:
         if 'queue' not in step:
-            step['queue'] = f'{config["app_id"]}.q'
+            step.update(get_route(step['task'], dataset))
     return wf_body
 
 
+def route_remaining_steps(celery_task: WorkflowTask, dataset: dict) -> None:
+    """
+    Re-route the steps after the running step of the task's workflow, ex: once the size of the dataset is known.
+
+    sca_rhythm sends the next step from the workflow loaded by the running task (celery_task.workflow) and saves
+    that whole workflow when the step succeeds, so the routes are updated there. They are saved now too,
+    for the observers of the workflow.
+    """
+    # the task instance keeps the workflow of its previous run
+    if celery_task.request.kwargs.get('workflow_id') is None:
+        return
+    wf = celery_task.workflow
+    steps = wf.workflow['steps']
+    step_idx = next((i for i, step in enumerate(steps) if step['name'] == celery_task.step), None)
+    if step_idx is None:
+        raise ValueError(f'step {celery_task.step} is not in workflow {wf.workflow["_id"]}')
+
+    update = {}
+    for i in range(step_idx + 1, len(steps)):
+        route = get_route(steps[i]['task'], dataset)
+        steps[i].update(route)
+        for key, value in route.items():
+            update[f'steps.{i}.{key}'] = value
+    if update:
+        wf.wf_col.update_one({'_id': wf.workflow['_id']}, {'$set': update})
+
+
 def get_archive_dir(dataset_type: str) -> str:
     sda_dir = config["paths"][dataset_type]["archive"]
     sda.ensure_directory(sda_dir)  # create the directory if it does not exist
@@ -108,7 +171,9 @@ def upload_file_to_sda(local_file_path: Path,
             cm = utils.empty_context_manager()
         with cm:
             logging.info(f'putting {local_file_path} on SDA at {sda_file_path}')
-            sda.put(local_file=str(local_file_path), sda_file=sda_file_path, verify_checksum=verify_checksum)
+            with telemetry.phase('put') as m:
+                sda.put(local_file=str(local_file_path), sda_file=sda_file_path, verify_checksum=verify_checksum)
+                m.bytes, m.files = local_file_path.stat().st_size, 1
 
 
 def download_file_from_sda(sda_file_path: str,
@@ -155,4 +220,6 @@ def download_file_from_sda(sda_file_path: str,
             cm = utils.empty_context_manager()
         with cm:
             logger.info(f'getting file from SDA {sda_file_path} to {local_file_path}')
-            sda.get(sda_file=sda_file_path, local_file=str(local_file_path), verify_checksum=verify_checksum)
+            with telemetry.phase('get') as m:
+                sda.get(sda_file=sda_file_path, local_file=str(local_file_path), verify_checksum=verify_checksum)
+                m.bytes, m.files = local_file_path.stat().st_size, 1